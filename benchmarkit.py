@@ -0,0 +1,670 @@
+#!/usr/bin/env python3
+#============================================================================
+# Benchmark the MozillaBuild packaging hot paths
+#============================================================================
+# Times the hot paths of packageit.py on a synthetic, MSYS2-like staging tree
+# (thousands of DLL-s, EXE-s and scripts, with duplicates like the two
+# msys-perl5_32.dll-s), using stub versions of the external tools (pacman,
+# curl, 7z, msiexec, mt.exe, editbin.exe, makensis and cmd.exe).
+#
+# So it runs on any POSIX machine (eg. Linux CI), without a Windows VM,
+# Visual Studio or an MSYS2 installation.
+#
+# Usage Instructions:
+#   ./benchmarkit.py [-o benchmark.json] [-r REPEAT] [-k NAME ...]
+#                    [--dlls N] [--exes N] [--scripts N] [--size KIB]
+#
+#   The results are written as json, to compare runs across commits, eg:
+#   ./benchmarkit.py -o new.json --compare old.json
+#============================================================================
+
+import os, sys, io, re, json, random, shutil, struct, tarfile, zipfile, threading, time
+from os.path import join as path, dirname, basename, abspath
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+from typing import Any, Callable, NamedTuple
+
+# the stubs import this file, so only the stdlib is imported up front
+# (packageit is imported when benchmarking)
+
+#============================================================================
+# USAGE
+
+PWD = abspath(dirname(__file__))
+
+args = ArgumentParser(description='Benchmark packageit.py on a synthetic staging tree')
+args.add_argument(
+    '-o', '--output', metavar='FILE',
+    dest='RESULTS', default='benchmark.json',
+    help='Where to write the results (json)',
+)
+args.add_argument(
+    '-w', '--work-path', metavar='DIR',
+    dest='WORK_PATH', default=path(PWD, 'benchmark'),
+    help='Working directory for the synthetic sources, tools and staging tree',
+)
+args.add_argument(
+    '-r', '--repeat', type=int, metavar='N',
+    dest='REPEAT', default=3,
+    help='Number of timed runs of each benchmark',
+)
+args.add_argument(
+    '-k', '--only', action='append', metavar='NAME',
+    dest='ONLY', default=None,
+    help='Only run the named benchmark (can be repeated)',
+)
+args.add_argument(
+    '-j', '--jobs', type=int, metavar='N',
+    dest='JOBS', default=os.cpu_count() or 1,
+    help='Number of parallel stages/jobs in packageit (default: number of CPUs)',
+)
+args.add_argument(
+    '--dlls', type=int, metavar='N',
+    dest='DLLS', default=2000,
+    help='Number of DLL-s in the synthetic MSYS2 tree',
+)
+args.add_argument(
+    '--exes', type=int, metavar='N',
+    dest='EXES', default=1500,
+    help='Number of EXE-s in the synthetic MSYS2 tree',
+)
+args.add_argument(
+    '--scripts', type=int, metavar='N',
+    dest='SCRIPTS', default=500,
+    help='Number of (shebang fixed) scripts in the synthetic Python tree',
+)
+args.add_argument(
+    '--size', type=int, metavar='KIB',
+    dest='SIZE', default=32,
+    help='Average size of the synthetic binaries in KiB',
+)
+args.add_argument(
+    '--seed', type=int,
+    dest='SEED', default=1,
+    help='Seed of the synthetic content',
+)
+args.add_argument(
+    '--compare', metavar='FILE',
+    dest='COMPARE', default=None,
+    help='Previous results to compare with',
+)
+
+#============================================================================
+# SYNTHETIC CONTENT
+#
+# Binaries are minimal, but valid PE32+ images (so the headers can be
+# parsed), filled with half random, half repetitive bytes (so they compress
+# about as well as real ones). Everything is deterministic for a seed.
+
+# the tree spec is passed to the stubs in the environment
+SPEC_ENV = 'PACKAGEIT_BENCH_SPEC'
+
+def spec() -> dict[str,int]:
+    return json.loads(os.environ[SPEC_ENV])
+
+def rng(*key:Any) -> random.Random:
+    return random.Random('/'.join(map(str, [spec()['seed'], *key])))
+
+def filler(rand:random.Random, size:int) -> bytes:
+    half = size // 2
+    return rand.randbytes(half) + bytes(range(256)) * ((size - half) // 256 + 1)
+
+# a PE32+ image of about 'size' bytes
+def pe(rand:random.Random, size:int, dll:bool, base:int=0x140000000) -> bytes:
+    raw = max(0x200, (size - 0x400 + 0x1ff) & ~0x1ff)
+    image = 0x1000 + ((raw + 0xfff) & ~0xfff)
+
+    dos = b'MZ' + bytes(0x3a) + struct.pack('<L', 0x80) + bytes(0x40)
+    coff = struct.pack('<HHLLLHH', 0x8664, 1, 0, 0, 0, 240,
+                       0x2022 if dll else 0x0022)
+    optional = struct.pack('<HBBLLLLLQLLHHHHHHLLLLHHQQQQLL',
+        0x20b, 14, 0, raw, 0, 0, 0x1000, 0x1000, base, 0x1000, 0x200,
+        6, 0, 0, 0, 6, 0, 0, image, 0x400, 0, 3, 0x0160,
+        0x100000, 0x1000, 0x100000, 0x1000, 0, 16) + bytes(16 * 8)
+    section = struct.pack('<8sLLLLLLHHL', b'.text', raw, 0x1000, raw, 0x400,
+                          0, 0, 0, 0, 0x60000020)
+
+    headers = dos + b'PE\0\0' + coff + optional + section
+    return headers + bytes(0x400 - len(headers)) + filler(rand, raw)[:raw]
+
+def binsize(rand:random.Random) -> int:
+    return int(spec()['size'] * 1024 * rand.uniform(0.5, 1.5))
+
+def mkfile(filepath:str, data:bytes, mode:int=0o644):
+    os.makedirs(dirname(filepath), exist_ok=True)
+    with open(filepath, 'wb') as handle: handle.write(data)
+    os.chmod(filepath, mode)
+
+# a python script with the interpreter path hardcoded, as distutils does
+def script(rand:random.Random, bang:str) -> bytes:
+    return (f'#!{bang}\n# -*- coding: utf-8 -*-\nimport re\nimport sys\n'.encode() +
+            b'# ' + filler(rand, 64).hex().encode() + b'\n' +
+            b'if __name__ == "__main__":\n    sys.exit(0)\n')
+
+#----------------------------------------------------------------------------
+# the MSYS2 tree, synced package by package by the pacman stub
+
+MSYS_PKGS = 30 # about as many packages are synced
+
+def msyspkg(root:str, pkg:str):
+    rand = rng('pkg', pkg)
+    count = lambda total: -(-total // MSYS_PKGS)
+    usrbin = path(root, 'usr', 'bin')
+
+    for index in range(count(spec()['dlls'])):
+        libdir = usrbin if index % 3 else path(root, 'usr', 'lib', pkg)
+        mkfile(path(libdir, f'msys-{pkg}-{index}.dll'), pe(rand, binsize(rand), dll=True))
+    for index in range(count(spec()['exes'])):
+        mkfile(path(usrbin, f'{pkg}-{index}.exe'), pe(rand, binsize(rand), dll=False))
+
+    # text content, and a license shared (identical) by every package
+    for index in range(20):
+        mkfile(path(root, 'usr', 'share', pkg, f'{index}.txt'), filler(rand, 2048).hex().encode())
+    mkfile(path(root, 'usr', 'share', 'licenses', pkg, 'COPYING'), b'GNU GENERAL PUBLIC LICENSE\n' * 600)
+
+    if pkg == 'msys2-runtime':
+        mkfile(path(usrbin, 'msys-2.0.dll'), pe(rand, binsize(rand), dll=True, base=0x180040000))
+        mkfile(path(usrbin, 'rm.exe'), pe(rand, binsize(rand), dll=False))
+    if pkg == 'bash':
+        mkfile(path(usrbin, 'bash.exe'), pe(rand, binsize(rand), dll=False))
+        mkfile(path(root, 'etc', 'skel', '.inputrc'), b'set bell-style none\n')
+        for name in ['07-pacman-key.post', '08-xml-catalog.post']:
+            mkfile(path(root, 'etc', 'post-install', name), b'#!/bin/sh\n')
+    if pkg == 'perl':
+        # the same dll in two places
+        dll = pe(rand, binsize(rand), dll=True)
+        mkfile(path(usrbin, 'msys-perl5_32.dll'), dll)
+        mkfile(path(root, 'usr', 'lib', 'perl5', 'core_perl', 'CORE', 'msys-perl5_32.dll'), dll)
+
+    mkfile(path(root, 'var', 'lib', 'pacman', 'local', f'{pkg}-1.0-1', 'desc'),
+           f'%NAME%\n{pkg}\n\n%VERSION%\n1.0-1\n'.encode())
+
+#============================================================================
+# STUBS
+#
+# Each stub is a tiny script (named after the tool) running stubmain().
+
+STUBS:dict[str,Callable[[list[str]],int]] = {}
+
+def stub(name:str) -> Callable:
+    def register(run:Callable[[list[str]],int]) -> Callable[[list[str]],int]:
+        STUBS[name] = run
+        return run
+    return register
+
+def stubmain(name:str, argv:list[str]):
+    sys.exit(STUBS[name](argv) or 0)
+
+def stubscript(name:str) -> bytes:
+    return '\n'.join([
+        f'#!{sys.executable}',
+        f'import sys; sys.path.insert(0, {PWD!r})',
+        f'import benchmarkit; benchmarkit.stubmain({name!r}, sys.argv[1:])',
+        '']).encode()
+
+def writestub(filepath:str, name:str):
+    mkfile(filepath, stubscript(name), 0o755)
+
+# files passed directly, or in @response files
+def fileargs(argv:list[str]) -> list[str]:
+    files = []
+    for arg in argv:
+        if arg.startswith('@'):
+            with open(arg[1:]) as handle:
+                files += [line.strip().strip('"') for line in handle if line.strip()]
+        elif not (arg.startswith('-') or re.match(r'/[A-Z]+(:|$)', arg)): files.append(arg)
+    return files
+
+def extract(archive:str, dst:str):
+    with zipfile.ZipFile(archive) as handle:
+        for info in handle.infolist():
+            handle.extract(info, dst)
+            if info.filename.endswith('.exe'): os.chmod(path(dst, info.filename), 0o755)
+
+@stub('pacman')
+def stub_pacman(argv:list[str]) -> int:
+    root = argv[argv.index('--root') + 1]
+    local = path(root, 'var', 'lib', 'pacman', 'local')
+    if '--query' in argv:
+        for entry in sorted(os.listdir(local)):
+            name, version, release = entry.rsplit('-', 2)
+            print(name, f'{version}-{release}')
+        return 0
+    config = argv[argv.index('--config') + 1] if '--config' in argv else None
+    for pkg in [arg for arg in argv[argv.index('--root') + 2:] if not arg.startswith('-') and arg != config]:
+        print(f'installing {pkg}...')
+        msyspkg(root, pkg)
+
+@stub('curl')
+def stub_curl(argv:list[str]) -> int:
+    for url in [arg for arg in argv if '://' in arg]:
+        mkfile(basename(url), filler(rng('src', url), 4096))
+
+@stub('7z')
+def stub_7z(argv:list[str]) -> int:
+    dst = next(arg[2:] for arg in argv if arg.startswith('-o'))
+    extract(argv[1], dst)
+
+@stub('msiexec')
+def stub_msiexec(argv:list[str]) -> int:
+    extract(argv[2], next(arg.split('=', 1)[1] for arg in argv if arg.startswith('TARGETDIR=')))
+
+@stub('cmd')
+def stub_cmd(argv:list[str]) -> int:
+    assert argv[:2] == ['/C', 'rmdir'], f'unsupported: {argv}'
+    shutil.rmtree(argv[-1], ignore_errors=True)
+
+# both tools rewrite the files in place
+@stub('mt')
+def stub_mt(argv:list[str]) -> int:
+    target = next(arg for arg in argv if arg.startswith('-outputresource:'))
+    with open(target.split(':', 1)[1].rsplit(';', 1)[0], 'r+b') as handle:
+        handle.seek(0x40); handle.write(b'manifest')
+
+@stub('editbin')
+def stub_editbin(argv:list[str]) -> int:
+    base = int(next(arg for arg in argv if arg.startswith('/REBASE:BASE='))
+               .split('=', 1)[1].split(',')[0], 16)
+    # the images are placed one after the other, at 64K aligned bases
+    for filepath in fileargs(argv):
+        with open(filepath, 'r+b') as handle:
+            handle.seek(0x80 + 24 + 24); handle.write(struct.pack('<Q', base))
+            handle.seek(0x80 + 24 + 56); size, = struct.unpack('<L', handle.read(4))
+            if '/DYNAMICBASE:NO' in argv:
+                handle.seek(0x80 + 24 + 70); chars, = struct.unpack('<H', handle.read(2))
+                handle.seek(0x80 + 24 + 70); handle.write(struct.pack('<H', chars & ~0x40))
+        base += (size + 0xffff) & ~0xffff
+
+@stub('makensis')
+def stub_makensis(argv:list[str]) -> int:
+    with open(argv[-1]) as handle:
+        version = re.search(r'!define VERSION (\S+)', handle.read()).group(1)
+
+    # the duplicates in the payload are copied at install time
+    copies = set()
+    if os.path.isfile('payload.nsi'):
+        with open('payload.nsi') as handle:
+            copies = {path('mozilla-build', *match.group(1).split('\\'))
+                      for match in re.finditer(r'CopyFiles /SILENT "[^"]+" "\$INSTDIR\\([^"]+)"', handle.read())}
+
+    with zipfile.ZipFile(f'MozillaBuildSetup{version}.exe', 'w', zipfile.ZIP_DEFLATED,
+                         compresslevel=1, strict_timestamps=False) as out:
+        for dirpath, dirnames, filenames in os.walk('mozilla-build'):
+            for name in filenames:
+                if path(dirpath, name) not in copies: out.write(path(dirpath, name))
+
+# the bundled python: pip is a no-op, everything else is the host python
+@stub('python')
+def stub_python(argv:list[str]) -> int:
+    if argv[:2] == ['-m', 'pip']:
+        if 'completion' in argv: print('_pip_completion() { :; }\ncomplete -F _pip_completion pip')
+        return 0
+    os.execv(sys.executable, [sys.executable, *argv])
+
+#============================================================================
+# SYNTHETIC SOURCES
+#
+# A sources dir with synthetic installers (zip-s where packageit expects
+# 7z-s or msi-s, as the stubs unpack those), plus the real nsis/content
+
+# the exe-s with their exec bits, which the in-process unzip keeps
+def zipped(filepath:str, files:dict[str,bytes]):
+    os.makedirs(dirname(filepath), exist_ok=True)
+    with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED) as out:
+        for name, data in files.items():
+            info = zipfile.ZipInfo(name, (1980, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = (0o755 if name.endswith('.exe') else 0o644) << 16
+            out.writestr(info, data)
+
+def mksources(src:str, py3path:str):
+    rand = rng('sources')
+    exe = lambda: pe(rand, binsize(rand), dll=False)
+    dll = lambda: pe(rand, binsize(rand), dll=True)
+    inst = lambda name: path(src, 'installers', name)
+
+    for name in ['nsis', 'content']:
+        shutil.copytree(path(PWD, 'sources', name), path(src, name), dirs_exist_ok=True)
+    shutil.copy(path(PWD, 'sources', 'noprivs.manifest'), src)
+    mkfile(path(src, 'vswhere.exe'), exe())
+
+    zipped(inst('7z2107-x64.msi'), {
+        'Files/7-Zip/7z.exe': stubscript('7z'), 'Files/7-Zip/7z.dll': dll(),
+        **{f'Files/7-Zip/Lang/{index}.txt': filler(rand, 4096) for index in range(80)}})
+    zipped(inst('nsis-3.08.zip'), {
+        'nsis-3.08/makensis.exe': stubscript('makensis'),
+        **{f'nsis-3.08/Stubs/{index}': dll() for index in range(20)}})
+    zipped(inst('upx-3.96-win64.zip'), {'upx-3.96-win64/upx.exe': exe()})
+    zipped(inst('unz600xN.exe'), {'unzip.exe': exe(), 'funzip.exe': exe()})
+    zipped(inst('zip300xN.zip'), {'zip.exe': exe(), 'zipnote.exe': exe()})
+    zipped(inst('KDiff3-32bit-Setup_0.9.98.exe'), {
+        'kdiff3.exe': exe(), **{f'Qt5{index}.dll': dll() for index in range(12)}})
+    zipped(inst('watchman-v2021.01.11.00.zip'), {
+        name: exe() for name in ['watchman.exe', 'eledo-pty-bridge.exe', 'gflags.dll', 'glog.dll']})
+
+    scripts = {f'Scripts/tool{index}-script.py': script(rng('script', index),
+                   'c:\\python3\\python.exe' if index % 2 else
+                   path(py3path, 'python3.exe'))
+               for index in range(spec()['scripts'])}
+    zipped(inst('python-3.10.4.7z'), {
+        'python.exe': stubscript('python'), 'python310.dll': dll(),
+        **{f'Lib/pkg{index // 50}/mod{index}.py':
+               f'# module {index}\nVALUE = {index}\n\ndef f(x):\n    return x + VALUE\n'.encode()
+           for index in range(2000)},
+        **{f'DLLs/_ext{index}.pyd': dll() for index in range(40)},
+        **scripts})
+
+    with tarfile.open(inst('emacs-26.3-x86_64-no-deps.tar.lzma'), 'w:xz', preset=1) as out:
+        for name, data in [('bin/emacs.exe', exe()),
+                           *((f'share/emacs/lisp/{index}.el', filler(rand, 8192))
+                             for index in range(200))]:
+            info = tarfile.TarInfo(name); info.size = len(data)
+            out.addfile(info, io.BytesIO(data))
+
+# the reference MSYS2, MSVC and Windows SDK, with the stubbed tools
+def mktoolchain(work:str) -> dict[str,str]:
+    msys, msvc, sdk = path(work, 'msys64'), path(work, 'msvc'), path(work, 'winsdk')
+    writestub(path(msys, 'usr', 'bin', 'pacman.exe'), 'pacman')
+    writestub(path(msys, 'usr', 'bin', 'curl.exe'), 'curl')
+    mkfile(path(msys, 'etc', 'pacman.conf'),
+           b'[options]\nArchitecture = auto\n\n[msys]\nInclude = /etc/pacman.d/mirrorlist.msys\n')
+    mkfile(path(msvc, 'VC', 'Auxiliary', 'Build', 'Microsoft.VCToolsVersion.default.txt'), b'14.30.0\n')
+    writestub(path(msvc, 'VC', 'Tools', 'MSVC', '14.30.0', 'bin', 'HostX64', 'x64', 'editbin.exe'), 'editbin')
+    writestub(path(sdk, 'mt.exe'), 'mt')
+    for name in ['msiexec', 'cmd']: writestub(path(work, 'bin', f'{name}.exe'), name)
+    return {'REF_PATH': msys, 'MSVC_PATH': msvc, 'SDK_PATH': sdk, 'BIN': path(work, 'bin')}
+
+# serve the bash completion helpers (and an MSYS2 mirror to probe) locally
+def serve(root:str) -> str:
+    mkfile(path(root, 'hg-completion.bash'), b'# hg completion\n' * 400)
+    mkfile(path(root, 'git-completion.bash'), b'# git completion\n' * 4000)
+    mkfile(path(root, 'msys2', 'msys', 'x86_64', 'msys.db'), filler(rng('msys.db'), 256 * 1024))
+    server = ThreadingHTTPServer(('127.0.0.1', 0),
+        partial(type('Quiet', (SimpleHTTPRequestHandler,), {'log_message': lambda *a: None}),
+                directory=root))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+#============================================================================
+# BENCHMARKS
+#
+# A benchmark is a setup (not timed), and a timed run returning what it
+# processed (files, bytes). Benchmarks run in the order they are defined.
+
+class Bench(NamedTuple):
+    name:  str
+    title: str
+    setup: Callable[[], Any]
+    run:   Callable[[Any], dict[str,Any]]
+
+BENCHES:dict[str,Bench] = {}
+
+def bench(name:str, title:str, setup:Callable[[],Any]=lambda: None) -> Callable:
+    def register(run:Callable[[Any],dict[str,Any]]) -> Callable:
+        BENCHES[name] = Bench(name, title, setup, run)
+        return run
+    return register
+
+pkg:Any = None  # packageit, imported by main()
+ctx:dict[str,Any] = {}
+
+def pipeline(**options:Any):
+    return pkg.Pipeline(**ctx['options'], **options)
+
+# per-stage wall times of the last run, from its trace
+def stagetimes() -> dict[str,float]:
+    return {span['name']: span['dur'] / 1e6 for span in pkg.spans if span['cat'] == 'stage'}
+
+def treefiles(top:str) -> list[str]:
+    return [path(dirpath, name) for dirpath, dirnames, filenames in os.walk(top) for name in filenames]
+
+def treebytes(files:list[str]) -> int:
+    return sum(map(os.path.getsize, files))
+
+@bench('e2e-cold', 'End-to-end packaging run, from a clean staging dir')
+def bench_e2e_cold(_) -> dict[str,Any]:
+    pipeline(CLEAN=True).run()
+    return {'stages': stagetimes(), 'bytes': os.path.getsize(pkg.INSTALLER_EXE)}
+
+@bench('withfilesin', 'Walking the staged MSYS2 tree with withfilesin')
+def bench_withfilesin(_) -> dict[str,Any]:
+    files = []
+    pkg.withfilesin(pkg.MSYS2_PATH, files.append)
+    return {'files': len(files)}
+
+@bench('index', 'Crawling the staged tree into a TreeIndex')
+def bench_index(_) -> dict[str,Any]:
+    index = pkg.TreeIndex(pkg.MOZ_PATH)
+    return {'files': len(files := index.files()), 'bytes': sum(entry.size for entry in files)}
+
+@bench('collect_dlls', 'Collecting the staged DLL-s for rebasing')
+def bench_collect_dlls(_) -> dict[str,Any]:
+    pkg.msys_dlls.clear()
+    for entry in (dlls := pkg.STAGED.files(pkg.MSYS2_PATH, ext='dll')): pkg.collect_dlls(entry)
+    return {'files': len(dlls)}
+
+def scripts_setup() -> list[str]:
+    scripts = path(ctx['work'], 'scripts')
+    shutil.rmtree(scripts, ignore_errors=True)
+    for index in range(spec()['scripts']):
+        mkfile(path(scripts, f'tool{index}-script.py'), script(rng('script', index),
+               path(pkg.PY3_PATH, 'python3.exe') if index % 2 else 'c:\\python3\\python.exe'))
+    # both paths in one script: the first of each is fixed
+    mkfile(path(scripts, 'both-script.py'),
+           script(rng('script', 'both'), path(pkg.SYS, 'python3', 'python.exe')) +
+           f'# {path(pkg.PY3_PATH, "python3.exe")}\n'.encode())
+    return treefiles(scripts)
+
+@bench('shebang_fix', 'Fixing the interpreter paths in scripts', scripts_setup)
+def bench_shebang_fix(scripts:list[str]) -> dict[str,Any]:
+    changed = pkg.shebang_fixes(scripts)
+    assert not pkg.find_bangs(both := path(ctx['work'], 'scripts', 'both-script.py')), \
+           f'an interpreter path is left in {both}'
+    return {'files': len(scripts), 'changed': changed}
+
+def copy_setup() -> list[str]:
+    shutil.rmtree(path(ctx['work'], 'copy'), ignore_errors=True)
+    return treefiles(path(pkg.MSYS2_PATH, 'usr', 'bin'))
+
+@bench('copy', 'Copying the staged usr/bin files one by one', copy_setup)
+def bench_copy(files:list[str]) -> dict[str,Any]:
+    for filepath in files: pkg.copy(filepath, path(ctx['work'], 'copy'))
+    return {'files': len(files), 'bytes': treebytes(files)}
+
+def copydir_setup():
+    shutil.rmtree(path(ctx['work'], 'copy'), ignore_errors=True)
+
+@bench('copydir', 'Copying the staged MSYS2 tree', copydir_setup)
+def bench_copydir(_) -> dict[str,Any]:
+    pkg.copydir(pkg.MSYS2_PATH, path(ctx['work'], 'copy'))
+    return {'files': len(files := treefiles(path(ctx['work'], 'copy'))), 'bytes': treebytes(files)}
+
+def unpack_setup() -> str:
+    shutil.rmtree(dst := path(ctx['work'], 'unpack'), ignore_errors=True)
+    return dst
+
+@bench('unpack-zip', 'Unpacking a zip archive', unpack_setup)
+def bench_unpack_zip(dst:str) -> dict[str,Any]:
+    pkg.unpack(pkg.INSTALL_NSIS, dst)
+    return {'bytes': os.path.getsize(pkg.INSTALL_NSIS)}
+
+@bench('unpack-xztar', 'Unpacking an xz compressed tar archive', unpack_setup)
+def bench_unpack_xztar(dst:str) -> dict[str,Any]:
+    pkg.unpack(pkg.INSTALL_EMACS, dst, 'xztar')
+    return {'bytes': os.path.getsize(pkg.INSTALL_EMACS)}
+
+@bench('unpack-select', 'Unpacking one member of a zip archive', unpack_setup)
+def bench_unpack_select(dst:str) -> dict[str,Any]:
+    pkg.unpack(pkg.INSTALL_NSIS, dst, patterns=['*/makensis.exe'], strip=1)
+    return {'files': len(treefiles(dst))}
+
+@bench('unpack-7z', 'Unpacking with (the stub of) 7-Zip', unpack_setup)
+def bench_unpack_7z(dst:str) -> dict[str,Any]:
+    pkg.unpack(pkg.INSTALL_PY3, dst)
+    return {'bytes': os.path.getsize(pkg.INSTALL_PY3)}
+
+@bench('pycompile', 'Precompiling the staged python modules')
+def bench_pycompile(_) -> dict[str,Any]:
+    pkg.stage_pycompile()
+    return {'files': len(pkg.STAGED.files(pkg.PY3_PATH, ext='py'))}
+
+# put back the staged binaries as the packages installed them (not rebased,
+# without manifests), from the same packages synced into a scratch root
+# (rm.exe is winrm in the staged tree, it's left alone)
+def pristine_setup(extension:str):
+    shutil.rmtree(scratch := path(ctx['work'], 'pristine'), ignore_errors=True)
+    for entry in os.listdir(path(pkg.MSYS2_PATH, 'var', 'lib', 'pacman', 'local')):
+        msyspkg(scratch, entry.rsplit('-', 2)[0])
+    for filepath in treefiles(scratch):
+        relpath = os.path.relpath(filepath, scratch)
+        if filepath.endswith(extension) and relpath != path('usr', 'bin', 'rm.exe'):
+            os.replace(filepath, path(pkg.MSYS2_PATH, relpath))
+    shutil.rmtree(scratch)
+    pkg.STAGED.update(pkg.MSYS2_PATH)
+
+@bench('rebase', 'Rebasing the staged DLL-s (editbin stub)', lambda: pristine_setup('.dll'))
+def bench_rebase(_) -> dict[str,Any]:
+    pkg.stage_rebase()
+    return {'files': len(pkg.msys_dlls)}
+
+@bench('manifests', 'Embedding manifests in the staged EXE-s (in-process)', lambda: pristine_setup('.exe'))
+def bench_manifests(_) -> dict[str,Any]:
+    pkg.stage_manifests()
+    return {'files': len(pkg.msys_exes)}
+
+def package_setup() -> str:
+    shutil.rmtree(pkg.PAYLOAD_CACHE, ignore_errors=True)
+    shutil.rmtree(out := path(ctx['work'], 'package'), ignore_errors=True)
+    os.makedirs(out)
+    return out
+
+def package(backend:str, out:str) -> dict[str,Any]:
+    pkg.BACKENDS[backend].build(filepath := path(out, f'payload.{backend}'))
+    return {'bytes': os.path.getsize(filepath), 'staged': pkg.TreeIndex(pkg.MOZ_PATH).size()}
+
+@bench('package-zip', 'Packaging the staged tree as a zip (parallel deflate)', package_setup)
+def bench_package_zip(out:str) -> dict[str,Any]:
+    return package('zip', out)
+
+@bench('package-tar.xz', 'Packaging the staged tree as a tar.xz (parallel xz streams)', package_setup)
+def bench_package_xz(out:str) -> dict[str,Any]:
+    return package('tar.xz', out)
+
+def repackage_setup() -> str:
+    package('zip', out := package_setup())
+    return out
+
+@bench('repackage-zip', 'Repackaging the zip from the cached chunks', repackage_setup)
+def bench_repackage_zip(out:str) -> dict[str,Any]:
+    return package('zip', out)
+
+# a dry run after the packaging run has nothing to redo
+def uptodate_setup():
+    redo = [(name, reason) for name, reason in pipeline().plan() if reason]
+    assert not redo, f'the dry run would redo stages of an up to date tree: {redo}'
+
+@bench('e2e-warm', 'End-to-end packaging run, with every stage up to date', uptodate_setup)
+def bench_e2e_warm(_) -> dict[str,Any]:
+    pipeline().run()
+    return {'stages': stagetimes()}
+
+#----------------------------------------------------------------------------
+
+def measure(item:Bench, repeat:int) -> dict[str,Any]:
+    times, result = [], {}
+    for _ in range(repeat):
+        state = item.setup()
+        start = time.perf_counter()
+        result = item.run(state) or {}
+        times.append(time.perf_counter() - start)
+
+    times.sort()
+    return {'title': item.title, 'times': times, 'min': times[0],
+            'median': times[len(times) // 2], 'mean': sum(times) / len(times), **result}
+
+def gitcommit() -> str:
+    try:
+        return pkg.output(['git', 'rev-parse', 'HEAD'], cwd=PWD, stderr=pkg.DEVNULL)
+    except Exception: return None
+
+#============================================================================
+# BENCHMARKIT!
+
+def main(argv:list[str]=None):
+    global pkg
+    options = args.parse_args(argv)
+    unknown = set(options.ONLY or []) - set(BENCHES)
+    if unknown: args.error(f'unknown benchmarks: {", ".join(sorted(unknown))} '
+                           f'(one of: {", ".join(BENCHES)})')
+
+    work = abspath(options.WORK_PATH)
+    os.environ[SPEC_ENV] = json.dumps({
+        'dlls': options.DLLS, 'exes': options.EXES, 'scripts': options.SCRIPTS,
+        'size': options.SIZE, 'seed': options.SEED})
+
+    import packageit as pkg
+    pkg.setupoutput('auto', pkg.NORMAL)
+    pkg.logsection(f'Preparing the synthetic sources and tools in {work}')
+
+    shutil.rmtree(work, ignore_errors=True)
+    mksources(path(work, 'sources'), path(work, 'stage', 'mozilla-build', 'python3'))
+    toolchain = mktoolchain(work)
+    os.environ['PATH'] = os.pathsep.join([toolchain.pop('BIN'), os.environ['PATH']])
+
+    # keep the download cache of the benchmark apart
+    pkg.CURL_PATH = path(work, 'downloaded')
+    pkg.CACHE_PATH = path(pkg.CURL_PATH, 'store')
+    pkg.CACHE_INDEX = path(pkg.CACHE_PATH, 'index.json')
+    pkg.TOOLCHAIN_CACHE = path(pkg.CURL_PATH, 'toolchain.json')
+    pkg.PAYLOAD_CACHE = path(pkg.CURL_PATH, 'payload')
+    pkg.MIRROR_CACHE = path(pkg.CURL_PATH, 'mirrors.json')
+
+    www = serve(path(work, 'www'))
+    pkg.HG_COMPLETION = f'{www}/hg-completion.bash'
+    pkg.GIT_COMPLETION = f'{www}/git-completion.bash'
+
+    ctx.update(work=work, options={
+        **toolchain, 'SRC_PATH': path(work, 'sources'), 'OUT_PATH': path(work, 'stage'),
+        'JOBS': options.JOBS, 'FETCH_TOOLS': False, 'MIRRORS': [f'{www}/msys2'], 'UNLOCKED': True, 'COLOR': 'never', 'VERBOSITY': pkg.QUIET,
+        'TRACE_FILE': path(work, 'trace.json')})
+
+    # the tree the micro benchmarks work on
+    pkg.println(pkg.taskf('stage'), 'initial packaging run', level=pkg.QUIET)
+    pipeline(CLEAN=True).run()
+
+    results = {}
+    for item in BENCHES.values():
+        if options.ONLY and item.name not in options.ONLY: continue
+        pkg.println(pkg.taskf('bench'), pkg.fmt(item.name, pkg.YELLOW), item.title, level=pkg.QUIET)
+        results[item.name] = measure(item, options.REPEAT)
+        pkg.println(pkg.taskf('time'), pkg.fmt(f'{results[item.name]["median"]:9.3f} s', pkg.CYAN),
+                    pkg.chf(f'(min {results[item.name]["min"]:.3f} s)'), level=pkg.QUIET)
+
+    report = {
+        'version':   pkg.VERSION,
+        'commit':    gitcommit(),
+        'python':    sys.version,
+        'platform':  sys.platform,
+        'cpus':      os.cpu_count(),
+        'date':      time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'tree':      spec(),
+        'repeat':    options.REPEAT,
+        'jobs':      options.JOBS,
+        'results':   results,
+    }
+    with open(options.RESULTS, 'w') as handle: json.dump(report, handle, indent=1)
+    pkg.logsuccess(f'results written to {options.RESULTS}')
+
+    if options.COMPARE:
+        with open(options.COMPARE) as handle: previous = json.load(handle)['results']
+        pkg.logsection(f'Compared with {options.COMPARE}')
+        for name, result in results.items():
+            if name not in previous: continue
+            ratio = result['median'] / previous[name]['median']
+            pkg.println(pkg.taskf('ratio'), pkg.fmt(f'{ratio:6.2f}x',
+                        pkg.GREEN if ratio < 0.95 else pkg.RED if ratio > 1.05 else pkg.DIM),
+                        name, level=pkg.QUIET)
+
+if __name__ == '__main__':
+    main()
@@ -18,19 +18,24 @@
 #   built simply by invoking ./packageit.py from a MozillaBuild terminal.
 #   It also supports command line arguments for changing the default paths
 #   if desired.
+#
+#   The stages can also be run from another script, see the PIPELINE section.
 #============================================================================
 
-import functools
-import os, stat, re, json, hashlib, typing
-from typing import Any, Callable, Iterable, Optional, Text, Union
-from winreg import OpenKey, HKEY_LOCAL_MACHINE as HKLM, HKEY_CURRENT_USER as HKCU, QueryValueEx, QueryInfoKey, EnumKey
-from shutil import copyfile, copytree, register_unpack_format, unpack_archive
+import functools, inspect, contextlib, sys, ctypes
+import os, stat, re, json, hashlib, typing, threading, time, tempfile, mmap, struct, filecmp
+import zlib, lzma, gzip, bz2, tarfile, zipfile, fnmatch, queue
+from typing import Any, Callable, Iterable, Iterator, Optional, Text, Union
+from shutil import copyfile, copyfileobj, copymode
 from os.path import join as path, dirname, basename, abspath, isdir
-from argparse import ArgumentParser
-from subprocess import DEVNULL, run, CalledProcessError
+from argparse import ArgumentParser, Namespace
+from subprocess import DEVNULL, PIPE, STDOUT, Popen, CompletedProcess, CalledProcessError
 from textwrap import dedent
-from functools import reduce
-from packaging.version import LegacyVersion as Version
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from http.client import HTTPConnection, HTTPSConnection, HTTPResponse, HTTPException, IncompleteRead
+from urllib.parse import urlsplit, urljoin, unquote
+from urllib.request import url2pathname
 
 #============================================================================
 # USAGE
@@ -47,7 +52,7 @@ args.add_argument(
 )
 args.add_argument(
     '-m', '--msys2-ref-path',
-    dest='REF_PATH', # # default=msys2_path(),
+    dest='REF_PATH', # default: msyspath(), detected when needed
     help='Path to reference MSYS2 installation (containing curl and pacman)',
 )
 args.add_argument(
@@ -57,14 +62,24 @@ args.add_argument(
 )
 args.add_argument(
     '-v', '--msvc-path',
-    dest='MSVC_PATH', # default=vswhere('installationPath'),
+    dest='MSVC_PATH', # default: vswhere('installationPath'), detected when needed
     help='Path to Visual Studio installation',
 )
 args.add_argument(
     '-w', '--win10-sdk-path',
-    dest='SDK_PATH', # default=sdkpath(),
+    dest='SDK_PATH', # default: sdkpath(), detected when needed
     help='Path to Windows 10 SDK installation folder'
 )
+args.add_argument(
+    '-c', '--clean', action='store_true',
+    dest='CLEAN', default=False,
+    help='Remove the staging directory first, and redo every stage (instead of only the invalid ones)',
+)
+args.add_argument(
+    '-j', '--jobs', type=int, metavar='N',
+    dest='JOBS', default=os.cpu_count() or 1,
+    help='Number of stages to run in parallel (default: number of CPUs)',
+)
 args.add_argument(
     '-f', '--fetch-sources', action='store_true',
     dest='FETCH_SOURCES', default=False,
@@ -72,8 +87,49 @@ args.add_argument(
 )
 args.add_argument(
     '-u', '--fetch-tools', nargs='?', choices=['with-cache', 'without-cache'],
-    dest='FETCH_TOOLS', default=('MOZ_DEV' in os.environ.keys()),
-    help=f'Download latest tool updates to "{path("PWD", "temp")}", and bundle them.',
+    dest='FETCH_TOOLS', default=('MOZ_DEV' in os.environ.keys()), const='with-cache',
+    help=f'Download latest tool updates to "{path("PWD", "downloaded")}", and bundle them. '
+          '"without-cache" skips revalidating cached downloads, and fetches everything again',
+)
+args.add_argument(
+    '--lock-file', metavar='FILE',
+    dest='LOCK_FILE', default=path(PWD, 'packageit.lock'),
+    help='Lock file pinning the tool updates and the downloaded helpers (used when it exists)',
+)
+args.add_argument(
+    '--unlocked', action='store_true',
+    dest='UNLOCKED', default=False,
+    help='Ignore the lock file, and fetch the latest tool updates and helpers',
+)
+args.add_argument(
+    '--resolve', action='store_true',
+    dest='RESOLVE', default=False,
+    help='Write the missing entries of the lock file (resolving and downloading them), instead of packaging',
+)
+args.add_argument(
+    '--update', nargs='*', metavar='NAME',
+    dest='UPDATE_TOOLS', default=None,
+    help='Refresh the named (default: all) entries of the lock file to the latest, instead of packaging',
+)
+args.add_argument(
+    '--tools-mirror', metavar='URL',
+    dest='TOOLS_MIRROR', default=None,
+    help='Try downloading the locked files from this mirror first (as URL/file name)',
+)
+args.add_argument(
+    '--github-api', metavar='URL',
+    dest='GITHUB_API', default='https://api.github.com',
+    help='Base url of the GitHub API, for the tool updates (eg. a local fake one for testing)',
+)
+args.add_argument(
+    '--github-raw', metavar='URL',
+    dest='GITHUB_RAW', default='https://raw.githubusercontent.com',
+    help='Base url of the raw GitHub repository contents (the winget manifests)',
+)
+args.add_argument(
+    '--cache-size', type=int, metavar='MIB',
+    dest='CACHE_SIZE', default=4096,
+    help='Size limit of the download cache in MiB, least recently used downloads are evicted',
 )
 args.add_argument(
     '-p', '--msys-pacman', action='store_true',
@@ -90,6 +146,17 @@ args.add_argument(
     dest='MSYS_DEVEL', default=False,
     help='Bundle libicu4c-devel, libffi-devel, libevent-devel and zlib-devel from MSYS2',
 )
+args.add_argument(
+    '--mirror', action='append', metavar='URL',
+    dest='MIRRORS', default=None,
+    help='MSYS2 mirror to sync packages and fetch sources from, can be repeated (default: a built-in list). '
+         'The mirrors are ranked by latency and throughput, and failed over in that order',
+)
+args.add_argument(
+    '--rank-mirrors', action='store_true',
+    dest='RANK_MIRRORS', default=False,
+    help='Probe the MSYS2 mirrors again (the ranking is reused for a day)',
+)
 
 #============================================================================
 # type hintig
@@ -126,24 +193,85 @@ def fmt(arg:Any, *gr:Sgr, **kwargs:Any) -> Text:
 #============================================================================
 # print raw tty print
 
+# verbosity levels: a line is printed if its level is <= VERBOSITY
+QUIET=0; NORMAL=1; VERBOSE=2
+
+# output settings, see setupoutput()
+VERBOSITY = NORMAL
+COLORED:Maybe[bool] = None  # emit sgr sequences
+LIVE:bool = True            # flush each line (when on a tty)
+
+SGR_SEQ = re.compile('\033\\[[;0-9]*m')
+
+# output of the task running on the current thread, when it's grouped:
+# printed in one piece when the task is done, so parallel tasks don't mix
+tasklog = threading.local()
+printlock = threading.Lock()
+
+# turn on ansi escape processing in the windows console (once per run)
+def vtmode() -> bool:
+    if os.name != 'nt': return True
+    ENABLE_VIRTUAL_TERMINAL_PROCESSING = 0x0004
+    try:
+        kernel32 = ctypes.windll.kernel32
+        handle, mode = kernel32.GetStdHandle(-11), ctypes.c_uint32()
+        if (kernel32.GetConsoleMode(handle, ctypes.byref(mode)) and
+            kernel32.SetConsoleMode(handle, mode.value | ENABLE_VIRTUAL_TERMINAL_PROCESSING)):
+            return True
+    except (AttributeError, OSError): pass
+    # older consoles: cmd.exe leaves vt processing enabled behind
+    return os.system('color') == 0
+
+# set up the output: color is 'auto' (colored on a tty, unless NO_COLOR
+# is set), 'always' or 'never'. off a tty (eg. in ci), output is buffered
+def setupoutput(color:str='auto', verbosity:int=NORMAL):
+    global COLORED, LIVE, VERBOSITY
+    tty = sys.stdout.isatty()
+    VERBOSITY = verbosity
+    LIVE = tty
+    COLORED = (color == 'always' or
+               (color == 'auto' and tty and 'NO_COLOR' not in os.environ))
+    if COLORED and tty: COLORED = vtmode()
+
+# write out lines (w/o sgr sequences, if not colored)
+def writelines(*lines:Text):
+    if COLORED is None: setupoutput()
+    text = os.linesep.join(lines) + os.linesep
+    with printlock:
+        sys.stdout.write(text if COLORED else SGR_SEQ.sub('', text))
+        if LIVE: sys.stdout.flush()
+
 # print text with ansi sgr colors
-def println(*args:Any):
-    os.system('color')
-    print(*args, flush=True)
+def println(*args:Any, level:int=NORMAL):
+    if level > VERBOSITY: return
+    if (lines := getattr(tasklog, 'lines', None)) is not None:
+        return lines.append(' '.join(map(str, args)))
+    writelines(' '.join(map(str, args)))
 
 # perl-like chomp: eats last newline\carriage feed pair
 def chomp(text:Text) -> Text:
     return re.sub('(\n\r?|\r\n?)$', '', text, 1)
 
 # run a subprocess
+# (in a grouped task, uncaptured output is captured into the task log,
+# and when quiet, it's captured and only shown if the command fails)
 def subproc(cmd:Cmd, **kwargs:Any):
-    try: return run(args=cmd, check=True,
-                    text=True, encoding='UTF-8', **kwargs)
+    uncaptured = not {'stdout', 'capture_output'} & kwargs.keys()
+    grouped = uncaptured and getattr(tasklog, 'lines', None) is not None
+    if uncaptured and (grouped or VERBOSITY < NORMAL):
+        kwargs.update(stdout=PIPE, stderr=STDOUT)
+    sys.stdout.flush() # the child writes to the same stdout
+
+    try: result = runproc(cmd, check=True,
+                          text=True, encoding='UTF-8', **kwargs)
     except CalledProcessError as error:
         logerror(os.linesep.join(map(nuls, [error.stdout, error.stderr])),
                  error.returncode)
         raise
 
+    if grouped and result.stdout: println(chomp(result.stdout))
+    return result
+
 # capture command output
 # print (uncaptured) error message + throw on failure
 def output(cmd:Cmd, **kwargs:Any):
@@ -154,6 +282,8 @@ def output(cmd:Cmd, **kwargs:Any):
 
 # guess msys path: check default or guess from registry
 def msyspath():
+    from winreg import OpenKey, HKEY_CURRENT_USER as HKCU, QueryValueEx, QueryInfoKey, EnumKey
+
     # default MSYS2 install path
     msyspath=path(SYS, 'msys64')
 
@@ -182,80 +312,263 @@ def msyspath():
 
 # query a property of latest msvc/prerelease/buildtools installed
 def vswhere(property:str) -> Path:
-    return output([path(os.getcwd(), 'sources', 'vswhere.exe'),
+    return output([VSWHERE,
                    '-products', '*', '-latest', '-prerelease',
                    '-format', 'value', '-utf8', '-property', property])
 
 # detect winsdk path
 def sdkpath() -> Path:
+    from winreg import OpenKey, HKEY_LOCAL_MACHINE as HKLM, QueryValueEx
+
     with OpenKey(HKLM, path('SOFTWARE', 'WOW6432Node', 'Microsoft', 'Microsoft SDKs', 'Windows', 'v10.0')) as hkey:
         sdk = QueryValueEx(hkey, 'InstallationFolder')[0]
         ver = QueryValueEx(hkey, 'ProductVersion')[0]
 
     return path(sdk, 'bin', f'{ver}.0', 'x64')
 
-args.set_defaults(
-    REF_PATH  = msyspath(),
-    MSVC_PATH = vswhere('installationPath'),
-    SDK_PATH  = sdkpath()
+# output options
+args.add_argument(
+    '-q', '--quiet', action='store_const', const=QUIET,
+    dest='VERBOSITY', default=NORMAL,
+    help='Only print section headers, results and errors',
+)
+args.add_argument(
+    '-V', '--verbose', action='store_const', const=VERBOSE,
+    dest='VERBOSITY',
+    help='Also print every single tool invocation',
+)
+args.add_argument(
+    '--color', choices=['auto', 'always', 'never'],
+    dest='COLOR', default='auto',
+    help='Colorize the output (default: auto, when printing to a terminal)',
 )
 
-parsed = args.parse_args()
+args.add_argument(
+    '--dedup', choices=['nsis', 'report', 'off'],
+    dest='DEDUP', default='nsis',
+    help='Pack identical staged files once, and copy them at install time (default), '
+         'or only report the bytes that would be saved',
+)
 
-SRC_PATH      = parsed.SRC_PATH
-REF_PATH      = parsed.REF_PATH
-OUT_PATH      = parsed.OUT_PATH
-MSVC_PATH     = parsed.MSVC_PATH
-SDK_PATH      = parsed.SDK_PATH
-MSYS_PACMAN   = parsed.MSYS_PACMAN
-MSYS_EXTRA    = parsed.MSYS_EXTRA
-MSYS_DEVEL    = parsed.MSYS_DEVEL
-FETCH_SOURCES = parsed.FETCH_SOURCES
-FETCH_TOOLS   = parsed.FETCH_TOOLS
+args.add_argument(
+    '-b', '--backend', action='append', choices=['nsis', 'zip', 'tar.xz', 'tar.zst'],
+    dest='BACKEND_NAMES', default=None,
+    help='Package with the given backend (can be repeated, default: nsis): the NSIS installer, '
+         'or a portable archive of the staged tree (tar.zst needs the zstandard module)',
+)
+args.add_argument(
+    '--zip-stdlib', action='store_true',
+    dest='ZIP_STDLIB', default=False,
+    help='Ship the pure python modules of the standard library precompiled in pythonXY.zip (faster imports)',
+)
+args.add_argument(
+    '--benchmark-imports', action='store_true',
+    dest='BENCH_IMPORTS', default=False,
+    help='Stage python, then time importing mercurial with and without the precompiled bytecode '
+         '(in importtime.json, run again with --zip-stdlib to compare the layouts), instead of packaging',
+)
+args.add_argument(
+    '--benchmark-backends', action='store_true',
+    dest='BENCH_BACKENDS', default=False,
+    help='Stage, then compare the packaging time, ratio and extraction speed of the backends '
+         '(the -b ones, or all of them) on the staged tree, instead of packaging',
+)
+
+# pipeline options
+args.add_argument(
+    '--trace', metavar='FILE',
+    dest='TRACE_FILE', default=None,
+    help='Where to write the Chrome trace of the run (default: trace.json in the staging directory)',
+)
+args.add_argument(
+    '-n', '--dry-run', action='store_true',
+    dest='DRY_RUN', default=False,
+    help='Only list the stages which would be (re)done, and why',
+)
+args.add_argument(
+    '--stage', action='append', metavar='NAME',
+    dest='ONLY_STAGES', default=None,
+    help='Only (re)do the named stage (can be repeated), regardless of its stamp',
+)
 
 #============================================================================
 # SUPPLEMENTARY CONFIG
 
-# requred binaries from mreferenced MSYS
-REF_PACMAN = path(REF_PATH, 'usr', 'bin', 'pacman.exe')
-REF_CURL   = path(REF_PATH, 'usr', 'bin', 'curl.exe')
+# downloads dir
+CURL_PATH   = path(PWD, 'downloaded')
+CACHE_PATH  = path(CURL_PATH, 'store')
+CACHE_INDEX = path(CACHE_PATH, 'index.json')
+
+# detected toolchain paths
+TOOLCHAIN_CACHE = path(CURL_PATH, 'toolchain.json')
+
+# compressed chunks of the portable packages (kept over clean builds)
+PAYLOAD_CACHE = path(CURL_PATH, 'payload')
+
+# the locked wheels of the pip packages (for pip's --find-links)
+WHEELHOUSE   = path(CURL_PATH, 'wheels')
+PIP_PLATFORM = 'win_amd64'
+
+# bytecode of the staged python (the excluded modules don't compile, on purpose)
+PYC_EXCLUDE = r'bad_coding|badsyntax|lib2to3[\\/]tests[\\/]data'
+# kept on disk with --zip-stdlib (they read their own files, or are the landmark
+# python looks for to find its prefix)
+ZIP_STDLIB_KEEP = ['site-packages', 'test', 'idlelib', 'tkinter', 'turtledemo',
+                   'venv', 'ensurepip', 'lib2to3', 'distutils', 'os.py']
+IMPORT_BENCH = 'import mercurial'
+IMPORT_RUNS  = 5
+
+# tool metadata responses are reused for this long, before revalidating
+API_TTL = 60 * 60 # seconds
+
+# http client settings
+HTTP_AGENT     = 'MozillaBuild-packageit'
+HTTP_TIMEOUT   = 60 # seconds
+HTTP_REDIRECTS = 10
+HTTP_CHUNK     = 1024 * 1024
+HTTP_RETRIES   = 4   # after the first attempt
+HTTP_BACKOFF   = 1.0 # seconds, doubled after each retry
+HTTP_TRANSIENT = [408, 429, 500, 502, 503, 504]
+FETCH_JOBS     = 8  # concurrent downloads
+
+# MSYS2 mirrors (with the repositories at {mirror}/msys/$arch)
+MSYS2_MIRRORS = [
+    'https://repo.msys2.org',
+    'https://mirror.msys2.org',
+    'https://mirrors.dotsrc.org/msys2',
+    'https://mirror.selfnet.de/msys2',
+    'https://mirror.clarkson.edu/msys2',
+    'https://mirrors.tuna.tsinghua.edu.cn/msys2',
+    'https://mirrors.ustc.edu.cn/msys2',
+]
+MIRROR_CACHE   = path(CURL_PATH, 'mirrors.json') # the ranking
+MIRROR_TTL     = 24 * 60 * 60 # seconds
+MIRROR_PROBE   = 'msys/x86_64/msys.db' # probed for latency and throughput
+MIRROR_BYTES   = 1024 * 1024 # read at most this much of it
+MIRROR_SIZE    = 4 * 1024 * 1024 # a typical package, to weigh the two
+MIRROR_TIMEOUT = 10 # seconds
+MIRROR_RETRIES = 1  # per mirror, before failing over to the next one
+
+# MSYS2 package sources ({base}-{version}.src.tar.gz)
+SOURCES_PATH  = 'msys/sources' # on the mirrors
+SOURCES_INDEX = 'sources.json' # what was fetched, in OUT_SRC_PATH
+
+# bash completion helpers, always downloaded
+HG_COMPLETION  = 'https://www.mercurial-scm.org/repo/hg/raw-file/tip/contrib/bash_completion'
+GIT_COMPLETION = 'https://raw.githubusercontent.com/git/git/master/contrib/completion/git-completion.bash'
 
-# sources
-INSTALL_PATH = path(SRC_PATH, 'installers')
-CONTENT_PATH = path(SRC_PATH, 'content')
-NSISSRC_PATH = path(SRC_PATH, 'nsis')
+#----------------------------------------------------------------------------
+# paths depending on the options: (re)set for the options of a run (see
+# the PIPELINE section), the defaults are configured at the end of the file
+
+def configure(options:Namespace):
+    globals().update(vars(options))
+    toolchain.clear()
+    ranked.clear()
+    mirrorfailures.clear()
+
+    # sources
+    INSTALL_PATH = path(SRC_PATH, 'installers')
+    CONTENT_PATH = path(SRC_PATH, 'content')
+    NSISSRC_PATH = path(SRC_PATH, 'nsis')
+
+    # workdirs
+    STAMP_PATH = path(OUT_PATH, '.stages')
+    TRACE_PATH = TRACE_FILE or path(OUT_PATH, 'trace.json')
+    MOZ_PATH = path(OUT_PATH, 'mozilla-build')
+    BIN_PATH = path(MOZ_PATH, 'bin')
+    PY3_PATH = path(MOZ_PATH, 'python3')
+    PYSCRPTS = path(PY3_PATH, 'Scripts')
+
+    # base urls of services used
+    WINGET_PKGS = f'{GITHUB_API}/repos/microsoft/winget-pkgs'
+    WINGET_RAW  = f'{GITHUB_RAW}/microsoft/winget-pkgs/master'
+
+    # utilites
+    VSWHERE  = path(SRC_PATH, 'vswhere.exe')
+    UN7IP    = path(BIN_PATH, '7z.exe' )
+
+    # INSTALLERS INCLUDED
+    INSTALL_7ZIP  = path(INSTALL_PATH, '7z2107-x64.msi')
+    INSTALL_NSIS  = path(INSTALL_PATH, 'nsis-3.08.zip')
+    INSTALL_UPX   = path(INSTALL_PATH, 'upx-3.96-win64.zip')
+    INSTALL_PY3   = path(INSTALL_PATH, 'python-3.10.4.7z')
+    INSTALL_UNZ   = path(INSTALL_PATH, 'unz600xN.exe')
+    INSTALL_ZIP   = path(INSTALL_PATH, 'zip300xN.zip')
+    INSTALL_EMACS = path(INSTALL_PATH, 'emacs-26.3-x86_64-no-deps.tar.lzma')
+    INSTALL_KDIFF = path(INSTALL_PATH, 'KDiff3-32bit-Setup_0.9.98.exe')
+    INSTALL_WATCH = path(INSTALL_PATH, 'watchman-v2021.01.11.00.zip')
+
+    # staged components
+    OUT_7ZIP = path(OUT_PATH, '7zip')
+    BIN_7ZIP = path(BIN_PATH, '7zip')
+    INFOZIP_OUT_PATH = path(BIN_PATH, 'info-zip')
 
-# downloads dir
-CURL_PATH = path(PWD, 'downloaded')
-ETAG_PATH = path(CURL_PATH, 'cache')
+    MSYS2_PATH = path(MOZ_PATH, 'msys2')
+    MSYS2_ETC  = path(MSYS2_PATH, 'etc')
+    MSYS2_USR  = path(MSYS2_PATH, 'usr')
+    MSYS2_UBIN = path(MSYS2_USR,  'bin')
 
-# workdirs
-MOZ_PATH = path(OUT_PATH, 'mozilla-build')
-BIN_PATH = path(MOZ_PATH, 'bin')
-PY3_PATH = path(MOZ_PATH, 'python3')
-PYSCRPTS = path(PY3_PATH, 'Scripts')
+    OUT_SRC_PATH  = path(OUT_PATH, 'sources')
+    COMPLETIONS   = path(MSYS2_USR, 'share', 'bash-completion', 'completions')
+    INSTALLER_EXE = path(OUT_PATH, f'MozillaBuildSetup{VERSION}.exe')
+    PORTABLE_BASE = path(OUT_PATH, f'MozillaBuild{VERSION}')
+    PACKAGE_WITH  = list(dict.fromkeys(BACKEND_NAMES or ['nsis']))
 
-# utilites
-VSWHERE  = path(SRC_PATH, 'vswhere.exe')
-YML2JSON = path(SRC_PATH, 'y2j.exe')
-UN7IP    = path(BIN_PATH, '7z.exe' )
+    # pacman config for syncing the staging root (with the ranked mirrors)
+    MIRROR_URLS = [url.rstrip('/') for url in MIRRORS or MSYS2_MIRRORS]
+    PACMAN_CONF = path(OUT_PATH, 'pacman', 'pacman.conf')
+    MIRRORLIST  = path(OUT_PATH, 'pacman', 'mirrorlist.msys')
 
-# base urls of services used
-GITHUB_API  = f'https://api.github.com/repos'
-WINGET_PKGS = f'{GITHUB_API}/microsoft/winget-pkgs'
+    # index of the staged files
+    STAGED = TreeIndex(MOZ_PATH)
 
-#============================================================================
-# INSTALLERS INCLUDED
-
-INSTALL_7ZIP  = path(INSTALL_PATH, '7z2107-x64.msi')
-INSTALL_NSIS  = path(INSTALL_PATH, 'nsis-3.08.zip')
-INSTALL_UPX   = path(INSTALL_PATH, 'upx-3.96-win64.zip')
-INSTALL_PY3   = path(INSTALL_PATH, 'python-3.10.4.7z')
-INSTALL_UNZ   = path(INSTALL_PATH, 'unz600xN.exe')
-INSTALL_ZIP   = path(INSTALL_PATH, 'zip300xN.zip')
-INSTALL_EMACS = path(INSTALL_PATH, 'emacs-26.3-x86_64-no-deps.tar.lzma')
-INSTALL_KDIFF = path(INSTALL_PATH, 'KDiff3-32bit-Setup_0.9.98.exe')
-INSTALL_WATCH = path(INSTALL_PATH, 'watchman-v2021.01.11.00.zip')
+    globals().update({name: value for name, value in locals().items() if name.isupper()})
+
+#----------------------------------------------------------------------------
+# lazy toolchain discovery: the reference MSYS2, MSVC and the Windows SDK
+# are only looked for when a stage needs them (unless given as options).
+# found paths are cached in TOOLCHAIN_CACHE, and looked for again when
+# the path is gone, or its mtime changed (eg. updated or reinstalled)
+
+toolchain:dict[str,Path] = {}
+toolchainlock = threading.Lock()
+
+def mtime(filepath:Path) -> Maybe[int]:
+    try: return os.stat(filepath).st_mtime_ns
+    except OSError: return None
+
+def discover(name:str, probe:Callable[[],Path]) -> Path:
+    with toolchainlock:
+        if name in toolchain: return toolchain[name]
+
+        try: cached = json.loads(getcontents(TOOLCHAIN_CACHE))
+        except (OSError, ValueError): cached = {}
+
+        if not ((entry := cached.get(name)) and entry['mtime'] is not None and
+                mtime(entry['path']) == entry['mtime']):
+            println(taskf('detect', YELLOW), name)
+            cached[name] = entry = {'path': (found := probe()), 'mtime': mtime(found)}
+            mkdirs(CURL_PATH)
+            putcontents(TOOLCHAIN_CACHE, json.dumps(cached, indent=1))
+
+        toolchain[name] = entry['path']
+        return entry['path']
+
+def refpath() -> Path:
+    return REF_PATH or discover('msys2', msyspath)
+
+def msvcpath() -> Path:
+    return MSVC_PATH or discover('msvc', lambda: vswhere('installationPath'))
+
+def winsdkpath() -> Path:
+    return SDK_PATH or discover('winsdk', sdkpath)
+
+# requred binaries from the referenced MSYS
+def reftool(name:str) -> Path:
+    tool = path(refpath(), 'usr', 'bin', name)
+    assert os.path.isfile(tool), f'Reference MSYS2 installation is invalid:\n\t"{tool}" missing'
+    return tool
 
 #============================================================================
 # LOGGING
@@ -285,7 +598,8 @@ def urlf(url:Url) -> Text:
 
 # status messages
 def logstatus(pre:Text, bg:Sgr, text:Text, code:Any=None, tpl:Text=' {} '):
-    println(pre, fmt(nuls(code, fmt=tpl), DIM, bg, YELLOW+BGR, REVERSED), text)
+    println(pre, fmt(nuls(code, fmt=tpl), DIM, bg, YELLOW+BGR, REVERSED), text,
+            level=QUIET)
 
 def logsuccess(text:Text, code:Any='DONE'): logstatus('-', GREEN, text, code)
 def logerror(text:Text, code:Any='ERROR'): logstatus('!', RED, text, code)
@@ -301,17 +615,18 @@ def logheader(text:Text, arginfo:list[tuple[Text,Any]]):
         boxln, *(' '.join([chf(':', WHITE), fmt(label.ljust(width), YELLOW),
                            chf(':'), fmt(str(value), GREEN)])
                 for (label, value) in arginfo),
-        boxln]))
+        boxln]), level=QUIET)
 
-# section header, subheader
+# section header, subheader (also starting a traced section)
 def logsection(text:Text):
-    println(fmt(f'{os.linesep}# {text}', BOLD, MAGENTA))
+    tracesection(SGR_SEQ.sub('', text))
+    println(fmt(f'{os.linesep}# {text}', BOLD, MAGENTA), level=QUIET)
 
 def logsubhead(text:Text):
     logsection(fmt(text, MAGENTA))
 
 # colored command line
-def logcall(cmd:Cmd):
+def logcall(cmd:Cmd, level:int=NORMAL):
     def argvf(arg:str) -> str:
         key, eq, value = re.match('([^="\\\']+)?([=])?(.*)', arg).groups()
         return ''.join([key, chf(eq), fmt(value, ITALIC, GREEN)])
@@ -326,15 +641,138 @@ def logcall(cmd:Cmd):
         if os.path.sep in arg:    return argvf(fmt(arg, ITALIC, WHITE))
         return argvf(fmt(arg, GREEN))
 
-    println(fmt('$', WHITE), *map(argf, map(nuls,cmd), range(len(cmd))))
+    println(fmt('$', WHITE), *map(argf, map(nuls,cmd), range(len(cmd))), level=level)
+
+#============================================================================
+# TRACING
+#
+# Every stage, section (from logsection/logsubhead), process, download,
+# copy and unpack is recorded as a span, with its wall time and (where it
+# applies) child cpu time, bytes read/written/downloaded and exit status.
+# After a run the spans are written as a Chrome trace (load it in
+# chrome://tracing or https://ui.perfetto.dev) and summarized.
+
+TRACE_EPOCH = time.perf_counter()
+
+spans:list[Json] = []
+spanlock = threading.Lock()
+threadnames:dict[int,str] = {}
+
+# the open section of the current thread: (name, start)
+sections = threading.local()
+
+def addspan(cat:str, name:Text, start:float, end:float, args:dict[str,Any]):
+    thread = threading.current_thread()
+    with spanlock:
+        threadnames[thread.ident] = thread.name
+        spans.append({
+            'name': name, 'cat': cat, 'ph': 'X',
+            'pid': os.getpid(), 'tid': thread.ident,
+            'ts': round((start - TRACE_EPOCH) * 1e6),
+            'dur': round((end - start) * 1e6),
+            'args': args,
+        })
+
+# trace a block, the span args can be updated with the yielded dict
+@contextlib.contextmanager
+def traced(cat:str, name:Text, **args:Any) -> Iterator[dict[str,Any]]:
+    start = time.perf_counter()
+    try: yield args
+    except BaseException as error:
+        args.setdefault('status', type(error).__name__)
+        raise
+    finally: addspan(cat, name, start, time.perf_counter(), args)
+
+# a section lasts until the next one, or the end of the stage/run
+def tracesection(name:Maybe[Text]):
+    now = time.perf_counter()
+    if current := getattr(sections, 'current', None):
+        addspan('section', current[0], current[1], now, {})
+    sections.current = name and (name.strip(), now)
+
+def resettrace():
+    global TRACE_EPOCH
+    with spanlock:
+        spans.clear()
+        TRACE_EPOCH = time.perf_counter()
+
+# the cpu time and i/o of a finished child process: exact per process on
+# windows, elsewhere (cpu only) the difference of the children times
+def procusage(proc:Popen, before:os.times_result) -> dict[str,Any]:
+    if os.name == 'nt':
+        kernel32, handle = ctypes.windll.kernel32, int(proc._handle)
+        times = [ctypes.c_ulonglong() for _ in range(4)] # FILETIMEs, 100ns
+        io = (ctypes.c_ulonglong * 6)()                  # IO_COUNTERS
+        usage = {}
+        if kernel32.GetProcessTimes(handle, *map(ctypes.byref, times)):
+            usage['cpu'] = round((times[2].value + times[3].value) / 1e7, 3)
+        if kernel32.GetProcessIoCounters(handle, ctypes.byref(io)):
+            usage.update(read=io[3], written=io[4])
+        return usage
+
+    after = os.times()
+    return {'cpu': round(after.children_user + after.children_system -
+                         before.children_user - before.children_system, 3)}
+
+# like subprocess.run, traced with the usage of the process
+def runproc(cmd:Cmd, check:bool=False, capture_output:bool=False, **kwargs:Any) -> CompletedProcess:
+    if capture_output: kwargs.update(stdout=PIPE, stderr=PIPE)
+
+    with traced('process', basename(str(cmd[0])),
+                cmd=' '.join(map(str, cmd))[:1000]) as span:
+        before = os.times()
+        with Popen(cmd, **kwargs) as proc:
+            try: stdout, stderr = proc.communicate()
+            except BaseException: proc.kill(); raise
+            span.update(procusage(proc, before), status=proc.returncode)
+
+    result = CompletedProcess(cmd, proc.returncode, stdout, stderr)
+    if check: result.check_returncode()
+    return result
+
+# write the spans as a chrome trace
+def writetrace(filename:Path):
+    with spanlock:
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                   'tid': tid, 'args': {'name': name}}
+                  for tid, name in threadnames.items()] + spans
+        mkdirs(dirname(filename))
+        putcontents(filename, json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+    println(taskf('trace'), fmt(filename, ITALIC, WHITE))
+
+# totals per category, and the slowest stages/processes
+def tracesummary(slowest:int=8):
+    MiB = 2**20
+    totals:dict[str,dict[str,float]] = {}
+    for span in spans:
+        total = totals.setdefault(span['cat'], dict.fromkeys(
+            ['count', 'wall', 'cpu', 'read', 'written', 'downloaded', 'failed'], 0))
+        total['count'] += 1
+        total['wall']  += span['dur'] / 1e6
+        for key in ['cpu', 'read', 'written', 'downloaded']:
+            total[key] += span['args'].get(key) or 0
+        total['failed'] += span['args'].get('status') not in [None, 0, 200, 304]
+
+    println(taskf('trace'), fmt(f'{"":10} {"count":>6} {"wall s":>9} {"cpu s":>9} '
+                                f'{"read MiB":>9} {"wrote MiB":>9} {"fetch MiB":>9} {"failed":>6}', DIM))
+    for cat, total in totals.items():
+        println(taskf('trace'), ' '.join([fmt(f'{cat:10}', YELLOW),
+            f'{total["count"]:6}', fmt(f'{total["wall"]:9.1f}', CYAN), f'{total["cpu"]:9.1f}',
+            f'{total["read"] / MiB:9.1f}', f'{total["written"] / MiB:9.1f}',
+            f'{total["downloaded"] / MiB:9.1f}',
+            fmt(f'{total["failed"]:6}', RED if total['failed'] else DIM)]))
+
+    for span in sorted((span for span in spans if span['cat'] in ['stage', 'process']),
+                       key=lambda span: -span['dur'])[:slowest]:
+        println(taskf('slowest'), fmt(f'{span["dur"] / 1e6:9.1f} s', CYAN),
+                fmt(span['cat'], DIM), span['name'])
 
 #============================================================================
 # MISC
 
-# return first list item where pred(item) is true
-def find(pred:Callable[[T],bool], seq:list[T]) -> T:
-    for b in seq: print(pred(b), b)
-    return reduce(lambda a, b: b if pred(b) else a, seq)
+# return first list item where pred(item) is true (or None)
+def find(pred:Callable[[T],bool], seq:list[T]) -> Maybe[T]:
+    return next((item for item in seq if pred(item)), None)
 
 # chop last "/download" part  from soruce forge urls
 # (skip the countdown instersitital)
@@ -366,6 +804,95 @@ def command(cmd:Cmd, **kwargs:Any):
     subproc(cmd, **kwargs)
     println(fmt('>>>', DIM, YELLOW))
 
+#----------------------------------------------------------------------------
+# running a tool over lots of files
+#
+# Calls are fanned out over 'jobs' worker threads (each running a process).
+# Files are passed one per call, or batched: as many per call as fit on a
+# command line, or all at once in a response file (for tools reading @file
+# arguments, like the msvc ones). Failures are collected per file, instead
+# of stopping at the first one.
+
+# command line length limit (leaving room for the environment on posix)
+CMDLINE_MAX = (32000 if os.name == 'nt' else
+               min(os.sysconf('SC_ARG_MAX') // 2, 1024 * 1024))
+
+class ToolError(Exception): pass
+
+class ToolFailure(typing.NamedTuple):
+    files:      list[Path]
+    returncode: int
+    output:     Text
+
+# length of a command line, with quoting
+def cmdlen(cmd:Cmd) -> int:
+    return sum(len(arg) + 3 for arg in cmd)
+
+# split files into batches fitting on the command line of a tool
+def batches(tool:Callable[[list[Path]],Cmd], files:list[Path],
+            limit:int=CMDLINE_MAX) -> list[list[Path]]:
+    result:list[list[Path]] = [[]]
+    length = base = cmdlen(tool(files[0:1])) - cmdlen(files[0:1])
+    for file in files:
+        if result[-1] and length + cmdlen([file]) > limit:
+            result.append([])
+            length = base
+        result[-1].append(file)
+        length += cmdlen([file])
+    return result
+
+# run the command built by 'tool' for 'files' (passed in a response file
+# with batch='respfile'). a failed batch on the command line is retried
+# file by file, to find out which ones failed
+def toolcall(tool:Callable[[list[Path]],Cmd], files:list[Path],
+             batch:Maybe[str], cwd:Path=None) -> list[ToolFailure]:
+    logcall(tool(files), level=VERBOSE)
+    if batch != 'respfile':
+        result = runproc(tool(files), cwd=cwd, capture_output=True, text=True, errors='replace')
+    else:
+        fd, respfile = tempfile.mkstemp('.rsp', text=True)
+        try:
+            with open(fd, 'w') as handle:
+                handle.write(os.linesep.join(f'"{file}"' for file in files))
+            result = runproc(tool([f'@{respfile}']), cwd=cwd,
+                             capture_output=True, text=True, errors='replace')
+        finally: os.remove(respfile)
+
+    if result.returncode == 0: return []
+
+    if batch == 'cmdline' and len(files) > 1:
+        return [failure for file in files
+                        for failure in toolcall(tool, [file], batch, cwd)]
+
+    return [ToolFailure(files, result.returncode,
+                        chomp(nuls(result.stdout) + nuls(result.stderr)))]
+
+# run a tool over files in parallel, returns the failures.
+# batch: None (one file per call), 'cmdline' or 'respfile'
+def runtool(tool:Callable[[list[Path]],Cmd], files:Iterable[Path],
+            batch:Maybe[str]=None, jobs:int=None, cwd:Path=None) -> list[ToolFailure]:
+    if not (files := list(files)): return []
+
+    calls = ([[file] for file in files] if not batch else
+             batches(tool, files) if batch == 'cmdline' else [files])
+    jobs = min(jobs or JOBS, len(calls))
+
+    logcall(tool(calls[0][0:1]))
+    println(taskf('run'), chf(f'{len(files)} files in {len(calls)} calls,'
+                              f' {jobs} parallel'))
+
+    with ThreadPoolExecutor(jobs, thread_name_prefix='tool') as pool:
+        return [failure
+                for failures in pool.map(lambda files: toolcall(tool, files, batch, cwd), calls)
+                for failure in failures]
+
+# log the failures of a tool run, and stop if there were any
+def toolcheck(failures:list[ToolFailure], what:Text):
+    for failure in failures:
+        logerror(f'{", ".join(failure.files)}: {failure.output}', failure.returncode)
+    if failures:
+        raise ToolError(f'{what} failed for {sum(len(failure.files) for failure in failures)} file(s)')
+
 #============================================================================
 # I/O
 
@@ -375,7 +902,9 @@ def getcontents(path:Path) -> Text:
 
 def putcontents(path:Path, text:Text):
     """Writes a text buffer intoto a file"""
+    if linked(path): os.remove(path) # don't write through a hardlink
     with open(path, 'w') as handle: handle.write(text)
+    STAGED.update(path)
 
 # process file contents with a callback
 def modcontents(path:Path, mod:Callable[[Text], Text]=str):
@@ -399,17 +928,138 @@ def mkdirs(*paths:Path):
             println(taskf("mkdir"), path) # log the dir creation
         except: pass
 
+#----------------------------------------------------------------------------
+# copy engine
+#
+# Copies within the staging dir are hardlinked, anything else is cloned when
+# the file system can (reflink on linux, CopyFile on windows clones blocks on
+# ReFS / Dev Drives), or copied in-kernel / with large buffers. Destinations
+# which are identical already are left alone.
+#
+# Hardlinked files share their content, so tools modifying files in place
+# (editbin, mt) first need a private copy of them, see unshare()
+
+COPY_CHUNK = 8 * 1024 * 1024
+COPY_JOBS  = 8
+FICLONE    = 0x40049409 # linux ioctl
+
+# bytes per way of copying, of the current run
+copystats:dict[str,int] = dict.fromkeys(['copied', 'cloned', 'linked', 'identical'], 0)
+copylock = threading.Lock()
+
+def linked(filepath:Path) -> bool:
+    try: return os.stat(filepath).st_nlink > 1
+    except OSError: return False
+
+# only link within the staging dir (never to sources or the download cache)
+def linkable(src:Path, dst:Path) -> bool:
+    top = os.path.normpath(OUT_PATH)
+    return (TreeIndex.within(os.path.normpath(os.path.abspath(src)), top) and
+            TreeIndex.within(os.path.normpath(os.path.abspath(dst)), top))
+
+def identical(src:Path, dst:Path, info:os.stat_result) -> bool:
+    try: other = os.stat(dst)
+    except OSError: return False
+    if (other.st_dev, other.st_ino) == (info.st_dev, info.st_ino): return True
+    return other.st_size == info.st_size and filecmp.cmp(src, dst, shallow=False)
+
+# copy the content of a file, returns 'cloned' or 'copied'
+def copycontent(src:Path, dst:Path, size:int) -> str:
+    if os.name == 'nt':
+        if not ctypes.windll.kernel32.CopyFileW(src, dst, False): raise ctypes.WinError()
+        return 'copied'
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if sys.platform == 'linux':
+            import fcntl
+            try: fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno()); return 'cloned'
+            except OSError: pass
+            try:
+                offset = 0
+                while offset < size and (count := os.copy_file_range(
+                        fsrc.fileno(), fdst.fileno(), size - offset)):
+                    offset += count
+                if offset == size: return 'copied'
+            except OSError: pass
+            fsrc.seek(0); fdst.seek(0); fdst.truncate()
+        copyfileobj(fsrc, fdst, COPY_CHUNK)
+    return 'copied'
+
+# copy a single file: link, clone or copy it, returns how
+def copyfile2(src:Path, dst:Path) -> str:
+    info = os.stat(src)
+    if identical(src, dst, info): how = 'identical'
+    else:
+        if os.path.lexists(dst): os.remove(dst)
+        how = None
+        if linkable(src, dst):
+            try: os.link(src, dst); how = 'linked'
+            except OSError: pass # eg. not supported by the file system
+        if not how:
+            how = copycontent(src, dst, info.st_size)
+            if os.name != 'nt': copymode(src, dst) # keep exec bits
+    with copylock: copystats[how] += info.st_size
+    return how
+
+# copy a lot of files in parallel, returns the bytes per way of copying
+def copyfiles(pairs:list[tuple[Path,Path]], jobs:int=None) -> dict[str,int]:
+    with ThreadPoolExecutor(jobs or COPY_JOBS, thread_name_prefix='copy') as pool:
+        hows = list(pool.map(lambda pair: copyfile2(*pair), pairs))
+    sizes = dict.fromkeys(copystats, 0)
+    for (src, dst), how in zip(pairs, hows): sizes[how] += os.path.getsize(src)
+    return sizes
+
+# a private copy of a (hard)linked file, before changing it in place
+def unshare(filepath:Path) -> bool:
+    if not linked(filepath): return False
+    fd, private = tempfile.mkstemp(dir=dirname(filepath))
+    try:
+        with open(filepath, 'rb') as handle, open(fd, 'wb') as out:
+            copyfileobj(handle, out, COPY_CHUNK)
+        copymode(filepath, private)
+        os.replace(private, filepath)
+    except:
+        if os.path.exists(private): os.remove(private)
+        raise
+    return True
+
+def copyspan(span:dict[str,Any], sizes:dict[str,int]):
+    span.update(read=sizes['copied'], written=sizes['copied'] + sizes['cloned'],
+                saved=sizes['linked'] + sizes['cloned'] + sizes['identical'])
+
+def resetcopies():
+    with copylock: copystats.update(dict.fromkeys(copystats, 0))
+
+# log the bytes copied, and saved by linking, cloning or skipping
+def reportcopies():
+    MiB = 2**20
+    saved = copystats['linked'] + copystats['cloned'] + copystats['identical']
+    logsuccess(f'copied {copystats["copied"] / MiB:.1f} MiB, saved {saved / MiB:.1f} MiB ' +
+               f'({copystats["linked"] / MiB:.1f} linked, {copystats["cloned"] / MiB:.1f} cloned, ' +
+               f'{copystats["identical"] / MiB:.1f} identical)', 'COPY')
+
 # copy (and optionally rename a file)
 def copy(src:Path, dst:Path, name:Path=None):
     filepath = path(dst, name or basename (src))
     mkdirs(dst)
     println(taskf("copy"), opf(src, filepath))
-    copyfile(src, filepath)
+    with traced('copy', filepath) as span:
+        how = copyfile2(src, filepath)
+        size = os.path.getsize(filepath)
+        copyspan(span, {**dict.fromkeys(copystats, 0), how: size})
+    STAGED.update(filepath)
 
-# recursive copy tree
+# recursive copy tree (the files are copied in parallel)
 def copydir(src:Path, dst:Path):
     println(taskf("copy -r"), opf(src, dst))
-    copytree(src, dst)
+    with traced('copy', dst) as span:
+        pairs = []
+        for dirpath, dirnames, filenames in os.walk(src):
+            os.makedirs(outdir := path(dst, os.path.relpath(dirpath, src)), exist_ok=True)
+            pairs += [(path(dirpath, name), path(outdir, name)) for name in filenames]
+        copyspan(span, copyfiles(pairs))
+        span.update(files=len(pairs))
+    STAGED.update(dst)
 
 # recursively remove directory tree (rm -rf)
 # We use cmd.exe instead of sh.rmtree because it's more forgiving of open handles than
@@ -417,6 +1067,7 @@ def copydir(src:Path, dst:Path):
 # Windows Explorer while testing.
 def rmdir(path:Path):
     call(['cmd.exe', '/C', 'rmdir', '/S', '/Q', os.path.normpath(path)])
+    STAGED.drop(path)
 
 # wrap os.walk to call a calback on each file
 def withfilesin(top:Path, do:Callable[[Path], None]=lambda:None):
@@ -427,174 +1078,1529 @@ def withfilesin(top:Path, do:Callable[[Path], None]=lambda:None):
 def filenotempty(path:Path) -> bool:
     return os.path.isfile(path) and os.path.getsize(path)
 
-#============================================================================
-# arhcive unpacking
+#----------------------------------------------------------------------------
+# index of the staged files
+#
+# The staging tree is crawled once (with os.scandir, so the stat data comes
+# with the directory listing on windows), and looked up by extension and
+# name by all the stages searching for files in it. Stages adding, changing
+# or removing files update the index, instead of crawling the tree again.
+
+class FileEntry(typing.NamedTuple):
+    path:  Path
+    name:  str # lowercased basename
+    ext:   str # lowercased extension, w/o the dot
+    size:  int
+    mtime: int # ns
+
+class TreeIndex:
+    def __init__(self, top:Path):
+        self.top = os.path.normpath(top)
+        self.lock = threading.RLock()
+        self.entries:Maybe[dict[Path,FileEntry]] = None
+        self.byext:dict[str,dict[Path,FileEntry]] = {}
+        self.byname:dict[str,dict[Path,FileEntry]] = {}
+
+    # is 'filepath' (a normalized path) in or below 'top'
+    @staticmethod
+    def within(filepath:Path, top:Path) -> bool:
+        return filepath == top or filepath.startswith(top.rstrip(os.sep) + os.sep)
+
+    # build the index on first use
+    def built(self) -> dict[Path,FileEntry]:
+        with self.lock:
+            if self.entries is None:
+                self.entries = {}
+                self.crawl(self.top)
+            return self.entries
+
+    def insert(self, filepath:Path, info:os.stat_result):
+        name = basename(filepath).lower()
+        entry = FileEntry(filepath, name, ext(name), info.st_size, info.st_mtime_ns)
+        self.entries[filepath] = entry
+        self.byext.setdefault(entry.ext, {})[filepath] = entry
+        self.byname.setdefault(entry.name, {})[filepath] = entry
+
+    def remove(self, top:Path):
+        for filepath in ([top] if top in self.entries else
+                         [filepath for filepath in self.entries
+                          if self.within(filepath, top)]):
+            entry = self.entries.pop(filepath)
+            del self.byext[entry.ext][filepath]
+            del self.byname[entry.name][filepath]
+
+    def crawl(self, top:Path):
+        dirs = [top]
+        while dirs:
+            try: listing = os.scandir(dirs.pop())
+            except (FileNotFoundError, NotADirectoryError): continue
+            with listing:
+                for item in listing:
+                    if item.is_dir(follow_symlinks=False): dirs.append(item.path)
+                    else:
+                        # (removed since listed, by a stage writing the tree)
+                        try: self.insert(item.path, item.stat(follow_symlinks=False))
+                        except FileNotFoundError: continue
+
+    # (re)index a file or a whole subtree, after it was changed
+    def update(self, filepath:Path):
+        filepath = os.path.normpath(filepath)
+        with self.lock:
+            if self.entries is None or not self.within(filepath, self.top): return
+            self.remove(filepath)
+            if os.path.isdir(filepath): self.crawl(filepath)
+            elif os.path.lexists(filepath): self.insert(filepath, os.lstat(filepath))
+
+    # forget a removed file or subtree
+    def drop(self, filepath:Path):
+        with self.lock:
+            if self.entries is not None: self.remove(os.path.normpath(filepath))
+
+    # files in/below 'under', optionally only with the given ext or name
+    def files(self, under:Path=None, ext:str=None, name:str=None) -> list[FileEntry]:
+        under = os.path.normpath(under or self.top)
+        with self.lock:
+            entries = self.built()
+            entries = (self.byext.get(ext.lower(), {}) if ext is not None else
+                       self.byname.get(name.lower(), {}) if name is not None else
+                       entries)
+            return sorted((entry for entry in entries.values()
+                           if self.within(entry.path, under)),
+                          key=lambda entry: entry.path)
+
+    # total size of the files in/below 'under'
+    def size(self, under:Path=None) -> int:
+        return sum(entry.size for entry in self.files(under))
+
+# the staged files (in MOZ_PATH, set by configure)
+STAGED:TreeIndex
 
-# register 7z as an unpacker
-def un7pak(archive:Path, dst:Path=BIN_PATH):
+#============================================================================
+# arhcive unpacking: zip-s and tarballs are extracted in-process (the members
+# of a zip in parallel, a tarball streamed, decompressed on a reader thread),
+# 7z-s and self extracting exe-s with 7-Zip. 'patterns' are glob patterns of
+# the member names to extract (default: all of them), 'strip' drops leading
+# path components of the names (like tar --strip-components)
+
+EXTRACT_CHUNK = 4 * 1024 * 1024 # read/write buffer
+
+class UnpackError(Exception): pass
+
+# only plain files and dirs (when the python running this knows about filters)
+def tarfilter() -> dict[str,Any]:
+    return {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+
+# the (stripped) name of a member to extract, or None to skip it
+def membername(name:Text, patterns:Maybe[list[str]], strip:int) -> Maybe[Text]:
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.')]
+    if '..' in parts or parts and ':' in parts[0]: raise UnpackError(f'unsafe member name: {name}')
+    if patterns and not any(fnmatch.fnmatchcase('/'.join(parts), pattern) for pattern in patterns): return None
+    return '/'.join(parts[strip:]) or None
+
+# the members are spread over 'jobs' workers, each with its own handle on
+# the zip (largest first, so they end about the same time), returns the
+# number of files and bytes written
+def extractzip(archive:Path, dst:Path, patterns:list[str]=None, strip:int=0,
+               jobs:int=None) -> tuple[int,int]:
+    with zipfile.ZipFile(archive) as zip:
+        todo = [(info, path(dst, *name.split('/'))) for info in zip.infolist()
+                if (name := membername(info.filename, patterns, strip))]
+
+    mkdirs(*sorted({out if info.is_dir() else dirname(out) for info, out in todo}))
+    files = sorted(((info, out) for info, out in todo if not info.is_dir()),
+                   key=lambda item: -item[0].file_size)
+    jobs = max(1, min(jobs or JOBS, len(files)))
+
+    def worker(batch:list[tuple[zipfile.ZipInfo,Path]]) -> int:
+        with zipfile.ZipFile(archive) as zip:
+            for info, out in batch:
+                with zip.open(info) as src, open(out, 'wb') as file: copyfileobj(src, file, EXTRACT_CHUNK)
+                # keep the exec bits of zips made on unix
+                if (mode := info.external_attr >> 16) & 0o111: os.chmod(out, mode & 0o777)
+        return sum(info.file_size for info, _ in batch)
+
+    with ThreadPoolExecutor(jobs, thread_name_prefix='unzip') as pool:
+        return len(files), sum(pool.map(worker, [files[index::jobs] for index in range(jobs)]))
+
+# a file, reading ahead (and decompressing) on a thread
+class ReadAhead:
+    def __init__(self, stream:typing.BinaryIO, chunk:int=EXTRACT_CHUNK, window:int=4):
+        self.blocks:queue.Queue = queue.Queue(window)
+        self.buffer, self.offset, self.eof, self.done = b'', 0, False, False
+        self.thread = threading.Thread(target=self.fill, args=(stream, chunk),
+                                       name='readahead', daemon=True)
+        self.thread.start()
+
+    def fill(self, stream:typing.BinaryIO, chunk:int):
+        try:
+            while not self.done and (block := stream.read(chunk)): self.blocks.put(block)
+            self.blocks.put(b'')
+        except BaseException as error: self.blocks.put(error)
+
+    # at most 'size' bytes, as tarfile's streams read until they have enough
+    def read(self, size:int=-1) -> bytes:
+        if self.offset >= len(self.buffer):
+            if self.eof: return b''
+            if isinstance(block := self.blocks.get(), BaseException): raise block
+            if not block: self.eof = True
+            self.buffer, self.offset = block, 0
+        data = self.buffer[self.offset:None if size < 0 else self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        self.done = True
+        while self.thread.is_alive():
+            try: self.blocks.get(timeout=0.1)
+            except queue.Empty: pass
+
+# the decompressed contents of a tarball
+def decompressed(archive:Path) -> typing.BinaryIO:
+    with open(archive, 'rb') as file: magic = file.read(6)
+    if magic.startswith(b'\x1f\x8b'): return gzip.open(archive)
+    if magic.startswith(b'BZh'): return bz2.open(archive)
+    # xz, or the older lzma (alone) format
+    if magic.startswith(b'\xfd7zXZ') or magic.startswith(b'\x5d\x00\x00'): return lzma.open(archive)
+    return open(archive, 'rb')
+
+# stream the members of a tarball to disk, returns the number of files and
+# bytes written (hard links to members which are skipped can't be extracted)
+def extracttar(archive:Path, dst:Path, patterns:list[str]=None, strip:int=0) -> tuple[int,int]:
+    files = written = 0
+    extracted:set[Text] = set()
+    with decompressed(archive) as stream:
+        reader = ReadAhead(stream)
+        try:
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                tar.copybufsize = EXTRACT_CHUNK
+                for member in tar:
+                    if not (name := membername(member.name, patterns, strip)): continue
+                    if member.islnk():
+                        if (linkname := membername(member.linkname, None, strip)) not in extracted:
+                            raise UnpackError(f'{member.name} links to {member.linkname}, which is not extracted')
+                        member.linkname = linkname
+                    member.name = name
+                    extracted.add(name)
+                    tar.extract(member, dst, **tarfilter())
+                    if member.isreg(): files, written = files + 1, written + member.size
+        finally:
+            reader.close()
+    return files, written
+
+# 7-Zip reports nothing
+def un7pak(archive:Path, dst:Path, patterns:list[str]=None, strip:int=0) -> None:
+    if strip: raise UnpackError(f'can\'t strip the member names with 7-Zip: {archive}')
     # skip installer metadata in uppacking exes
     skip = ['-x!$*'] if ext(archive) == 'exe' else []
-    command([UN7IP, 'x', archive, f'-o{dst}'] + skip)
-
-register_unpack_format('7zip', ['7z', 'exe'], un7pak)
+    command([UN7IP, 'x', archive, f'-o{dst}'] + skip + [f'-i!{pattern}' for pattern in patterns or []])
+
+# format: extensions, extractor
+UNPACKERS:dict[str,tuple[list[str],Callable[...,Maybe[tuple[int,int]]]]] = {
+    'zip':  (['.zip'], extractzip),
+    'tar':  (['.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz', '.tar.lzma'], extracttar),
+    '7zip': (['.7z', '.exe'], un7pak),
+}
+
+# the extractor of an archive, by format (shutil's 'gztar', 'xztar', ...
+# are tarballs too), or extension
+def unpacker(archive:Path, fmt:str=None) -> Callable[...,Maybe[tuple[int,int]]]:
+    if fmt: return UNPACKERS['tar' if fmt.endswith('tar') else fmt][1]
+    name = basename(archive).lower()
+    for exts, extract in UNPACKERS.values():
+        if name.endswith(tuple(exts)): return extract
+    raise UnpackError(f'unknown archive format: {archive}')
 
 # unpack an archive, return path to extracted folder
-def unpack(archive:Path, dst:Path=BIN_PATH, fmt:str=None) -> Path:
-    mkdirs(dirname(dst))
-    println(taskf("unpack"), opf(archive, dst))
-    unpack_archive(archive, dst, fmt)
+def unpack(archive:Path, dst:Path=None, fmt:str=None, patterns:list[str]=None, strip:int=0) -> Path:
+    dst = dst or BIN_PATH
+    extract = unpacker(archive, fmt)
+    mkdirs(dst)
+    println(taskf("unpack"), opf(archive, dst), chf(nuls(patterns and ', '.join(patterns), fmt='({})')))
+    with traced('unpack', archive, read=os.path.getsize(archive)) as span:
+        staged = STAGED.within(dst, STAGED.top)
+        before = STAGED.size(dst) if staged and extract is un7pak else 0
+        if counts := extract(archive, dst, patterns, strip):
+            span.update(files=counts[0], written=counts[1])
+            println(taskf('unpacked'), chf(f'({counts[0]} files, {counts[1] / 2**20:.1f} MiB)'))
+        STAGED.update(dst)
+        if staged and not counts: span.update(written=STAGED.size(dst) - before)
     return path(dst, rootname(basename(archive)))
 
 #----------------------------------------------------------------------------
 # downloading stuff
 
-# download and cache url using ETag-s, returns the out path
-def etag(url:Url, out:Path) -> Path:
-    etag = f'{path(ETAG_PATH, basename(out or url))}.etag'
-    command([REF_CURL,
-             '--etag-compare', etag, '--etag-save', etag,
-             '--compressed', '-sNLS#', url, '-o', out])
+# per-thread pool of kept-alive connections, keyed by (scheme, host)
+connections = threading.local()
+
+class DownloadError(HTTPException): pass
+class TransientError(DownloadError): pass # worth retrying
+class IntegrityError(DownloadError): pass # not the expected content
+class NotFoundError(DownloadError): pass  # not on the server (404 / 410)
+
+# get a (reusable) connection to the host of an url
+def connection(url:Url) -> HTTPConnection:
+    pool = connections.__dict__.setdefault('pool', {})
+    parts = urlsplit(url)
+    if (key := (parts.scheme, parts.netloc)) not in pool:
+        conn = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+        pool[key] = conn(parts.netloc, timeout=getattr(connections, 'timeout', HTTP_TIMEOUT))
+    return pool[key]
+
+# send a request, following redirects; the response body must be read fully
+# (or the response closed) before the thread's connection can be reused
+def request(url:Url, headers:dict[str,str]={}, method:str='GET') -> HTTPResponse:
+    for hop in range(HTTP_REDIRECTS):
+        parts = urlsplit(url)
+        target = (parts.path or '/') + nuls(parts.query, fmt='?{}')
+        conn = connection(url)
+
+        # a kept-alive connection may have been dropped by the server
+        # since its last use: reconnect (once) in that case
+        for attempt in range(2):
+            try:
+                conn.request(method, target, headers={
+                    'User-Agent': HTTP_AGENT, 'Accept-Encoding': 'identity',
+                    **headers})
+                response = conn.getresponse()
+                break
+            except (ConnectionError, HTTPException):
+                conn.close()
+                if attempt: raise
+
+        if response.status not in (301, 302, 303, 307, 308):
+            response.url = url
+            return response
+
+        response.read()
+        url = urljoin(url, response.getheader('Location'))
+
+        # credentials are only sent to the host they are for
+        if urlsplit(url).netloc != parts.netloc:
+            headers = {name: value for name, value in headers.items() if name != 'Authorization'}
+
+    raise DownloadError(f'too many redirects: {url}')
+
+#----------------------------------------------------------------------------
+# content addressed download cache
+#
+# Payloads are stored once in CACHE_PATH, named by their sha256 digest. The
+# index maps urls to digests along with the ETag/Last-Modified validators of
+# the response, and keeps the size and last use of each blob for evicting
+# the least recently used ones when the cache grows over CACHE_SIZE.
+
+cachelock = threading.RLock()
+cache:Json = None
+
+# path of a blob in the store
+def blobpath(digest:str) -> Path:
+    return path(CACHE_PATH, digest[0:2], digest)
+
+# sha256 hex digest of a file
+def sha256sum(filepath:Path) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as handle:
+        while chunk := handle.read(HTTP_CHUNK): digest.update(chunk)
+    return digest.hexdigest()
+
+# the (lazily loaded) cache index
+def cacheindex() -> Json:
+    global cache
+    with cachelock:
+        if cache is None:
+            try:
+                with open(CACHE_INDEX, 'r') as handle: cache = json.load(handle)
+            except (OSError, ValueError): cache = {'urls': {}, 'blobs': {}}
+        return cache
+
+def savecache():
+    with cachelock:
+        mkdirs(CACHE_PATH)
+        putcontents(f'{CACHE_INDEX}.tmp', json.dumps(cacheindex(), indent=1))
+        os.replace(f'{CACHE_INDEX}.tmp', CACHE_INDEX)
+
+# mark a blob as just used
+def cachetouch(digest:str):
+    with cachelock:
+        cacheindex()['blobs'].setdefault(digest, {}).update(
+            size=os.path.getsize(blobpath(digest)), used=time.time())
+
+# drop a blob, and the urls pointing to it
+def cacheforget(digest:str):
+    with cachelock:
+        index = cacheindex()
+        index['blobs'].pop(digest, None)
+        for url in [url for url, entry in index['urls'].items()
+                    if entry['digest'] == digest]:
+            del index['urls'][url]
+        try: os.remove(blobpath(digest))
+        except FileNotFoundError: pass
+
+# evict least recently used blobs, until the store fits in CACHE_SIZE
+def cacheevict(keep:str=None):
+    with cachelock:
+        blobs = cacheindex()['blobs']
+        total = sum(blob['size'] for blob in blobs.values())
+        for digest in sorted(blobs, key=lambda digest: blobs[digest]['used']):
+            if total <= CACHE_SIZE * 1024 * 1024: break
+            if digest == keep: continue
+            total -= blobs[digest]['size']
+            println(taskf('evict', YELLOW), digest, chf(f'({blobs[digest]["size"]} bytes)'))
+            cacheforget(digest)
+
+# look up the cached entry of an url. the blob is verified on each read,
+# a missing or corrupted blob is dropped from the cache
+def cachelookup(url:Url) -> Maybe[Json]:
+    with cachelock:
+        if not (entry := cacheindex()['urls'].get(url)): return None
+        entry = dict(entry)
+
+    blob = blobpath(entry['digest'])
+    if os.path.isfile(blob) and sha256sum(blob) == entry['digest']:
+        return entry
+
+    logerror(f'dropping invalid cache entry for {urlf(url)}', 'CACHE')
+    with cachelock:
+        cacheforget(entry['digest'])
+        savecache()
+    return None
+
+# add a downloaded file to the store (an identical blob may exist already,
+# fetched from another url), and point the url at it. returns the blob path
+def cachestore(url:Url, filepath:Path, digest:str, response:Maybe[HTTPResponse]) -> Path:
+    blob = blobpath(digest)
+    with cachelock:
+        mkdirs(dirname(blob))
+        if os.path.isfile(blob): os.remove(filepath)
+        else: os.replace(filepath, blob)
+
+        cacheindex()['urls'][url] = {
+            'digest':   digest,
+            'etag':     response and response.getheader('ETag'),
+            'modified': response and response.getheader('Last-Modified'),
+            'checked':  time.time(),
+        }
+        cachetouch(digest)
+        cacheevict(keep=digest)
+        savecache()
+    return blob
+
+#----------------------------------------------------------------------------
+
+# download an url into the cache, revalidating an already cached copy
+# with the stored ETag/Last-Modified (unless it was checked in the last
+# 'ttl' seconds), returns the path to the cached blob. with 'sha256', the
+# download is verified (and a blob with that digest is used as is)
+def fetch(url:Url, ttl:int=0, headers:dict[str,str]={}, sha256:str=None,
+          retries:int=None) -> Path:
+    with traced('download', url) as span, urllock(url):
+        blob = fetchblob(url, span, ttl, headers, sha256,
+                         HTTP_RETRIES if retries is None else retries)
+    return blob
+
+# one download of an url at a time (they share the partial file)
+def urllock(url:Url) -> threading.Lock:
+    with cachelock: return urllocks.setdefault(url, threading.Lock())
+
+urllocks:dict[Url,threading.Lock] = {}
+
+# note that an url was just checked against the server
+def cachechecked(url:Url):
+    with cachelock:
+        if entry := cacheindex()['urls'].get(url): entry['checked'] = time.time()
+
+def fetchblob(url:Url, span:dict[str,Any], ttl:int=0, headers:dict[str,str]={},
+              sha256:str=None, retries:int=HTTP_RETRIES) -> Path:
+    if sha256 and (blob := pinnedblob(sha256)):
+        println(taskf('cached'), urlf(url), chf('(verified)'))
+        return blob
+
+    # local files (eg. from pip's index configured as a directory) are copied in
+    if urlsplit(url).scheme == 'file': return storefile(url, sha256)
+
+    entry = cachelookup(url) if FETCH_TOOLS != 'without-cache' else None
+
+    if entry and ttl and time.time() - entry.get('checked', 0) < ttl:
+        cachetouch(entry['digest'])
+        println(taskf('cached'), urlf(url), chf('(fresh)'))
+        return blobpath(entry['digest'])
+
+    headers = {**headers, **{header: entry[key] for header, key in [
+        ('If-None-Match', 'etag'), ('If-Modified-Since', 'modified')]
+        if entry and entry.get(key)}}
+
+    # transient failures are retried with backoff, resuming the transfer
+    state:dict[str,Any] = {}
+    for attempt in range(retries + 1):
+        try: return transfer(url, span, headers, entry, sha256, state)
+        except DownloadError as error:
+            # a corrupted transfer is downloaded once more, a wrong file is not
+            retry = isinstance(error, TransientError) or isinstance(error, IntegrityError) and not attempt
+            if not retry or attempt == retries: raise
+            failure = error
+        except (OSError, HTTPException) as error:
+            connection(url).close() # don't reuse it half-read
+            if attempt == retries: raise
+            failure = error
+        delay = HTTP_BACKOFF * 2 ** attempt
+        logerror(f'{urlf(url)}: {str(failure) or type(failure).__name__}, retrying in {delay:.0f}s', 'RETRY')
+        span['retries'] = attempt + 1
+        time.sleep(delay)
+
+# is a stored blob intact: rehashed against its name, unless it passed that
+# before and its size and mtime are the same since (the 'verified' marker
+# in the index). a corrupted blob is dropped (and downloaded again)
+def blobintact(digest:str) -> bool:
+    try: info = os.stat(blob := blobpath(digest))
+    except FileNotFoundError: return False
+    marker = [info.st_size, info.st_mtime_ns]
+    with cachelock:
+        if cacheindex()['blobs'].get(digest, {}).get('verified') == marker: return True
+
+    if sha256sum(blob) == digest:
+        with cachelock:
+            cacheindex()['blobs'].setdefault(digest, {})['verified'] = marker
+            savecache()
+        return True
+
+    logerror(f'dropping invalid cached blob {digest}', 'CACHE')
+    with cachelock:
+        cacheforget(digest)
+        savecache()
+    return False
+
+# the stored blob of a pinned digest, if it's intact
+def pinnedblob(sha256:str) -> Maybe[Path]:
+    if not blobintact(sha256 := sha256.lower()): return None
+    cachetouch(sha256)
+    return blobpath(sha256)
+
+def storefile(url:Url, sha256:str=None) -> Path:
+    mkdirs(dirname(partial := partialpath(url)))
+    copyfile(url2pathname(urlsplit(url).path), partial)
+    if sha256 and (digest := sha256sum(partial)) != sha256.lower():
+        os.remove(partial)
+        raise IntegrityError(f'sha256 {digest} does not match the expected {sha256}: {url}')
+    blob = cachestore(url, partial, sha256 or sha256sum(partial), None)
+    println(taskf('copied'), urlf(url), chf(f'({os.path.getsize(blob)} bytes)'))
+    return blob
+
+# a partially downloaded url: its data, and the validator it was sent with
+def partialpath(url:Url) -> Path:
+    return path(CACHE_PATH, 'partial', hashlib.sha256(url.encode()).hexdigest()[:32])
+
+# the state of a partial download, left by an earlier run: the size and
+# digest of the data so far (read once, to go on hashing from there)
+def resumestate(url:Url) -> dict[str,Any]:
+    partial, digest = partialpath(url), hashlib.sha256()
+    try:
+        with open(f'{partial}.json', 'r') as handle: validator = json.load(handle)['validator']
+        with open(partial, 'rb') as handle:
+            while chunk := handle.read(HTTP_CHUNK): digest.update(chunk)
+            return {'size': handle.tell(), 'digest': digest, 'validator': validator}
+    except (OSError, ValueError, KeyError):
+        return {'size': 0, 'digest': digest, 'validator': None}
+
+def dropstate(url:Url, state:dict[str,Any]):
+    for filepath in [partialpath(url), f'{partialpath(url)}.json']:
+        if os.path.isfile(filepath): os.remove(filepath)
+    state.update(size=0, digest=hashlib.sha256(), validator=None)
+
+# one attempt at downloading an url into the store, hashing while streaming.
+# a partial download is resumed with a Range request, if the server still
+# has the same version of it (If-Range). 'state' is kept between attempts
+def transfer(url:Url, span:dict[str,Any], headers:dict[str,str], entry:Maybe[Json],
+             sha256:Maybe[str], state:dict[str,Any]) -> Path:
+    partial = partialpath(url)
+    if not state: state.update(resumestate(url))
+    if state['size'] and state['validator']:
+        headers = {**headers, 'Range': f'bytes={state["size"]}-', 'If-Range': state['validator']}
+
+    with request(url, headers) as response:
+        span.update(status=response.status)
+        if response.status == 304 and entry:
+            response.read()
+            dropstate(url, state)
+            with cachelock:
+                cachechecked(url)
+                cachetouch(entry['digest'])
+                savecache()
+            println(taskf('cached'), urlf(url))
+            return blobpath(entry['digest'])
+
+        if response.status not in (200, 206) or response.status == 206 and not state['size']:
+            response.read() # drain, so the connection stays usable
+            if response.status == 416: dropstate(url, state)
+            if response.getheader('X-RateLimit-Remaining') == '0': raise DownloadError(
+                f'API rate limit exceeded (set GITHUB_TOKEN for a higher one): {url}')
+            error = (TransientError if response.status in HTTP_TRANSIENT else
+                     NotFoundError if response.status in (404, 410) else DownloadError)
+            raise error(f'{response.status} {response.reason}: {url}')
+
+        # the whole file (again), or the rest of it
+        if response.status == 200: dropstate(url, state)
+        else: println(taskf('resume'), urlf(url), chf(f'(from {state["size"]} bytes)'))
+
+        # weak etags can't be used to resume
+        etag = response.getheader('ETag')
+        state['validator'] = (etag if etag and not etag.startswith('W/') else
+                              response.getheader('Last-Modified'))
+        mkdirs(dirname(partial))
+        putcontents(f'{partial}.json', json.dumps({'url': url, 'validator': state['validator']}))
+
+        with open(partial, 'ab') as handle:
+            while chunk := response.read(HTTP_CHUNK):
+                handle.write(chunk)
+                state['digest'].update(chunk)
+                state['size'] += len(chunk)
+                span['downloaded'] = span.get('downloaded', 0) + len(chunk)
+
+        # reading in chunks does not fail when the connection drops early
+        if response.length: raise IncompleteRead(b'', response.length)
+
+        digest = state['digest'].hexdigest()
+        if sha256 and digest != sha256.lower():
+            dropstate(url, state)
+            raise IntegrityError(f'sha256 {digest} does not match the expected {sha256}: {url}')
+
+        os.remove(f'{partial}.json')
+        blob = cachestore(url, partial, digest, response)
+        state.clear()
+
+    println(taskf('fetched'), urlf(url), chf(f'({os.path.getsize(blob)} bytes)'))
+    return blob
+
+# place a cached blob at 'out' (hardlinked, when possible)
+def materialize(blob:Path, out:Path) -> Path:
+    mkdirs(dirname(out))
+    if os.path.exists(out): os.remove(out)
+    try: os.link(blob, out)
+    except OSError: copyfile(blob, out)
     return out
 
 # download an url, return tmp path
-def curl(url:Url, name:Path=None) -> Path:
-    return etag(url, path(CURL_PATH, basename(name or url)))
+def curl(url:Url, name:Path=None, sha256:str=None) -> Path:
+    return materialize(fetch(url, sha256=sha256), path(CURL_PATH, basename(name or url)))
 
 # download a file, and save it as 'dst'
-def download(url:Url, dst:Path) -> Path:
-    return etag(url, dst)
+def download(url:Url, dst:Path, sha256:str=None) -> Path:
+    return materialize(fetch(url, sha256=sha256), dst)
+
+#----------------------------------------------------------------------------
+# fetching everything up front
+
+# start all the downloads a run needs at once on a bounded pool,
+# jobs are named callables returning the downloaded path (or None)
+def prefetch(jobs:dict[str,Callable[[],Maybe[Path]]]) -> dict[str,Future]:
+    pool = ThreadPoolExecutor(FETCH_JOBS, thread_name_prefix='fetch')
+    futures = {name: pool.submit(job) for name, job in jobs.items()}
+    pool.shutdown(wait=False)
+    return futures
+
+# wait for a prefetched download and hand out its path. falls back to
+# 'default' if the job is unknown or failed, or re-raises w/o a default
+def fetched(name:str, default:Path=None) -> Path:
+    if not (future := FETCHED.get(name)): return default
+    try: return future.result() or default
+    except Exception as error:
+        if default is None: raise
+        logerror(f'fetching {name} failed: {error}', 'FETCH')
+        return default
+
+FETCHED:dict[str,Future] = {}
 
-# get content from url
-def geturl(url:Url, type:Path=None) -> Text:
-    return getcontents(curl(url, basename(os.extsep.join([
-        rootname(url), hashlib.md5(url.encode()).hexdigest(),
-        type or ext(url)]))))
+#----------------------------------------------------------------------------
+# A minimal YAML reader, for the winget manifests: block mappings and
+# sequences, plain/quoted/flow scalars, literal and folded block scalars,
+# and comments. Anchors, tags and multi-document streams are not supported.
+# Scalars are strings (so versions stay as written), except true/false/null
+
+class YamlError(ValueError): pass
+
+YAML_CONSTANTS = {'true': True, 'false': False, 'null': None, '~': None}
+
+# index of the first 'chars' outside quotes in 'text', or -1
+def unquoted(text:Text, pred:Callable[[Text,int],bool]) -> int:
+    quote = None
+    for index, char in enumerate(text):
+        if quote:
+            if char == quote: quote = None
+        elif char in '\'"': quote = char
+        elif pred(text, index): return index
+    return -1
+
+def uncomment(text:Text) -> Text:
+    index = unquoted(text, lambda text, i: text[i] == '#' and (i == 0 or text[i - 1] in ' \t'))
+    return (text if index < 0 else text[:index]).rstrip()
+
+# split 'key: value', or None if it's not a mapping entry
+def ymlentry(text:Text) -> Maybe[tuple[Text,Text]]:
+    index = unquoted(text, lambda text, i: text[i] == ':' and text[i + 1:i + 2] in ('', ' '))
+    if index < 0: return None
+    return ymlscalar(text[:index]), text[index + 1:].strip()
+
+def ymlscalar(text:Text) -> Any:
+    text = text.strip()
+    if len(text) > 1 and text[0] == text[-1] == "'": return text[1:-1].replace("''", "'")
+    if len(text) > 1 and text[0] == text[-1] == '"':
+        try: return json.loads(text)
+        except ValueError: return text[1:-1]
+    if text.startswith('[') and text.endswith(']'):
+        items, inner = [], text[1:-1]
+        while inner.strip():
+            index = unquoted(inner, lambda text, i: text[i] == ',')
+            items.append(ymlscalar(inner if index < 0 else inner[:index]))
+            inner = '' if index < 0 else inner[index + 1:]
+        return items
+    if text == '{}': return {}
+    return YAML_CONSTANTS.get(text.lower(), text) if text else None
+
+def isitem(text:Text) -> bool:
+    return text == '-' or text.startswith('- ')
+
+class YamlParser:
+    def __init__(self, text:Text):
+        self.raw = text.replace('\t', ' ').splitlines()
+        # (indent, content, raw line index) of the significant lines
+        self.lines = [(len(line) - len(line.lstrip()), content, index)
+                      for index, line in enumerate(self.raw)
+                      if (content := uncomment(line).strip()) and content not in ('---', '...')]
+        self.pos = 0
+
+    def peek(self) -> Maybe[tuple[int,Text,int]]:
+        return self.lines[self.pos] if self.pos < len(self.lines) else None
+
+    def parse(self) -> Any:
+        value = self.block(0)
+        if self.peek(): raise YamlError(f'unexpected line {self.peek()[2] + 1}: {self.peek()[1]}')
+        return value
+
+    def block(self, indent:int) -> Any:
+        if not (line := self.peek()) or line[0] < indent: return None
+        return self.sequence(line[0]) if isitem(line[1]) else self.mapping(line[0])
+
+    def sequence(self, indent:int) -> list[Any]:
+        items = []
+        while (line := self.peek()) and line[0] == indent and isitem(line[1]):
+            rest = line[1][1:].lstrip()
+            if rest and ymlentry(rest) is not None:
+                # '- key: value' starts a mapping at the column of the key
+                self.lines[self.pos] = (indent + len(line[1]) - len(rest), rest, line[2])
+                items.append(self.mapping(self.lines[self.pos][0]))
+            else:
+                self.pos += 1
+                items.append(self.value(rest, indent, line[2]))
+        return items
+
+    def mapping(self, indent:int) -> dict[Any,Any]:
+        result = {}
+        while (line := self.peek()) and line[0] == indent and not isitem(line[1]):
+            if not (entry := ymlentry(line[1])):
+                raise YamlError(f'expected a mapping at line {line[2] + 1}: {line[1]}')
+            self.pos += 1
+            result[entry[0]] = self.value(entry[1], indent, line[2], True)
+        return result
+
+    # the value after a 'key:' or '-', inline or in the block below it
+    # (a sequence may be at the indent of its key)
+    def value(self, rest:Text, indent:int, row:int, keyed:bool=False) -> Any:
+        if rest[:1] in ('|', '>'): return self.scalar(rest, indent, row)
+        if rest: return ymlscalar(rest)
+        if (line := self.peek()) and (line[0] > indent or keyed and line[0] == indent and isitem(line[1])):
+            return self.block(line[0])
+        return None
+
+    # a literal (|) or folded (>) block scalar, with its chomping indicator
+    def scalar(self, style:Text, indent:int, row:int) -> Text:
+        end = row + 1
+        while end < len(self.raw) and (not self.raw[end].strip() or
+                                       len(self.raw[end]) - len(self.raw[end].lstrip()) > indent):
+            end += 1
+        while self.pos < len(self.lines) and self.lines[self.pos][2] < end: self.pos += 1
+
+        body = self.raw[row + 1:end]
+        margin = min((len(line) - len(line.lstrip()) for line in body if line.strip()), default=0)
+        lines = [line[margin:] for line in body]
+        while lines and not lines[-1].strip(): lines.pop()
+
+        text = '\n'.join(lines) if style[0] == '|' else re.sub(r'(?<!\n)\n(?!\n)', ' ', '\n'.join(lines))
+        if '-' in style: return text
+        return text + ('\n' * (len(body) - len(lines) + 1) if '+' in style else '\n') if text else ''
+
+def parseyml(text:Text) -> Json:
+    return YamlParser(text).parse()
+
+#----------------------------------------------------------------------------
+# tool metadata
+#
+# The latest tool releases are resolved with the GitHub API (releases), and
+# from the winget-pkgs manifests (parsed in-process), on the fetch workers,
+# so the metadata of all the tools is requested at once. API responses are
+# reused for API_TTL seconds, then revalidated with a conditional request
+# (a 304 does not count against the GitHub rate limit). Set GITHUB_TOKEN in
+# the environment for the higher limit of authenticated requests.
+
+class ResolveError(Exception): pass
+
+class Resolved(typing.NamedTuple):
+    name:    Text
+    version: Text
+    url:     Url
+    file:    Text # name of the downloaded file
+    sha256:  Maybe[str] = None # as published
+    size:    Maybe[int] = None
+
+def apiheaders(url:Url) -> dict[str,str]:
+    headers = {'Accept': 'application/vnd.github+json'}
+    if url.startswith(GITHUB_API) and (token := os.environ.get('GITHUB_TOKEN')):
+        headers['Authorization'] = f'Bearer {token}'
+    return headers
+
+# get content from url (as utf-8)
+def geturl(url:Url, ttl:int=0) -> Text:
+    with open(fetch(url, ttl, apiheaders(url)), 'rb') as handle:
+        return handle.read().decode('utf-8-sig')
 
 # download url as json
 def getjson(url:Url) -> Json:
-    return json.loads(geturl(url, 'json'))
+    return json.loads(geturl(url, API_TTL))
 
-# download url as yaml translated into json
+# download url as yaml
 def getyml(url:Url) -> Json:
-    return json.loads(output([ YML2JSON ], input=geturl(url, 'yaml')))
+    return parseyml(geturl(url, API_TTL))
+
+# pre-release tags, ordered (and before the release itself)
+PRE_RELEASES = {'dev': 0, 'a': 1, 'alpha': 1, 'b': 2, 'beta': 2,
+                'pre': 3, 'preview': 3, 'c': 4, 'rc': 4}
+
+# sort key of a version string: the numbers in it compare as numbers, the
+# pre-release tags before the release, and any other words after it
+# (so 3.08 < 3.08.1, 3.1rc1 < 3.1 < 3.1-post1, and v22.01 == 22.01)
+def versionkey(version:Text) -> tuple[tuple[int,int,str],...]:
+    key = []
+    for part in re.findall(r'\d+|[a-z]+', re.sub(r'^v(?=\d)', '', version.lower())):
+        if part.isdigit():         key.append((3, int(part), ''))
+        elif part in PRE_RELEASES: key.append((1, PRE_RELEASES[part], ''))
+        else:                      key.append((2, 1, part))
+    return (*key, (2, 0, ''))
+
+def newest(versions:Iterable[Text]) -> Text:
+    return max(versions, key=versionkey)
 
 # get a latest release from github
-def github(owner:str, repo:str,
-           pred:Callable[...,bool]) -> Maybe[Path]:
-    url = f'{GITHUB_API}/{owner}/{repo}/releases/latest'
+def resolvegithub(owner:str, repo:str, pred:Callable[...,bool]) -> Resolved:
+    url = f'{GITHUB_API}/repos/{owner}/{repo}/releases/latest'
     println(taskf('github', YELLOW), urlf(url))
 
     data = getjson(url)
-
     if not (asset := find(pred, data['assets'])):
-        return logerror('no suitable assets found')
-
-    app = data['name']     or f'{owner}/{repo}'
-    ver = data['tag_name'] or 'latest'
-
-    println(taskf('download'), fmt(app, GREEN), fmt(ver, CYAN))
-    return curl(asset['browser_download_url'], name=asset['name'])
-
-# get a latest version installer from winget manifests
-def winget(publisher:str, package:str,
-           pred:Callable[...,bool],
-           sanitizeurl:Callable[[Url],Url]=str,
-           packagepath:Url=None) -> Maybe[Path]:
+        raise ResolveError(f'no suitable assets found in {owner}/{repo} {data["tag_name"]}')
+
+    digest = asset.get('digest') or ''
+    return Resolved(data['name'] or f'{owner}/{repo}', data['tag_name'] or 'latest',
+                    asset['browser_download_url'], asset['name'],
+                    digest[len('sha256:'):] if digest.startswith('sha256:') else None,
+                    asset.get('size'))
+
+# get a latest version installer from winget manifests: the versions are
+# listed with the API, the installer manifest is read from the repo as is
+def resolvewinget(publisher:str, package:str,
+                  pred:Callable[...,bool],
+                  sanitizeurl:Callable[[Url],Url]=str,
+                  packagepath:Url=None) -> Resolved:
     packagepath=(packagepath or
                  '/'.join([publisher[0:1].lower(), publisher, package]))
-    url  = f'{WINGET_PKGS}/contents/manifests/{packagepath}'
+    url = f'{WINGET_PKGS}/contents/manifests/{packagepath}'
     println(taskf('winget', YELLOW), urlf(url))
 
-    # return latest version (comparing on a subkey)
-    # comparing with the LegacyVersion version parser
-    def latest(versions:list[dict[Text,Any]], key='name') -> Text:
-        return max(map(lambda item: Version(item[key]), versions))
-
-    # get manifest for the latest version
-    manifest = getyml(getjson(
-        f'{url}/{latest(getjson(url))}/{publisher}.{package}.installer.yaml'
-    )['download_url'])
+    if not (versions := [item['name'] for item in getjson(url) if item['type'] == 'dir']):
+        raise ResolveError(f'no versions of {publisher}.{package} found')
 
-    if not (asset := find(pred, manifest['Installers'])):
-        return logerror('no suitable assets found')
+    version = newest(versions)
+    manifest = getyml(f'{WINGET_RAW}/manifests/{packagepath}/{version}/'
+                      f'{publisher}.{package}.installer.yaml')
 
-    app = manifest['PackageIdentifier'] or f'{publisher}.{package}'
-    ver = manifest['PackageVersion']    or 'latest'
+    # the fields at the root of the manifest are the defaults of each installer
+    shared = {key: value for key, value in manifest.items() if key != 'Installers'}
+    installers = [{**shared, **installer} for installer in manifest.get('Installers') or []]
+    if not (installer := find(pred, installers)):
+        raise ResolveError(f'no suitable installer found for {publisher}.{package} {version}')
 
-    println(taskf('download'), fmt(app, GREEN), fmt(ver, CYAN))
-    return curl(url=sanitizeurl(asset['InstallerUrl']))
+    # the hash is of the installer, not of a sanitized url
+    url = sanitizeurl(installer['InstallerUrl'])
+    digest = installer.get('InstallerSha256') if url == installer['InstallerUrl'] else None
+    return Resolved(manifest.get('PackageIdentifier') or f'{publisher}.{package}',
+                    str(manifest.get('PackageVersion') or version),
+                    url, basename(urlsplit(url).path),
+                    digest and digest.lower())
 
-#============================================================================
-# PRINT VERSION + PARSED ARGS AS HEADER
+def fetchtool(tool:Resolved) -> Path:
+    println(taskf('download'), fmt(tool.name, GREEN), fmt(tool.version, CYAN))
+    return curl(tool.url, name=tool.file, sha256=tool.sha256)
 
-VERSION = getcontents(path(PWD, 'VERSION'))
+#----------------------------------------------------------------------------
+# lock file
+#
+# LOCK_FILE pins the tool updates and the bash completion helpers to an
+# exact url, version, size and sha256, and records the size and sha256 of
+# the bundled installers (the INSTALL_* defaults). A locked build resolves
+# nothing: the pinned files are taken from the download cache by digest,
+# or downloaded from TOOLS_MIRROR (if set, as '{mirror}/{file}') or their
+# url, and checked against the lock. --resolve writes the missing entries
+# of the lock, --update refreshes them (all, or the named ones, 'wheels'
+# for the pip packages).
+
+class LockError(Exception): pass
+
+LOCK_VERSION = 1
+
+def loadlock() -> Json:
+    try:
+        with open(LOCK_FILE, 'r') as handle: lock = json.load(handle)
+    except FileNotFoundError: return {'version': LOCK_VERSION, 'tools': {}, 'assets': {}}
+    if lock.get('version') != LOCK_VERSION:
+        raise LockError(f'unsupported lock file version in {LOCK_FILE}: {lock.get("version")}')
+    return lock
+
+# the lock of a build, or None when unlocked
+def readlock() -> Maybe[Json]:
+    if UNLOCKED or not os.path.isfile(LOCK_FILE): return None
+    return loadlock()
+
+# the bash completion helpers, always downloaded: name -> url
+def helpers() -> dict[str,Url]:
+    return {'hg-completion': HG_COMPLETION, 'git-completion': GIT_COMPLETION}
+
+# the bundled installers: INSTALL_* name -> path
+def assets() -> dict[str,Path]:
+    return {name: value for name, value in globals().items()
+            if name.startswith('INSTALL_') and name != 'INSTALL_PATH'}
+
+def lockentry(name:Text, version:Maybe[Text], url:Url, file:Text, blob:Path) -> Json:
+    return {'name': name, 'version': version, 'url': url, 'file': file,
+            'size': os.path.getsize(blob), 'sha256': basename(blob)}
+
+# resolve (a tool) and download, to pin it. the download stays cached,
+# so the locked build after it does not download anything again
+def pin(name:str) -> Json:
+    if name in TOOLS:
+        tool = TOOLS[name]()
+        return lockentry(tool.name, tool.version, tool.url, tool.file,
+                         fetch(tool.url, sha256=tool.sha256))
+    url = helpers()[name]
+    return lockentry(name, None, url, f'{name}.bash', fetch(url))
+
+# get a pinned file, from the cache (w/o any request), or downloaded
+def fetchlocked(entry:Json, dst:Path=None) -> Path:
+    if blob := pinnedblob(entry['sha256']):
+        println(taskf('locked'), fmt(entry['name'], GREEN), fmt(entry['version'] or '', CYAN),
+                chf('(cached, verified)'))
+        return materialize(blob, path(dst or CURL_PATH, entry['file']))
+
+    urls = ([f'{TOOLS_MIRROR.rstrip("/")}/{entry["file"]}'] if TOOLS_MIRROR else []) + [entry['url']]
+    for url in urls:
+        try: blob = fetch(url, sha256=entry['sha256'])
+        except (OSError, HTTPException) as error:
+            if url != urls[-1]:
+                logerror(f'{url}: {error}, trying the next source', 'FETCH')
+                continue
+            if isinstance(error, IntegrityError):
+                raise LockError(f'{error} (of the lock), run with --update') from error
+            raise
+        println(taskf('locked'), fmt(entry['name'], GREEN), fmt(entry['version'] or '', CYAN))
+        return materialize(blob, path(dst or CURL_PATH, entry['file']))
+
+# check the bundled installers against the lock
+def checkassets(lock:Json):
+    changed = []
+    for name, filepath in assets().items():
+        if not (entry := lock['assets'].get(name)): continue
+        if (not os.path.isfile(filepath) or os.path.getsize(filepath) != entry['size'] or
+                contentdigest(filepath) != entry['sha256']):
+            changed.append(f'{name} ({basename(filepath)})')
+    if changed: raise LockError(
+        f'bundled installers do not match the lock: {", ".join(changed)}, run with --resolve')
 
-logheader(
-    ' '.join([fmt('MozillaBuild PACKAGEIT', BOLD, BLUE),
-              chf(':'), fmt(VERSION, BOLD, MAGENTA)]),
-    [
-        ('Reference (host) MSYS2 install',  REF_PATH),
-        ('Source location',                 SRC_PATH),
-        ('Staging folder',                  OUT_PATH),
-        ('MSVC install path',               MSVC_PATH),
-        ('Latest Windows 10 SDK path',      SDK_PATH),
-        ('Download MSYS2 package sources',  FETCH_SOURCES),
-        ('Download latest tool updates',    FETCH_TOOLS),
-        ('Bundle extras with MSYS2',        MSYS_EXTRA),
-        ('Bundle devel libs with MSYS2',    MSYS_DEVEL),
-    ]
-)
+#----------------------------------------------------------------------------
+# wheelhouse
+#
+# The pip packages are locked too: --resolve runs pip's resolver (of the
+# python running this, --dry-run with a --report) for the bundled python,
+# allowing only wheels (so mercurial comes prebuilt), and pins the wheels
+# it picks. The python stage installs them from WHEELHOUSE with --no-index
+# and --require-hashes, so a warm build doesn't resolve, download or build
+# anything. Unlocked, or when PIP_PACKAGES changed since, it installs from
+# the index as before.
+
+# the major, minor version of the bundled python
+def pyversion() -> tuple[str,str]:
+    return re.match(r'python-(\d+)\.(\d+)', basename(INSTALL_PY3)).groups()
+
+# the bundled python, as pip's target options
+def piptarget() -> list[str]:
+    major, minor = pyversion()
+    return ['--platform', PIP_PLATFORM, '--python-version', f'{major}.{minor}',
+            '--implementation', 'cp', '--abi', f'cp{major}{minor}']
+
+# pip's report of what it would install
+def resolvewheels() -> list[Json]:
+    with tempfile.TemporaryDirectory() as tmp:
+        command([sys.executable, '-m', 'pip', 'install', '--dry-run', '--quiet', '--ignore-installed',
+                 '--only-binary', ':all:', *piptarget(), '--target', path(tmp, 'target'),
+                 '--report', report := path(tmp, 'report.json'), *PIP_PACKAGES])
+        return json.loads(getcontents(report))['install']
+
+def pinwheel(item:Json) -> Json:
+    url = item['download_info']['url']
+    sha256 = item['download_info']['archive_info']['hashes']['sha256']
+    return lockentry(item['metadata']['name'], item['metadata']['version'], url,
+                     unquote(basename(urlsplit(url).path)), fetch(url, sha256=sha256))
+
+def pinwheels() -> Json:
+    with ThreadPoolExecutor(FETCH_JOBS, thread_name_prefix='fetch') as pool:
+        packages = list(pool.map(pinwheel, resolvewheels()))
+    return {'requirements': PIP_PACKAGES, 'target': piptarget(),
+            'packages': {entry['name']: entry for entry in packages}}
+
+# the pinned wheels, if they were resolved for PIP_PACKAGES and the bundled python
+def lockedwheels(lock:Maybe[Json]) -> Maybe[dict[str,Json]]:
+    if not lock or not (wheels := lock.get('wheels')): return None
+    if wheels['requirements'] != PIP_PACKAGES or wheels['target'] != piptarget(): return None
+    return wheels['packages']
+
+def installwheels(wheels:dict[str,Json]):
+    for name, entry in wheels.items(): fetched(f'wheel-{name}') or fetchlocked(entry, WHEELHOUSE)
+    putcontents(requirements := path(OUT_PATH, 'requirements.txt'), ''.join(
+        f'{entry["name"]}=={entry["version"]} --hash=sha256:{entry["sha256"]}\n'
+        for entry in wheels.values()))
+    command([
+        path(PY3_PATH, 'python3.exe'), '-m', 'pip', 'install',
+        '--no-index', '--find-links', WHEELHOUSE, '--require-hashes',
+        '--ignore-installed', '--upgrade', '--no-warn-script-location',
+        '-r', requirements
+    ])
 
 #============================================================================
-# PACKINGTIME!
+# PE images: the headers of the staged exe-s and dll-s are read in-process
+# (the COFF file header and the fixed part of the optional header, which is
+# all the rebasing needs)
+
+PE_DYNAMIC_BASE = 0x0040 # DllCharacteristics: relocatable at load time (ASLR)
+
+class PEError(Exception): pass
+
+class PEImage(typing.NamedTuple):
+    path: Path
+    machine: int
+    imagebase: int
+    imagesize: int
+    dllchars: int
+    header: int    # file offset of the 'PE\0\0' signature
+    pe32plus: bool
+
+    # the address range the image is loaded at (not relocated)
+    @property
+    def end(self) -> int: return self.imagebase + self.imagesize
+
+def peimage(filepath:Path) -> PEImage:
+    with open(filepath, 'rb') as handle:
+        dos = handle.read(0x40)
+        if len(dos) < 0x40 or dos[:2] != b'MZ': raise PEError(f'not a PE image: {filepath}')
+        header, = struct.unpack_from('<L', dos, 0x3c)
+        handle.seek(header)
+        head = handle.read(4 + 20 + 72)
+
+    if len(head) < 4 + 20 + 72 or head[:4] != b'PE\0\0': raise PEError(f'no PE header: {filepath}')
+    machine, = struct.unpack_from('<H', head, 4)
+    magic, = struct.unpack_from('<H', head, 24)
+    if magic not in (0x10b, 0x20b): raise PEError(f'unknown optional header ({magic:#x}): {filepath}')
+
+    # ImageBase is a 64 bit field at 24 in PE32+, a 32 bit one at 28 in PE32
+    # (after BaseOfData), the rest of the fields are at the same offsets
+    imagebase, = struct.unpack_from('<Q', head, 48) if magic == 0x20b else struct.unpack_from('<L', head, 52)
+    imagesize, = struct.unpack_from('<L', head, 24 + 56)
+    dllchars,  = struct.unpack_from('<H', head, 24 + 70)
+    return PEImage(filepath, machine, imagebase, imagesize, dllchars, header, magic == 0x20b)
+
+# the pairs of images whose address ranges overlap
+def overlapping(images:Iterable[PEImage]) -> list[tuple[PEImage,PEImage]]:
+    result, loaded = [], []
+    for image in sorted(images, key=lambda image: (image.imagebase, image.path)):
+        loaded = [other for other in loaded if other.end > image.imagebase]
+        result += [(other, image) for other in loaded]
+        loaded.append(image)
+    return result
+
 #----------------------------------------------------------------------------
+# PE resources: the resource tree of an image is read, changed, and written
+# back in-process (to embed a manifest, like mt.exe -outputresource does).
+# The new tree replaces the .rsrc section when it's the last one, otherwise
+# it goes into a new section after the last one (the old one is left as is).
+# Signed images and ones with an overlay (data after the last section, that
+# would be overwritten) are refused, and so are those without room for one
+# more section header.
+
+RT_MANIFEST  = 24
+LANG_NEUTRAL = 0
+PE_DIR_RESOURCE, PE_DIR_SECURITY = 2, 4
+
+# resource type -> name/id -> language -> (data, codepage)
+ResourceTree = dict[Union[int,str],Any]
+
+class PESection(typing.NamedTuple):
+    header: int # file offset of the section header
+    vsize: int
+    va: int
+    rawsize: int
+    raw: int
+
+    @property
+    def vend(self) -> int: return self.va + max(self.vsize, self.rawsize)
+
+def alignup(value:int, alignment:int) -> int:
+    return (value + alignment - 1) // alignment * alignment
+
+# the layout of a whole image, read into memory
+class PEFile:
+    def __init__(self, filepath:Path, data:bytearray):
+        self.path, self.data = filepath, data
+        if len(data) < 0x40 or data[:2] != b'MZ': raise PEError(f'not a PE image: {filepath}')
+        self.header, = struct.unpack_from('<L', data, 0x3c)
+        if data[self.header:self.header + 4] != b'PE\0\0': raise PEError(f'no PE header: {filepath}')
+
+        self.coff = self.header + 4
+        count, = struct.unpack_from('<H', data, self.coff + 2)
+        optsize, = struct.unpack_from('<H', data, self.coff + 16)
+        self.optional = self.coff + 20
+        magic, = struct.unpack_from('<H', data, self.optional)
+        if magic not in (0x10b, 0x20b): raise PEError(f'unknown optional header ({magic:#x}): {filepath}')
+
+        self.directories = self.optional + (112 if magic == 0x20b else 96)
+        self.ndirectories, = struct.unpack_from('<L', data, self.directories - 4)
+        self.salign, self.falign = struct.unpack_from('<LL', data, self.optional + 32)
+        self.headersize, = struct.unpack_from('<L', data, self.optional + 60)
+        self.table = self.optional + optsize
+        self.sections = [PESection(offset, *struct.unpack_from('<LLLL', data, offset + 8))
+                         for offset in range(self.table, self.table + 40 * count, 40)]
+
+    # the end of the image in the file (past it, there's an overlay)
+    @property
+    def end(self) -> int:
+        return max([section.raw + section.rawsize for section in self.sections if section.rawsize] +
+                   [self.headersize])
+
+    def directory(self, index:int) -> tuple[int,int]:
+        if index >= self.ndirectories: return 0, 0
+        return struct.unpack_from('<LL', self.data, self.directories + 8 * index)
+
+    def section(self, rva:int) -> PESection:
+        for section in self.sections:
+            if section.va <= rva < section.vend: return section
+        raise PEError(f'rva {rva:#x} is in no section: {self.path}')
+
+    # the file offset of an rva
+    def offset(self, rva:int) -> int:
+        section = self.section(rva)
+        if rva - section.va >= section.rawsize: raise PEError(f'rva {rva:#x} is not in the file: {self.path}')
+        return section.raw + rva - section.va
+
+    def resources(self) -> ResourceTree:
+        rva, _ = self.directory(PE_DIR_RESOURCE)
+        if not rva: return {}
+        base, data = self.offset(rva), self.data
+
+        def name(offset:int) -> str:
+            length, = struct.unpack_from('<H', data, base + offset)
+            return data[base + offset + 2:base + offset + 2 + 2 * length].decode('utf-16-le')
+
+        def table(offset:int, depth:int) -> ResourceTree:
+            named, ids = struct.unpack_from('<HH', data, base + offset + 12)
+            nodes:ResourceTree = {}
+            for entry in range(base + offset + 16, base + offset + 16 + 8 * (named + ids), 8):
+                key, target = struct.unpack_from('<LL', data, entry)
+                key = name(key & 0x7fffffff) if key & 0x80000000 else key
+                if target & 0x80000000:
+                    if depth == 3: raise PEError(f'resource tree is too deep: {self.path}')
+                    nodes[key] = table(target & 0x7fffffff, depth + 1)
+                else:
+                    datarva, size, codepage, _ = struct.unpack_from('<LLLL', data, base + target)
+                    nodes[key] = (bytes(data[(start := self.offset(datarva)):start + size]), codepage)
+            return nodes
+
+        try: return table(0, 1)
+        except (struct.error, UnicodeDecodeError) as error:
+            raise PEError(f'malformed resources ({error}): {self.path}') from None
+
+    # the image with its resources replaced by 'tree'
+    def withresources(self, tree:ResourceTree) -> bytearray:
+        rva, _ = self.directory(PE_DIR_RESOURCE)
+        last = max(self.sections, key=lambda section: section.va)
+        if rva and rva == last.va and last.raw + last.rawsize == self.end:
+            section, data = last, self.data[:last.raw]
+        else:
+            offset = self.table + 40 * len(self.sections)
+            if offset + 40 > min([section.raw for section in self.sections if section.rawsize] + [self.headersize]):
+                raise PEError(f'no room for another section header: {self.path}')
+            section = PESection(offset, 0, alignup(last.vend, self.salign), 0, alignup(self.end, self.falign))
+            data = self.data[:self.end]
+            struct.pack_into('<H', data, self.coff + 2, len(self.sections) + 1)
+
+        blob = packresources(tree, section.va)
+        data += bytes(section.raw - len(data)) + blob + bytes(alignup(len(blob), self.falign) - len(blob))
+        struct.pack_into('<8sLLLLLLHHL', data, section.header, b'.rsrc', len(blob), section.va,
+                         alignup(len(blob), self.falign), section.raw, 0, 0, 0, 0, 0x40000040)
+        struct.pack_into('<L', data, self.optional + 56, alignup(section.va + len(blob), self.salign))
+        struct.pack_into('<LL', data, self.directories + 8 * PE_DIR_RESOURCE, section.va, len(blob))
+        if struct.unpack_from('<L', data, self.optional + 64)[0]:
+            struct.pack_into('<L', data, self.optional + 64, pechecksum(data, self.optional + 64))
+        return data
+
+# the resource section of 'tree', at 'rva': the directory tables (breadth
+# first), the names, the data entries, then the data (8 byte aligned)
+def packresources(tree:ResourceTree, rva:int) -> bytes:
+    def keys(node:ResourceTree) -> list[Union[int,str]]:
+        return (sorted((key for key in node if isinstance(key, str)), key=str.upper) +
+                sorted(key for key in node if isinstance(key, int)))
+
+    tables, leaves, names = [tree], [], {}
+    for node in tables:
+        for key in keys(node):
+            if isinstance(key, str): names[key] = 0
+            (tables if isinstance(node[key], dict) else leaves).append(node[key])
+
+    offset, tableat = 0, {}
+    for node in tables: tableat[id(node)], offset = offset, offset + 16 + 8 * len(node)
+    for name in names: names[name], offset = offset, offset + 2 + len(name.encode('utf-16-le'))
+    entries = alignup(offset, 8)
+    offset, dataat = entries + 16 * len(leaves), []
+    for data, _ in leaves:
+        dataat.append(offset := alignup(offset, 8))
+        offset += len(data)
+
+    out = bytearray(offset)
+    leaf = 0
+    for node in tables:
+        named = sum(isinstance(key, str) for key in node)
+        struct.pack_into('<LLHHHH', out, tableat[id(node)], 0, 0, 0, 0, named, len(node) - named)
+        for index, key in enumerate(keys(node)):
+            child = node[key]
+            if isinstance(child, dict): target = tableat[id(child)] | 0x80000000
+            else: target, leaf = entries + 16 * leaf, leaf + 1
+            struct.pack_into('<LL', out, tableat[id(node)] + 16 + 8 * index,
+                             names[key] | 0x80000000 if isinstance(key, str) else key, target)
+    for name, at in names.items():
+        struct.pack_into('<H', out, at, len(encoded := name.encode('utf-16-le')) // 2)
+        out[at + 2:at + 2 + len(encoded)] = encoded
+    for index, ((data, codepage), at) in enumerate(zip(leaves, dataat)):
+        struct.pack_into('<LLLL', out, entries + 16 * index, rva + at, len(data), codepage, 0)
+        out[at:at + len(data)] = data
+    return bytes(out)
+
+# the optional header checksum (the 16 bit one's complement sum, plus the size)
+def pechecksum(data:bytearray, at:int) -> int:
+    words = memoryview(bytes(data[:at]) + bytes(4) + bytes(data[at + 4:]) + bytes(len(data) % 2)).cast('H')
+    total = sum(words)
+    while total >> 16: total = (total & 0xffff) + (total >> 16)
+    return total + len(data)
+
+# embed a manifest as the resource RT_MANIFEST #1 (in place, through a temp
+# file), returns whether it had to be changed (not when it's there already)
+def embedmanifest(filepath:Path, manifest:bytes) -> bool:
+    with open(filepath, 'rb') as handle: image = PEFile(filepath, bytearray(handle.read()))
+    if image.directory(PE_DIR_SECURITY)[1]: raise PEError(f'signed: {filepath}')
+    if len(image.data) > image.end: raise PEError(f'{len(image.data) - image.end} bytes of overlay: {filepath}')
+
+    tree = image.resources()
+    current = tree.get(RT_MANIFEST, {}).get(1, {})
+    if [data for data, _ in current.values()] == [manifest]: return False
+    tree.setdefault(RT_MANIFEST, {})[1] = {next(iter(current), LANG_NEUTRAL): (manifest, 0)}
+    data = image.withresources(tree)
+
+    fd, changed = tempfile.mkstemp(dir=dirname(filepath))
+    try:
+        with open(fd, 'wb') as out: out.write(data)
+        copymode(filepath, changed)
+        os.replace(changed, filepath)
+    except:
+        if os.path.exists(changed): os.remove(changed)
+        raise
+    return True
 
-# assert for pacman and curl in referenve MSYS2
-logsection('Check reference MSYS2')
-assert os.path.isfile(REF_PACMAN), f'Reference MSYS2 installation is invalid:\n\t"{REF_PACMAN}" missing'
-assert os.path.isfile(REF_CURL  ), f'Reference MSYS2 installation is invalid:\n\t"{REF_CURL  }" missing'
-logsuccess('pacman and curl present')
+#============================================================================
+# STAGES
+#
+# Staging is split into stages, which declare the inputs they consume
+# (installers, package lists, flags, content files) and the outputs they
+# produce. After a stage has run, a fingerprint of its inputs is stored in
+# STAMP_PATH, so a rerun only redoes the stages which are invalid (never
+# finished, changed inputs or missing outputs), and the stages after them.
+#
+# Stages only wait for the stages they run 'after', independent ones are
+# run in parallel (by JOBS workers).
+
+class Stage(typing.NamedTuple):
+    name:    str
+    title:   Text
+    run:     Callable[[], None]
+    after:   list[str]
+    inputs:  Callable[[], list[Any]]
+    outputs: Callable[[], list[Path]]
+    enabled: Callable[[], bool]
+    fetches: Callable[[], list[str]]
+
+STAGES:dict[str,Stage] = {}
+
+# register a stage, running after the ones in 'after'. 'inputs', 'outputs',
+# 'enabled' and 'fetches' (the names of the prefetched downloads it uses)
+# are callables, as they are only evaluated before running
+def stage(name:str, title:Text, after:list[str]=[],
+          inputs:Callable[[],list[Any]]=list,
+          outputs:Callable[[],list[Path]]=list,
+          enabled:Callable[[],bool]=lambda: True,
+          fetches:Callable[[],list[str]]=list) -> Callable:
+    def register(run:Callable[[], None]) -> Callable[[], None]:
+        for dep in after: assert dep in STAGES, f'stage "{name}" after unknown "{dep}"'
+        STAGES[name] = Stage(name, title, run, after, inputs, outputs, enabled, fetches)
+        return run
+    return register
 
 #----------------------------------------------------------------------------
+# fingerprints
+
+# file digests, by (path, size, mtime), so inputs are hashed only once
+digests:dict[tuple,str] = {}
+
+# fingerprint a stage input: files by content, directories by the names,
+# sizes and mtimes of the files in them, anything else by its value
+def inputprint(item:Any) -> Text:
+    if isinstance(item, str) and os.path.isfile(item):
+        info = os.stat(item)
+        if (key := (item, info.st_size, info.st_mtime_ns)) not in digests:
+            digests[key] = sha256sum(item)
+        return digests[key]
+
+    if isinstance(item, str) and os.path.isdir(item):
+        return repr(sorted(
+            (os.path.relpath(path(dirpath, name), item),
+             (info := os.stat(path(dirpath, name))).st_size, info.st_mtime_ns)
+            for dirpath, dirnames, filenames in os.walk(item)
+            for name in filenames))
+
+    return repr(item)
+
+# fingerprint a stage: the code of the stage itself + all of its inputs
+def fingerprint(stage:Stage) -> str:
+    digest = hashlib.sha256(inspect.getsource(stage.run).encode())
+    for item in stage.inputs(): digest.update(inputprint(item).encode())
+    return digest.hexdigest()
+
+def stampfile(name:str) -> Path:
+    return path(STAMP_PATH, f'{name}.json')
+
+def readstamp(name:str) -> Maybe[Json]:
+    try: return json.loads(getcontents(stampfile(name)))
+    except (OSError, ValueError): return None
+
+def writestamp(name:str, stamp:Json):
+    mkdirs(STAMP_PATH)
+    putcontents(stampfile(name), json.dumps(stamp, indent=1))
+
+def dropstamp(name:str):
+    try: os.remove(stampfile(name))
+    except FileNotFoundError: pass
+
+# remove files and directories produced by a stage
+def removeoutputs(outputs:list[Path]):
+    for item in outputs:
+        if isdir(item): rmdir(item)
+        elif os.path.lexists(item): os.remove(item); STAGED.drop(item)
 
-# clear leftovers form previous run
-if (os.path.exists(OUT_PATH)):
-    logsubhead('Removing the previous staging directory')
-    rmdir(OUT_PATH)
-
-# clear the download cache if reqd
-if (FETCH_TOOLS == 'no-cache' and os.path.exists(CURL_PATH)):
-    logsubhead('Removing the previous temp directory')
-    rmdir(CURL_PATH)
+#----------------------------------------------------------------------------
+# running stages
+
+# why a stage needs to (re)run, or None if it is up to date
+def invalid(stage:Stage, stamp:Maybe[Json], fprint:str, redone:set[str]) -> Maybe[Text]:
+    if not stamp:                      return 'not staged yet'
+    if deps := [dep for dep in stage.after if dep in redone]:
+                                       return f'after {", ".join(deps)}'
+    if stamp['fingerprint'] != fprint: return 'inputs changed'
+    if not all(map(os.path.lexists, stamp['outputs'])):
+                                       return 'outputs missing'
+    return None
+
+# (re)run a stage if it's invalid, returns whether it changed anything.
+# the stamp of a stage is dropped before it runs, so after a failure
+# a rerun picks up at the stages which did not finish
+def restage(stage:Stage, redone:set[str], forced:bool=False) -> bool:
+    stamp = readstamp(stage.name)
+
+    if not stage.enabled():
+        if not stamp: return False
+
+        # staged by a previous run: remove its leftovers
+        logsubhead(f'Removing disabled stage: {stage.name}')
+        removeoutputs(stamp['outputs'])
+        dropstamp(stage.name)
+        return True
+
+    fprint = fingerprint(stage)
+    if not (reason := 'requested' if forced else invalid(stage, stamp, fprint, redone)):
+        println(taskf('up to date', DIM), stage.title)
+        return False
+
+    logsection(stage.title)
+    println(taskf('stage', YELLOW), stage.name, chf(f'({reason})'))
+
+    outputs = stage.outputs()
+    dropstamp(stage.name)
+    removeoutputs((stamp['outputs'] if stamp else []) + outputs)
+
+    with traced('stage', stage.name, reason=reason):
+        try: stage.run()
+        finally: tracesection(None)
+
+    writestamp(stage.name, {'fingerprint': fprint, 'outputs': outputs, 'fetched': stagefetched(stage)})
+    return True
+
+# restage on a worker thread, with grouped output if running in parallel
+def runstage(stage:Stage, redone:set[str], grouped:bool, forced:bool=False) -> bool:
+    if not grouped: return restage(stage, redone, forced)
+
+    tasklog.lines = []
+    try: return restage(stage, redone, forced)
+    finally:
+        lines, tasklog.lines = tasklog.lines, None
+        if lines: writelines(*lines)
+
+# run the invalid stages, and the ones after them. a stage is started as
+# soon as all the stages it runs after are done, on one of 'jobs' workers.
+# with 'only', just the named stages are redone (the rest are left as is)
+def runstages(stages:dict[str,Stage]=STAGES, jobs:int=1, only:list[str]=None):
+    pending = {name: stage for name, stage in stages.items() if not only or name in only}
+    running:dict[Future,Stage] = {}
+    done:set[str] = set(stages) - set(pending)
+    redone:set[str] = set()
+    failed:list[Exception] = []
+
+    with ThreadPoolExecutor(max(jobs, 1), thread_name_prefix='stage') as pool:
+        while pending or running:
+            # start everything that's ready (unless something failed already)
+            for stage in [] if failed else list(pending.values()):
+                if all(dep in done for dep in stage.after):
+                    del pending[stage.name]
+                    running[pool.submit(runstage, stage, redone, jobs > 1, bool(only))] = stage
+
+            if not running: break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    if future.result(): redone.add(stage.name)
+                    done.add(stage.name)
+                except Exception as error:
+                    logerror(f'stage {stage.name} failed: {error}', 'FAIL')
+                    failed.append(error)
+
+    if failed: raise failed[0]
+
+# the files a stage was staged with, from its prefetched downloads (all
+# done by now, they are waited for by the inputs)
+def stagefetched(stage:Stage) -> dict[str,Path]:
+    return {name: future.result() for name in stage.fetches()
+            if (future := FETCHED.get(name)) and future.done() and not future.exception() and future.result()}
+
+# the prefetched downloads as the last run had them (the ones still there),
+# so a dry run fingerprints the stages with the same files, w/o fetching
+def lastfetched(stages:dict[str,Stage]=STAGES) -> dict[str,Future]:
+    futures:dict[str,Future] = {}
+    for name in stages:
+        for job, filepath in ((readstamp(name) or {}).get('fetched') or {}).items():
+            if not os.path.isfile(filepath): continue
+            futures[job] = Future()
+            futures[job].set_result(filepath)
+    return futures
+
+# the stages a run would redo, and why (without running anything)
+def planstages(stages:dict[str,Stage]=STAGES, only:list[str]=None) -> list[tuple[Stage,Maybe[Text]]]:
+    redone:set[str] = set()
+    plan = []
+    for stage in stages.values():
+        if only and stage.name not in only: continue
+        stamp = readstamp(stage.name)
+
+        try:
+            if not stage.enabled(): reason = stamp and 'disabled, leftovers removed'
+            elif only:              reason = 'requested'
+            else:                   reason = invalid(stage, stamp, fingerprint(stage), redone)
+        except Exception as error:  reason = f'inputs not available: {error}'
+
+        if not (reason or stage.enabled()): continue
+        if reason: redone.add(stage.name)
+        plan.append((stage, reason))
+    return plan
 
+#============================================================================
+# PACKINGTIME!
 #----------------------------------------------------------------------------
 
-logsubhead('Creating working directories')
-mkdirs(ETAG_PATH, OUT_PATH, MOZ_PATH, BIN_PATH)
+VERSION = getcontents(path(PWD, 'VERSION'))
 
 #----------------------------------------------------------------------------
+# All the downloads of a run, started up front so they run in parallel with
+# the staging. Stages pick up the results with fetched(...)
 
-OUT_7ZIP=path(OUT_PATH, '7zip')
-BIN_7ZIP=path(BIN_PATH, '7zip')
-
-if FETCH_TOOLS:
-    logsubhead('Trying to fetch latest 7-Zip')
-    INSTALL_7ZIP = winget('7zip', '7zip', # get the latest x64 MSI
+# the tools updated with -u, resolved to their latest release
+TOOLS:dict[str,Callable[[],Resolved]] = {
+    # get the latest x64 MSI
+    '7zip': lambda: resolvewinget('7zip', '7zip',
         lambda installer: (installer['Architecture'] == 'x64' and
-                           installer['InstallerType'] == 'wix')
-    ) or INSTALL_7ZIP
+                           installer.get('InstallerType') == 'wix')),
+    'vswhere': lambda: resolvegithub('microsoft', 'vswhere',
+        lambda asset: ext(asset['name']) == 'exe'),
+    'nsis': lambda: resolvewinget('NSIS', 'NSIS',
+        lambda installer: installer['Architecture'] == 'x86',
+        lambda url: sourceforge_url(url).replace('-setup.exe', '.zip')),
+    'upx': lambda: resolvegithub('upx', 'upx',
+        lambda asset: 'win64' in asset['name'].lower()),
+}
+
+# upx comes from MSYS2 with the extras
+def updatedtools() -> list[str]:
+    return [name for name in TOOLS if FETCH_TOOLS and not (name == 'upx' and MSYS_EXTRA)]
+
+# (only the named ones, if given)
+def fetchjobs(names:Iterable[str]=None) -> dict[str,Callable[[],Maybe[Path]]]:
+    pinned = (lock := readlock()) and lock['tools'] or {}
+    jobs = {
+        **{name: functools.partial(fetchlocked, pinned[name]) if name in pinned else
+                 functools.partial(lambda name: fetchtool(TOOLS[name]()), name)
+           for name in updatedtools()},
+        **{name: functools.partial(fetchlocked, pinned[name]) if name in pinned else
+                 functools.partial(curl, url, f'{name}.bash')
+           for name, url in helpers().items()},
+        **{f'wheel-{name}': functools.partial(fetchlocked, entry, WHEELHOUSE)
+           for name, entry in (lockedwheels(lock) or {}).items()},
+    }
+    return jobs if names is None else {name: job for name, job in jobs.items() if name in names}
+
+#----------------------------------------------------------------------------
 
-logsection('Staging 7-Zip')
-mkdirs(OUT_7ZIP)
+@stage('7zip', 'Staging 7-Zip',
+    fetches=lambda: ['7zip'],
+    inputs=lambda: [fetched('7zip', INSTALL_7ZIP)],
+    outputs=lambda: [OUT_7ZIP, BIN_7ZIP,
+                     path(BIN_PATH, '7z.exe'), path(BIN_PATH, '7z.dll')])
+def stage_7zip():
+    mkdirs(OUT_7ZIP)
 
-# Create an administrative install point and copy the files to stage rather
-# than using a silent install to avoid installing the shell extension on the host machine.
-call(['msiexec.exe', '/q', '/a', INSTALL_7ZIP, f'TARGETDIR={OUT_7ZIP}'])
+    # Create an administrative install point and copy the files to stage rather
+    # than using a silent install to avoid installing the shell extension on the host machine.
+    call(['msiexec.exe', '/q', '/a', fetched('7zip', INSTALL_7ZIP), f'TARGETDIR={OUT_7ZIP}'])
 
-# copy files
-copydir(path(OUT_7ZIP, 'Files', '7-Zip'), BIN_7ZIP)
-copy(path(BIN_7ZIP, '7z.exe'), BIN_PATH)
-copy(path(BIN_7ZIP, '7z.dll'), BIN_PATH)
+    # copy files
+    copydir(path(OUT_7ZIP, 'Files', '7-Zip'), BIN_7ZIP)
+    copy(path(BIN_7ZIP, '7z.exe'), BIN_PATH)
+    copy(path(BIN_7ZIP, '7z.dll'), BIN_PATH)
 
 #----------------------------------------------------------------------------
 # Extract Python3 to the stage directory. The archive being used is the result of running the
@@ -607,15 +2613,6 @@ copy(path(BIN_7ZIP, '7z.dll'), BIN_PATH)
 # or from the command line (only need to specify ultra compression here):
 #   $ cd /c/python3 && 7z a /c/temp/python-3.x.x.7z -r . -mx=9
 
-logsection('Staging Python 3 and extra packages')
-
-unpack(INSTALL_PY3, PY3_PATH)
-copy(path(PY3_PATH, 'python.exe'), PY3_PATH, 'python3.exe')
-
-#----------------------------------------------------------------------------
-
-logsubhead('Update pip packages')
-
 PIP_PACKAGES = [
     'pip',
     'setuptools',
@@ -623,12 +2620,6 @@ PIP_PACKAGES = [
     'windows-curses',
 ]
 
-command([
-    path(PY3_PATH, 'python3.exe'), '-m', 'pip', 'install',
-    '--ignore-installed', '--upgrade', '--no-warn-script-location',
-    *PIP_PACKAGES
-])
-
 #----------------------------------------------------------------------------
 # Find any occurrences of hardcoded interpreter paths in the Scripts directory and change them
 # to a generic python.exe instead. Awful, but distutils hardcodes the interpreter path in the
@@ -640,27 +2631,193 @@ command([
 # Need to special-case c:\python3\python.exe too due to the
 # aforementioned packaging issues above.
 
-logsubhead('distutils shebang fix')
+# all the interpreter paths to fix, in a single (binary) pattern, a group each
+@functools.cache
+def fix_bangs(py3_path:Path) -> re.Pattern:
+    return re.compile(b'|'.join(b'(%s)' % re.escape(bang.encode()) for bang in [
+        path(SYS, 'python3', 'python.exe'),
+        path(py3_path, "python3.exe")
+    ]), re.IGNORECASE)
+
+# the shebang is looked for in the first BANG_HEAD bytes,
+# the rest of a larger file is searched memory mapped
+BANG_HEAD = 4096
+
+# find the first match of each interpreter path in a file, in file order
+def find_bangs(filename:Path) -> list[tuple[int,int]]:
+    bangs = fix_bangs(PY3_PATH)
+
+    def first(data:Union[bytes,mmap.mmap]) -> list[tuple[int,int]]:
+        spans:dict[int,tuple[int,int]] = {}
+        for match in bangs.finditer(data):
+            spans.setdefault(match.lastindex, match.span())
+            if len(spans) == bangs.groups: break
+        return sorted(spans.values())
+
+    with open(filename, 'rb') as handle:
+        spans = first(head := handle.read(BANG_HEAD))
+        if len(spans) == bangs.groups or len(head) < BANG_HEAD: return spans
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return first(data)
+
+# replace the first occurrence of each hardcoded interpreter path in a file
+# (binary safe, and streamed to a temp file in one pass), returns whether
+# the file had to be changed
+def shebang_fix(filename:Path) -> bool:
+    if ext(filename) == 'exe': return False
+    if not (spans := find_bangs(filename)): return False
+
+    fd, fixed = tempfile.mkstemp(dir=dirname(filename))
+    try:
+        with open(filename, 'rb') as handle, open(fd, 'wb') as out:
+            for start, end in spans:
+                out.write(handle.read(start - handle.tell()))
+                out.write(b'python3.exe')
+                handle.seek(end)
+            copyfileobj(handle, out, HTTP_CHUNK)
+        copymode(filename, fixed)
+        os.replace(fixed, filename)
+    except:
+        if os.path.exists(fixed): os.remove(fixed)
+        raise
 
-FIX_BANGS=map(re.escape, [
-    path(SYS, 'python3', 'python.exe'),
-    path(PY3_PATH, "python3.exe")
-])
+    STAGED.update(filename)
+    return True
+
+# shebang fix a lot of files in parallel, returns the number of files changed
+def shebang_fixes(files:Iterable[Path], jobs:int=None) -> int:
+    with ThreadPoolExecutor(jobs or JOBS, thread_name_prefix='shebang') as pool:
+        return sum(pool.map(shebang_fix, files))
+
+@stage('python', 'Staging Python 3 and extra packages', after=['7zip'],
+    inputs=lambda: [INSTALL_PY3, PIP_PACKAGES, lockedwheels(readlock()), ZIP_STDLIB],
+    outputs=lambda: [PY3_PATH],
+    fetches=lambda: [f'wheel-{name}' for name in lockedwheels(readlock()) or {}])
+def stage_python():
+    unpack(INSTALL_PY3, PY3_PATH)
+    copy(path(PY3_PATH, 'python.exe'), PY3_PATH, 'python3.exe')
+
+    if wheels := lockedwheels(lock := readlock()):
+        logsubhead('Install the locked wheels')
+        installwheels(wheels)
+    else:
+        if lock: logerror(f'no wheels locked for the pip packages in {LOCK_FILE}, run with --resolve', 'LOCK')
+        logsubhead('Update pip packages')
+        command([
+            path(PY3_PATH, 'python3.exe'), '-m', 'pip', 'install',
+            '--ignore-installed', '--upgrade', '--no-warn-script-location',
+            *PIP_PACKAGES
+        ])
+    STAGED.update(PY3_PATH)
+
+    logsubhead('distutils shebang fix')
+    scripts = [entry.path for entry in STAGED.files(PYSCRPTS) if entry.ext != 'exe']
+    logsuccess(f'fixed {shebang_fixes(scripts)} of {len(scripts)} scripts', 'DONE')
 
-def shebang_fix(filename:Path):
-    if ext(filename) == 'exe': return
-    modcontents(filename, lambda contents: reduce(lambda data, bang:
-            re.sub(bang, 'python3.exe', data, 1, flags=re.IGNORECASE),
-        FIX_BANGS, contents))
+#----------------------------------------------------------------------------
+# Precompile the staged python (the stdlib and the pip packages), so the
+# first hg doesn't pay for it, in a directory it may not be able to write.
+# The pyc-s are 'unchecked-hash' ones: reproducible, and not checked against
+# the sources at import. With ZIP_STDLIB, the pure python modules of the
+# stdlib are moved into pythonXY.zip (precompiled, stored), which is the
+# first place python looks in. Toggling it redoes the python stage too, to
+# start from the unpacked Lib.
+
+def pycompile(*dirs:Path, legacy:bool=False):
+    try: command([path(PY3_PATH, 'python3.exe'), '-m', 'compileall', '-q', '-f', '-j', str(JOBS),
+                  '--invalidation-mode', 'unchecked-hash', '-x', PYC_EXCLUDE,
+                  *(['-b'] if legacy else []), *dirs])
+    except CalledProcessError:
+        logerror('some modules failed to compile (above), they are compiled when imported', 'PYC')
+
+def zipstdlib() -> Path:
+    lib, scratch = path(PY3_PATH, 'Lib'), path(OUT_PATH, '.stdlib')
+    out = path(PY3_PATH, f'python{"".join(pyversion())}.zip')
+    if os.path.exists(scratch): rmdir(scratch)
+    mkdirs(scratch)
+
+    # move the modules out, compile them next to their sources, zip the rest
+    # (the sources only of the modules that didn't compile)
+    for name in sorted(os.listdir(lib)):
+        if name in ZIP_STDLIB_KEEP or name == '__pycache__': continue
+        if isdir(source := path(lib, name)) or name.endswith('.py'): os.replace(source, path(scratch, name))
+    pycompile(scratch, legacy=True)
+
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED) as zip:
+        for filepath, name in members(scratch):
+            name = name.split('/', 1)[1]
+            if isdir(filepath): continue
+            if '__pycache__' in name.split('/'): continue
+            if not name.endswith('.py') or not os.path.exists(f'{filepath}c'): zip.write(filepath, name)
+        count = len(zip.infolist())
+    rmdir(scratch)
+    println(taskf('zip'), fmt(count, CYAN), 'stdlib files', opf(dst=out))
+    return out
 
-withfilesin(PYSCRPTS, do=shebang_fix)
+@stage('pycompile', 'Precompiling the staged python', after=['python'],
+    inputs=lambda: [ZIP_STDLIB, PYC_EXCLUDE, ZIP_STDLIB_KEEP],
+    outputs=lambda: [path(PY3_PATH, f'python{"".join(pyversion())}.zip')] if ZIP_STDLIB else [])
+def stage_pycompile():
+    if ZIP_STDLIB:
+        logsubhead('Zipping the standard library')
+        zipstdlib()
+
+    logsubhead('Compiling the bytecode')
+    pycompile(PY3_PATH)
+    STAGED.update(PY3_PATH)
+    logsuccess(f'{len(STAGED.files(PY3_PATH, ext="pyc"))} modules precompiled', 'PYC')
+
+# the time IMPORT_BENCH takes in the staged python (the median of IMPORT_RUNS):
+# the wall time, and the time spent importing (from -X importtime). without
+# the bytecode, the pyc-s are looked for in an empty PYTHONPYCACHEPREFIX
+# (and not written), the zipped stdlib stays compiled
+def importtime(compiled:bool) -> Json:
+    runs = []
+    with tempfile.TemporaryDirectory() as empty:
+        env = {**os.environ, **({} if compiled else
+                                {'PYTHONPYCACHEPREFIX': empty, 'PYTHONDONTWRITEBYTECODE': '1'})}
+        for _ in range(IMPORT_RUNS):
+            start = time.perf_counter()
+            result = subproc([path(PY3_PATH, 'python3.exe'), '-X', 'importtime', '-c', IMPORT_BENCH],
+                             env=env, capture_output=True)
+            wall = time.perf_counter() - start
+            # 'import time: self [us] | cumulative | imported package'
+            times = [int(field) for line in result.stderr.splitlines() if line.startswith('import time:')
+                     if (field := line.split('|')[0].split(':', 1)[1].strip()).isdigit()]
+            runs.append((wall, sum(times) / 1e6, len(times)))
+
+    wall, imports, modules = sorted(runs)[len(runs) // 2]
+    return {'layout': f'{"zipped" if ZIP_STDLIB else "lib"}-{"pyc" if compiled else "source"}',
+            'statement': IMPORT_BENCH, 'seconds': wall, 'import_seconds': imports, 'modules': modules}
+
+# time the layouts, adding them to the results of the earlier runs
+def benchimports() -> list[Json]:
+    try: results = {item['layout']: item for item in json.loads(getcontents(path(OUT_PATH, 'importtime.json')))}
+    except (OSError, ValueError): results = {}
+
+    for compiled in [False, True]:
+        result = importtime(compiled)
+        results[result['layout']] = result
+
+    base = results.get('lib-source')
+    for item in results.values():
+        println(taskf(item['layout']), fmt(f'{item["seconds"] * 1000:8.1f} ms', CYAN),
+                chf(f'(imports {item["import_seconds"] * 1000:.1f} ms, {item["modules"]} modules)'),
+                nuls(base and f'{base["seconds"] / item["seconds"]:.2f}x', fmt='{} of lib-source'))
+
+    putcontents(path(OUT_PATH, 'importtime.json'), json.dumps(list(results.values()), indent=1))
+    logsuccess(f'results in {path(OUT_PATH, "importtime.json")}', 'BENCH')
+    return list(results.values())
 
 #----------------------------------------------------------------------------
 # Extract KDiff3 to the stage directory. The KDiff3 installer doesn't support
 # silent installation, so we use a ready-to-extract 7-Zip archive instead.
 
-logsection('Staging KDiff3')
-unpack(INSTALL_KDIFF, path(MOZ_PATH, 'kdiff3'))
+@stage('kdiff3', 'Staging KDiff3', after=['7zip'],
+    inputs=lambda: [INSTALL_KDIFF],
+    outputs=lambda: [path(MOZ_PATH, 'kdiff3')])
+def stage_kdiff3():
+    unpack(INSTALL_KDIFF, path(MOZ_PATH, 'kdiff3'))
 
 # note: winget-pkgs has
 # - "JoachimEibl/Kiff3":v0.9.98 (links to sourceforge),
@@ -669,12 +2826,13 @@ unpack(INSTALL_KDIFF, path(MOZ_PATH, 'kdiff3'))
 #    https://binary-factory.kde.org/view/Windows%2064-bit/job/KDiff3_Stable_win64/
 
 #----------------------------------------------------------------------------
-
-if not MSYS_EXTRA:
-    INFOZIP_OUT_PATH = path(BIN_PATH, 'info-zip')
-
-    # Extract Info-Zip Zip & UnZip to the stage directory.
-    logsection('Staging Info-Zip')
+# Extract Info-Zip Zip & UnZip to the stage directory.
+@stage('info-zip', 'Staging Info-Zip', after=['7zip'],
+    enabled=lambda: not MSYS_EXTRA,
+    inputs=lambda: [INSTALL_UNZ, INSTALL_ZIP],
+    outputs=lambda: [INFOZIP_OUT_PATH,
+                     path(BIN_PATH, 'unzip.exe'), path(BIN_PATH, 'zip.exe')])
+def stage_infozip():
     unpack(INSTALL_UNZ, INFOZIP_OUT_PATH)
     unpack(INSTALL_ZIP, INFOZIP_OUT_PATH)
 
@@ -684,53 +2842,59 @@ if not MSYS_EXTRA:
 
 #----------------------------------------------------------------------------
 
-if not MSYS_EXTRA:
-    if FETCH_TOOLS:
-        logsubhead('Trying to fetch latest UPX')
-        INSTALL_UPX = github('upx', 'upx',
-            lambda asset: 'win64' in asset['name'].lower()
-        ) or INSTALL_UPX
-
-    logsection('Staging UPX')
-    copy(path(BIN_PATH, unpack(INSTALL_UPX, BIN_PATH), 'upx.exe'), BIN_PATH)
+@stage('upx', 'Staging UPX',
+    enabled=lambda: not MSYS_EXTRA,
+    fetches=lambda: ['upx'],
+    inputs=lambda: [fetched('upx', INSTALL_UPX)],
+    outputs=lambda: [path(BIN_PATH, 'upx.exe')])
+def stage_upx():
+    unpack(fetched('upx', INSTALL_UPX), BIN_PATH, patterns=['*/upx.exe'], strip=1)
 
 #----------------------------------------------------------------------------
 
-logsection('Staging nsinstall')
-copy(path(CONTENT_PATH, 'nsinstall.exe'), BIN_PATH)
+@stage('nsinstall', 'Staging nsinstall',
+    inputs=lambda: [path(CONTENT_PATH, 'nsinstall.exe')],
+    outputs=lambda: [path(BIN_PATH, 'nsinstall.exe')])
+def stage_nsinstall():
+    copy(path(CONTENT_PATH, 'nsinstall.exe'), BIN_PATH)
 
 #----------------------------------------------------------------------------
 
-if FETCH_TOOLS:
-    logsubhead('Trying to fetch an latest vswhere')
-    VSWHERE = github('microsoft', 'vswhere',
-        lambda asset: ext(asset['name']) == 'exe'
-    ) or VSWHERE
-
-logsection('Staging vswhere')
-copy(VSWHERE, BIN_PATH)
+@stage('vswhere', 'Staging vswhere',
+    fetches=lambda: ['vswhere'],
+    inputs=lambda: [fetched('vswhere', VSWHERE)],
+    outputs=lambda: [path(BIN_PATH, basename(fetched('vswhere', VSWHERE)))])
+def stage_vswhere():
+    copy(fetched('vswhere', VSWHERE), BIN_PATH)
 
 #----------------------------------------------------------------------------
 
-logsection('Staging watchman')
-unpack(INSTALL_WATCH, BIN_PATH)
+@stage('watchman', 'Staging watchman',
+    inputs=lambda: [INSTALL_WATCH, path(CONTENT_PATH, 'watchman-LICENSE')],
+    outputs=lambda: [path(BIN_PATH, name) for name in [
+        'watchman.exe', 'eledo-pty-bridge.exe', 'gflags.dll', 'glog.dll',
+        'watchman-LICENSE']])
+def stage_watchman():
+    unpack(INSTALL_WATCH, BIN_PATH)
 
-# copy license
-copy(path(CONTENT_PATH, 'watchman-LICENSE'), BIN_PATH)
+    # copy license
+    copy(path(CONTENT_PATH, 'watchman-LICENSE'), BIN_PATH)
 
 #----------------------------------------------------------------------------
-
-logsection('Locating MSYS2 components and dependencies')
+# MSYS2 components and dependencies
 
 # these pacakges may require restarting the MSYS shell in regular cases
 # before continuing, so we install them first
 CORE_PKGS = ([
     'msys2-runtime',
     'bash',
-]) + ([
+])
+
+# bundled with MSYS_PACMAN
+PACMAN_PKGS = ([
     'pacman',
     'pacman-mirrors'
-] if MSYS_PACMAN else [])
+])
 
 REQD_PKGS = ([
     'bash-completion',
@@ -750,9 +2914,11 @@ REQD_PKGS = ([
     'tar',
     'vim',
     'wget',
-]) + ([
-    # skip these when MSYS_PACMAN == True,
-    # as they were pulled as dependencies of pacman in PKGS_CORE
+])
+
+# skip these when MSYS_PACMAN == True,
+# as they were pulled as dependencies of pacman in PKGS_CORE
+PACMAN_DEPS = ([
     'bzip2',
     'ca-certificates',
     'coreutils',
@@ -764,7 +2930,7 @@ REQD_PKGS = ([
     'which',
     'xz',
     'zstd',
-] if not MSYS_PACMAN else [])
+])
 
 # extra packages available in msys base repo
 EXTRA_PKGS = ([
@@ -787,250 +2953,1203 @@ DEVEL_PKGS = ([
     # icu4x ?
 ])
 
-#----------------------------------------------------------------------------
-# Extract MSYS2 packages to the stage directory
+def corepkgs() -> list[str]:
+    return ((CORE_PKGS) +
+            (PACMAN_PKGS if MSYS_PACMAN else []))
 
-logsection('Syncing base MSYS2 components')
+def syncpkgs() -> list[str]:
+    return ((REQD_PKGS) +
+            (PACMAN_DEPS if not MSYS_PACMAN else []) +
+            (EXTRA_PKGS  if MSYS_EXTRA else []) +
+            (DEVEL_PKGS  if MSYS_DEVEL else []))
 
-MSYS2_PATH = path(MOZ_PATH, 'msys2')
-mkdirs(path(MSYS2_PATH, 'tmp'),
-       path(MSYS2_PATH, 'var', 'lib', 'pacman'),
-       path(MSYS2_PATH, 'var', 'log'))
+#----------------------------------------------------------------------------
 
-MSYS2_ETC  = path(MSYS2_PATH, 'etc')
-MSYS2_USR  = path(MSYS2_PATH, 'usr')
-MSYS2_UBIN = path(MSYS2_USR,  'bin')
+def msys2env() -> dict[str,str]:
+    env = os.environ.copy()
+    env['PATH'] = os.pathsep.join([
+        path(refpath(), 'usr', 'bin'),
+        env['PATH']])
+    return env
 
-MSYS2_ENV = os.environ.copy()
-MSYS2_ENV['PATH'] = os.pathsep.join([
-    path(REF_PATH, 'usr', 'bin'),
-    MSYS2_ENV['PATH']])
+#----------------------------------------------------------------------------
+# MSYS2 mirrors: probed in parallel for their latency (to the response) and
+# throughput (reading up to MIRROR_BYTES of the msys repository database),
+# and ranked by the time a typical package would take. The ranking is kept
+# in MIRROR_CACHE for MIRROR_TTL. pacman syncs the staging root from them in
+# that order, and the source archives fail over along it (a mirror failing
+# during the run is moved to the end).
+
+class MirrorProbe(typing.NamedTuple):
+    url:        Url
+    latency:    Maybe[float] = None # seconds
+    throughput: Maybe[float] = None # bytes per second
+    error:      Maybe[str]   = None
+
+ranked:list[Url] = []
+mirrorfailures:dict[Url,int] = {}
+mirrorlock = threading.Lock()
+
+def probemirror(url:Url) -> MirrorProbe:
+    connections.timeout = MIRROR_TIMEOUT
+    start, size = time.perf_counter(), 0
+    try:
+        with traced('probe', url) as span, request(f'{url}/{MIRROR_PROBE}') as response:
+            latency = time.perf_counter() - start
+            span.update(status=response.status)
+            if response.status != 200: return MirrorProbe(url, error=f'{response.status} {response.reason}')
+            while size < MIRROR_BYTES and (chunk := response.read(min(HTTP_CHUNK, MIRROR_BYTES - size))):
+                size += len(chunk)
+            span['downloaded'] = size
+        return MirrorProbe(url, latency, size / max(time.perf_counter() - start - latency, 1e-6))
+    except (OSError, HTTPException) as error:
+        return MirrorProbe(url, error=str(error) or type(error).__name__)
+    finally:
+        # the probes are read partially, so their connections can't be reused
+        for conn in connections.__dict__.pop('pool', {}).values(): conn.close()
+
+# the seconds a typical package would take from a mirror (failed ones last)
+def mirrorscore(probe:MirrorProbe) -> float:
+    if probe.error or not probe.throughput: return float('inf')
+    return probe.latency + MIRROR_SIZE / probe.throughput
+
+# the mirrors, fastest first: cached, or probed again when the ranking is
+# older than MIRROR_TTL, the mirrors changed, or 'probe' is set
+def rankmirrors(urls:list[Url], probe:bool=False) -> list[MirrorProbe]:
+    try: cached = json.loads(getcontents(MIRROR_CACHE))
+    except (OSError, ValueError): cached = {}
+    if (not probe and cached.get('mirrors') == urls and
+        time.time() - cached.get('checked', 0) < MIRROR_TTL):
+        return [MirrorProbe(**entry) for entry in cached['ranking']]
+
+    with ThreadPoolExecutor(len(urls), thread_name_prefix='probe') as pool:
+        ranking = sorted(pool.map(probemirror, urls), key=mirrorscore)
+
+    for entry in ranking:
+        println(taskf('mirror', RED if entry.error else GREEN), urlf(entry.url), chf(
+            f'({entry.error})' if entry.error else
+            f'({entry.latency * 1000:.0f} ms, {entry.throughput / 2**20:.1f} MiB/s)'))
+
+    # an offline run is not worth remembering
+    if any(not entry.error for entry in ranking):
+        mkdirs(dirname(MIRROR_CACHE))
+        putcontents(MIRROR_CACHE, json.dumps({'checked': time.time(), 'mirrors': urls,
+                                              'ranking': [entry._asdict() for entry in ranking]}, indent=1))
+    return ranking
+
+# the ranked mirror urls (ranked once per run), the ones failed since last
+def mirrors() -> list[Url]:
+    with mirrorlock:
+        if not ranked: ranked.extend(entry.url for entry in rankmirrors(MIRROR_URLS, RANK_MIRRORS))
+        return sorted(ranked, key=lambda url: mirrorfailures.get(url, 0))
+
+# fetch a file from the mirrors, failing over to the next one on errors,
+# or if it's not there (yet). only the last mirror retries with backoff
+# (not found when a mirror that answered didn't have it, even if others were down)
+def fetchmirrored(relpath:Path, sha256:str=None) -> Path:
+    failure:Maybe[Exception] = None
+    missing = False
+    for index, mirror in enumerate(urls := mirrors()):
+        last = index == len(urls) - 1
+        try: return fetch(f'{mirror}/{relpath}', sha256=sha256, retries=None if last else MIRROR_RETRIES)
+        except NotFoundError: missing = True
+        except (OSError, HTTPException) as error:
+            failure = error
+            with mirrorlock: mirrorfailures[mirror] = mirrorfailures.get(mirror, 0) + 1
+            if not last: logerror(f'{urlf(mirror)}: {error}, failing over to {urlf(urls[index + 1])}', 'MIRROR')
+    if missing or not failure: raise NotFoundError(f'not on any of the mirrors: {relpath}')
+    raise failure
 
 #----------------------------------------------------------------------------
 # function to call pacman in the staging root
 # using a wrapper to execute the cmd / capture the output
 
-def pacman(pkgs:list[str]=[], env:dict[str,str]=MSYS2_ENV,
+def pacman(pkgs:list[str]=[], env:dict[str,str]=None,
            op:list[str]=['--sync', '--refresh', '--noconfirm'],
            wrap_call:Callable[[Cmd],T]=command) -> T:
-    wrap_call([REF_PACMAN, '--root', MSYS2_PATH, *op, *pkgs], env=env)
+    return wrap_call([reftool('pacman.exe'), '--root', MSYS2_PATH, '--config', pacmanconf(),
+                      *op, *pkgs], env=env or msys2env())
+
+# the pacman.conf of the reference MSYS2, with the msys repository synced
+# from the ranked mirrors (the other repositories are left as they are)
+def pacmanconf() -> Path:
+    mkdirs(dirname(PACMAN_CONF))
+    putcontents(MIRRORLIST, ''.join(f'Server = {url}/msys/$arch/\n' for url in mirrors()))
+
+    lines, section = [], None
+    for line in getcontents(path(refpath(), 'etc', 'pacman.conf')).splitlines():
+        if (stripped := line.strip()).startswith('['): section = stripped
+        elif section == '[msys]' and re.match(r'(Include|Server)\s*=', stripped): continue
+        lines.append(line)
+        if stripped == '[msys]': lines.append(f'Include = {MIRRORLIST.replace(os.sep, "/")}')
+
+    putcontents(PACMAN_CONF, '\n'.join(lines) + '\n')
+    return PACMAN_CONF
 
 #----------------------------------------------------------------------------
-# Install msys2-runtime (and pacman if opted) first
-# so that post-install scripts run successfully
+# Extract MSYS2 packages to the stage directory
+
+@stage('msys2', 'Syncing base MSYS2 components',
+    inputs=lambda: [corepkgs(), syncpkgs()],
+    outputs=lambda: [MSYS2_PATH])
+def stage_msys2():
+    mkdirs(path(MSYS2_PATH, 'tmp'),
+           path(MSYS2_PATH, 'var', 'lib', 'pacman'),
+           path(MSYS2_PATH, 'var', 'log'))
 
-pkglabel=' + '.join(
-    filter(nuls, ['core', MSYS_PACMAN and 'pacman']))
+    # Install msys2-runtime (and pacman if opted) first
+    # so that post-install scripts run successfully
+    pkglabel=' + '.join(
+        filter(nuls, ['core', MSYS_PACMAN and 'pacman']))
 
-logsubhead(f'Syncing {pkglabel} MSYS2 packages')
-pacman(CORE_PKGS)
+    logsubhead(f'Syncing {pkglabel} MSYS2 packages')
+    pacman(corepkgs())
 
-pkglabel=' + '.join(
-    filter(nuls, ['required', MSYS_EXTRA and 'extra', MSYS_DEVEL and 'dev']))
+    pkglabel=' + '.join(
+        filter(nuls, ['required', MSYS_EXTRA and 'extra', MSYS_DEVEL and 'dev']))
 
-logsubhead(f'Syncing {pkglabel} MSYS2 packages')
-pacman((REQD_PKGS) +
-       (EXTRA_PKGS if MSYS_EXTRA else []) +
-       (DEVEL_PKGS if MSYS_DEVEL else []))
+    logsubhead(f'Syncing {pkglabel} MSYS2 packages')
+    pacman(syncpkgs())
+    STAGED.update(MSYS2_PATH)
 
 #----------------------------------------------------------------------------
 
-if FETCH_SOURCES:
-    logsubhead('Downloading MSYS2 package sources')
-    OUT_SRC_PATH = path(OUT_PATH, 'sources')
+# Fetch the sources of the installed MSYS2 packages, on FETCH_JOBS threads.
+# The archives are named after the base package (split packages share one),
+# read from the local pacman database. Archives already in OUT_SRC_PATH with
+# the size (or the sha256) they were fetched with are skipped, so a rerun
+# after a failure only fetches the rest. Packages without a source archive
+# on the server are reported, failed downloads fail the stage.
+
+def pkgdb() -> Path:
+    return path(MSYS2_PATH, 'var', 'lib', 'pacman', 'local')
+
+# the fields of a pacman database 'desc' file
+def pkgdesc(filepath:Path) -> dict[str,list[str]]:
+    fields:dict[str,list[str]] = {}
+    for block in getcontents(filepath).split('\n\n'):
+        if (lines := block.strip().splitlines()) and lines[0].startswith('%'):
+            fields[lines[0].strip('%')] = lines[1:]
+    return fields
+
+# source archive name -> the installed packages built from it
+def srcpackages() -> dict[str,list[str]]:
+    sources:dict[str,list[str]] = {}
+    for entry in sorted(os.scandir(pkgdb()), key=lambda entry: entry.name):
+        if not os.path.isfile(desc := path(entry.path, 'desc')): continue
+        fields = pkgdesc(desc)
+        name, version = fields['NAME'][0], fields['VERSION'][0]
+        base = (fields.get('BASE') or [name])[0]
+        sources.setdefault(f'{base}-{version}.src.tar.gz', []).append(name)
+    return sources
+
+# the index entry of a source archive already in place: the same size as
+# when it was fetched, or (left by an earlier run without the index) the
+# same sha256 as the download cache has for it
+def srcpresent(file:Path, entry:Maybe[Json]) -> Maybe[Json]:
+    if not os.path.isfile(out := path(OUT_SRC_PATH, file)): return None
+    if entry: return entry if os.path.getsize(out) == entry['size'] else None
+    with cachelock: cached = next(filter(None, (cacheindex()['urls'].get(f'{mirror}/{SOURCES_PATH}/{file}')
+                                                for mirror in MIRROR_URLS)), None)
+    if cached and sha256sum(out) == cached['digest']:
+        return {'size': os.path.getsize(out), 'sha256': cached['digest']}
+    return None
+
+def fetchsource(file:Path, entry:Maybe[Json]) -> tuple[str,Json]:
+    if present := srcpresent(file, entry): return 'present', present
+    blob = fetchmirrored(f'{SOURCES_PATH}/{file}')
+    materialize(blob, path(OUT_SRC_PATH, file))
+    return 'fetched', {'size': os.path.getsize(blob), 'sha256': basename(blob)}
+
+@stage('sources', 'Downloading MSYS2 package sources', after=['msys2'],
+    inputs=lambda: [pkgdb()],
+    enabled=lambda: FETCH_SOURCES)
+def stage_sources():
     mkdirs(OUT_SRC_PATH)
-    command([REF_CURL, '-sLS#', '--remote-name-all'] + (
-        f'https://repo.msys2.org/msys/sources/{name}-{version}.src.tar.gz'
-        for name, version in
-            (line.split(' ') for line in
-                pacman(op=['--query'], wrap_call=output).splitlines()))
-    , cwd=OUT_SRC_PATH)
+    try: index = json.loads(getcontents(path(OUT_SRC_PATH, SOURCES_INDEX)))
+    except (OSError, ValueError): index = {}
+
+    sources = srcpackages()
+    downloaded:dict[str,Json] = {}
+    missing:dict[str,list[str]] = {}
+    failed:dict[str,Exception] = {}
+    counts = {'present': 0, 'fetched': 0}
+
+    with ThreadPoolExecutor(FETCH_JOBS, thread_name_prefix='fetch') as pool:
+        futures = {file: pool.submit(fetchsource, file, index.get(file)) for file in sources}
+        for file, future in futures.items():
+            try: status, downloaded[file] = future.result()
+            except NotFoundError: missing[file] = sources[file]; continue
+            except (OSError, HTTPException) as error: failed[file] = error; continue
+            counts[status] += 1
+
+    # sources of packages no longer installed
+    for file in set(index) - set(sources):
+        if os.path.isfile(stale := path(OUT_SRC_PATH, file)): os.remove(stale)
+
+    putcontents(path(OUT_SRC_PATH, SOURCES_INDEX), json.dumps(downloaded, indent=1, sort_keys=True))
+
+    for file, names in missing.items():
+        logerror(f'{", ".join(names)}: no source archive {file}', 'MISSING')
+    for file, error in failed.items():
+        logerror(f'{", ".join(sources[file])}: {error}', 'FAILED')
+
+    size = sum(entry['size'] for entry in downloaded.values())
+    logsuccess(f'{len(downloaded)} source archives ({counts["fetched"]} fetched, {counts["present"]} present),'
+               f' {size / 2**20:.1f} MiB, {len(missing)} missing', 'SOURCES')
+    if failed:
+        raise DownloadError(f'{len(failed)} source archive(s) failed to download, rerun to fetch the rest')
 
 #----------------------------------------------------------------------------
 
-logsection('Staging emacs')
-unpack(INSTALL_EMACS, path(MSYS2_PATH, 'usr'), 'xztar')
+@stage('emacs', 'Staging emacs', after=['msys2'],
+    inputs=lambda: [INSTALL_EMACS])
+def stage_emacs():
+    unpack(INSTALL_EMACS, path(MSYS2_PATH, 'usr'), 'xztar')
 
 #----------------------------------------------------------------------------
 
-logsection('Replacing MSYS rm with winrm')
-copy(path(MSYS2_UBIN,   'rm.exe'),    MSYS2_UBIN, 'rm-msys.exe')
-copy(path(CONTENT_PATH, 'winrm.exe'), MSYS2_UBIN, 'rm.exe')
-copy(path(CONTENT_PATH, 'winrm.exe'), MSYS2_UBIN, 'winrm.exe')
+@stage('winrm', 'Replacing MSYS rm with winrm', after=['msys2'],
+    inputs=lambda: [path(CONTENT_PATH, 'winrm.exe')],
+    outputs=lambda: [path(MSYS2_UBIN, 'winrm.exe')])
+def stage_winrm():
+    # keep the original rm around (only once, on a rerun rm.exe is winrm already)
+    if not os.path.isfile(path(MSYS2_UBIN, 'rm-msys.exe')):
+        copy(path(MSYS2_UBIN, 'rm.exe'), MSYS2_UBIN, 'rm-msys.exe')
+    copy(path(CONTENT_PATH, 'winrm.exe'), MSYS2_UBIN, 'rm.exe')
+    copy(path(MSYS2_UBIN, 'rm.exe'), MSYS2_UBIN, 'winrm.exe')
 
 #----------------------------------------------------------------------------
 # Recursively find all MSYS DLLs, then chmod them to make sure none are read-only.
-# Then rebase them via the editbin tool.
+# Then rebase them via the editbin tool, each one at the base planned for it:
+# MSYS2's fork() emulation needs the DLL-s loaded at the same address in the
+# child, which fails (slowly, and not always) when their ranges overlap.
 
-logsection('Collecting staged MSYS DLL-s for rebasing')
+REBASE_TOP    = 0x60000000 # the DLL-s are laid out downwards from here
+REBASE_ALIGN  = 0x10000    # the allocation granularity of windows
+MSYS_DLL_BASE = 0x60100000 # msys-2.0.dll is special, and goes above the rest
 
 msys_dlls = {}
 
-def collect_dlls(filepath:Path):
-    if (ext(filepath) != 'dll'): return
+def collect_dlls(entry:FileEntry):
+    filepath = entry.path
 
     # "msys-perl5_32.dll" is in both "/usr/bin/" and "/usr/lib/perl5/...".
-    # Since "editbin /rebase" fails if it's provided equivalent dlls, let's
-    # ensure no two dlls with the same name are added.
-    if (filepath in msys_dlls): return
+    # Since a DLL is loaded (and rebased) by its name, let's ensure
+    # no two dlls with the same name are added.
+    if (basename(filepath) in msys_dlls): return
 
-    os.chmod(filepath, stat.S_IWRITE)
+    os.chmod(filepath, os.stat(filepath).st_mode | stat.S_IWRITE)
     msys_dlls[basename(filepath)] = os.path.relpath(filepath, MSYS2_PATH)
 
-withfilesin(MSYS2_PATH, do=collect_dlls)
+# a compact, deterministic layout: the images (in path order) are placed
+# below each other, downwards from 'top', at aligned bases
+def rebaseplan(images:Iterable[PEImage], top:int, align:int=REBASE_ALIGN) -> dict[Path,int]:
+    plan:dict[Path,int] = {}
+    for image in sorted(images, key=lambda image: image.path):
+        base = top - alignup(image.imagesize, align)
+        if base < align: raise PEError(f'no address space left below {top:#x} for {image.path}')
+        plan[image.path] = top = base
+    return plan
+
+# the files, in address order, split where the plan isn't contiguous
+# (around the ones already in place)
+def rebaseruns(files:list[Path], plan:dict[Path,int], images:dict[Path,PEImage]) -> list[list[Path]]:
+    runs:list[list[Path]] = []
+    end = None
+    for filepath in sorted(files, key=plan.__getitem__):
+        if plan[filepath] != end: runs.append([])
+        runs[-1].append(filepath)
+        end = plan[filepath] + alignup(images[filepath].imagesize, REBASE_ALIGN)
+    return runs
+
+# editbin places the files of a call consecutively from the base, as they
+# are planned, so each contiguous run is rebased in batched calls (split
+# by the command line limit, each batch from the base of its first file)
+def dllrebase(files:list[Path], plan:dict[Path,int], images:dict[Path,PEImage]):
+    tools_version=getcontents(path(msvcpath(), 'VC', 'Auxiliary', 'Build',
+                                   'Microsoft.VCToolsVersion.default.txt'))
+    EDITBIN=path(msvcpath(), 'VC', 'Tools', 'MSVC',
+                 tools_version, 'bin', 'HostX64', 'x64', 'editbin.exe')
+    toolcheck([failure for run in rebaseruns(files, plan, images)
+                       for failure in runtool(lambda files: [EDITBIN, '/NOLOGO',
+                           f'/REBASE:BASE={plan[files[0]]:#x}', '/DYNAMICBASE:NO', *files
+                       ], run, batch='cmdline')], 'rebasing')
+
+# read the headers back: every DLL at its planned base, and none overlapping
+def checkrebase(plan:dict[Path,int]) -> list[PEImage]:
+    with ThreadPoolExecutor(JOBS, thread_name_prefix='pe') as pool:
+        images = list(pool.map(peimage, plan))
+
+    misplaced = [image for image in images if image.imagebase != plan[image.path]]
+    for image in misplaced:
+        logerror(f'{os.path.relpath(image.path, MSYS2_PATH)} is at {image.imagebase:#x},'
+                 f' not at {plan[image.path]:#x}', 'REBASE')
+    collisions = overlapping(images)
+    for image, other in collisions:
+        logerror(f'{os.path.relpath(image.path, MSYS2_PATH)} [{image.imagebase:#x}-{image.end:#x})'
+                 f' overlaps {os.path.relpath(other.path, MSYS2_PATH)} [{other.imagebase:#x}-{other.end:#x})',
+                 'OVERLAP')
+    if misplaced or collisions:
+        raise PEError(f'rebasing failed: {len(misplaced)} misplaced, {len(collisions)} overlapping DLL-s')
+    return images
+
+@stage('rebase', 'Rebasing the staged MSYS DLL-s',
+    after=['msys2', 'emacs', 'winrm'],
+    inputs=lambda: [msvcpath(), REBASE_TOP, REBASE_ALIGN, MSYS_DLL_BASE])
+def stage_rebase():
+    msys_dlls.clear()
+    for entry in STAGED.files(MSYS2_PATH, ext='dll'): collect_dlls(entry)
+
+    msys = path(MSYS2_UBIN, 'msys-2.0.dll')
+    with ThreadPoolExecutor(JOBS, thread_name_prefix='pe') as pool:
+        images = {image.path: image for image in pool.map(peimage,
+                  {path(MSYS2_PATH, filepath) for filepath in msys_dlls.values()} | {msys})}
+
+    # msys-2.0.dll is special and needs to be rebased independent of the rest
+    plan = rebaseplan([image for image in images.values() if image.path != msys], REBASE_TOP)
+    plan[msys] = MSYS_DLL_BASE
+    println(taskf('plan'), fmt(len(plan), CYAN), 'DLL-s', chf(f'at {min(plan.values()):#x}-{REBASE_TOP:#x},'
+                                                           f' msys-2.0.dll at {MSYS_DLL_BASE:#x}'))
+
+    # the ones already in place (on a rerun) are left alone
+    pending = sorted(image.path for image in images.values()
+                     if (image.imagebase, image.dllchars & PE_DYNAMIC_BASE) != (plan[image.path], 0))
+
+    logsubhead('Rebasing collected DLL-s')
+
+    # editbin changes the files in place
+    with ThreadPoolExecutor(COPY_JOBS, thread_name_prefix='unshare') as pool:
+        list(pool.map(unshare, pending))
+    dllrebase([filepath for filepath in pending if filepath != msys], plan, images)
+    if msys in pending: dllrebase([msys], plan, images)
+    for filepath in pending: STAGED.update(filepath)
+
+    checkrebase(plan)
+    logsuccess(f'rebased {len(pending)} DLL-s, {len(plan)} checked, none overlapping', 'DONE')
 
 #----------------------------------------------------------------------------
+# Embed some fiendly manifests to make UAC happy. They're written in-process
+# (in parallel, and skipping the exe-s that have it already), mt.exe is only
+# needed for the ones that can't be (signed, or with an overlay).
 
-logsubhead('Rebasing collected DLL-s')
+msys_exes={}
 
-tools_version=getcontents(path(MSVC_PATH, 'VC', 'Auxiliary', 'Build',
-                               'Microsoft.VCToolsVersion.default.txt'))
-EDITBIN=path(MSVC_PATH, 'VC', 'Tools', 'MSVC',
-             tools_version, 'bin', 'HostX64', 'x64', 'editbin.exe')
+def collect_exes(entry:FileEntry):
+    msys_exes[entry.path] = os.path.relpath(entry.path, MSYS2_PATH)
 
-def dllrebase(*file_list:Path, base:str, cwd:Path=None):
-    run([EDITBIN, '/NOLOGO',
-         f'/REBASE:BASE={base}', '/DYNAMICBASE:NO', *file_list
-    ], cwd=cwd, check=True)
+# mt.exe takes a single -outputresource, so it's one call per file
+def embed_manifest(files:list[Path]) -> Cmd:
+    return [path(winsdkpath(), 'mt.exe'), '-nologo',
+            '-manifest', path(SRC_PATH, 'noprivs.manifest'),
+           f'-outputresource:{files[0]};#1']
+
+@stage('manifests', 'Embedding UAC-friendly manifests in executable files',
+    after=['rebase'],
+    inputs=lambda: [path(SRC_PATH, 'noprivs.manifest')])
+def stage_manifests():
+    msys_exes.clear()
+    for entry in STAGED.files(MSYS2_PATH, ext='exe'): collect_exes(entry)
+    with open(path(SRC_PATH, 'noprivs.manifest'), 'rb') as handle: manifest = handle.read()
+
+    # the changed files are replaced, not written in place (no need to unshare them)
+    def embed(filepath:Path) -> Union[bool,PEError]:
+        try: return embedmanifest(filepath, manifest)
+        except PEError as error: return error
+
+    with ThreadPoolExecutor(JOBS, thread_name_prefix='manifest') as pool:
+        results = dict(zip(msys_exes, pool.map(embed, msys_exes)))
+    embedded = [filepath for filepath, result in results.items() if result is True]
+    fallback = [filepath for filepath, result in results.items() if isinstance(result, PEError)]
+
+    for filepath in fallback:
+        logerror(f'{msys_exes[filepath]}: {results[filepath]}, embedding with mt.exe', 'MT')
+    if fallback:
+        # mt changes the files in place
+        with ThreadPoolExecutor(COPY_JOBS, thread_name_prefix='unshare') as pool:
+            list(pool.map(unshare, fallback))
+        toolcheck(runtool(embed_manifest, fallback), 'embedding manifests')
+
+    for filepath in embedded + fallback: STAGED.update(filepath)
+    logsuccess(f'embedded {len(embedded) + len(fallback)} manifests ({len(fallback)} with mt.exe),'
+               f' {len(msys_exes) - len(embedded) - len(fallback)} already in place', 'DONE')
 
-# rebase collected DLL-s
-dllrebase(*(msys_dlls.values()), base='0x60000000,DOWN', cwd=MSYS2_PATH)
+#----------------------------------------------------------------------------
 
-# msys-2.0.dll is special and needs to be rebased independent of the rest
-dllrebase(path(MSYS2_UBIN, 'msys-2.0.dll'), base='0x60100000')
+@stage('msys2-config', 'Configure staged MSYS', after=['msys2', 'python'],
+    inputs=lambda: [path(PWD, 'VERSION'), CONTENT_PATH, MSYS_PACMAN],
+    outputs=lambda: [path(MOZ_PATH, 'VERSION'), path(MOZ_PATH, 'start-shell.bat')])
+def stage_msys2_config():
+    # db_home:  Set "~" to point to "%USERPROFILE%"
+    # db_gecos: Fills out gecos information
+    #           (such as the user's full name) from AD/SAM.
+    putcontents(path(MSYS2_ETC, 'nsswitch.conf'), dedent(
+        """
+        db_home: windows
+        db_gecos: windows
+        """
+    ))
+
+    # vi/vim wrapper
+    putcontents(path(MSYS2_UBIN, 'vi'), dedent(
+        """
+        #!/bin/sh
+        exec vim "$@"
+        """
+    ))
+
+    if not MSYS_PACMAN:
+        # we didn't include the package manager (pacman),
+        # so remove its key management setup.
+        try: os.remove(path(MSYS2_ETC, 'post-install', '07-pacman-key.post'))
+        except: pass
 
-logsuccess(f'rebased {len(msys_dlls)+1} DLL-s', 'DONE')
+    # We didn't install the xmlcatalog binary.
+    try: os.remove(path(MSYS2_ETC, 'post-install', '08-xml-catalog.post'))
+    except: pass
 
-#----------------------------------------------------------------------------
-# Embed some fiendly manifests to make UAC happy.
+    # Copy various configuration files.
+    logsubhead('Copying configuration files')
 
-msys_exes={}
+    copy(path(PWD, 'VERSION'), MOZ_PATH)
+    copy(path(MSYS2_ETC, 'skel', '.inputrc'), MSYS2_ETC, 'inputrc')
+    copy(path(CONTENT_PATH, 'mercurial.ini'  ), PYSCRPTS)
+    copy(path(CONTENT_PATH, 'start-shell.bat'), MOZ_PATH)
+    copy(path(CONTENT_PATH, 'msys-config', 'ssh_config'),
+         path(MSYS2_ETC, 'ssh'))
+    copy(path(CONTENT_PATH, 'msys-config', 'profile-mozilla.sh'),
+         path(MSYS2_ETC, 'profile.d'))
 
-logsection('Embedding UAC-friendly manifests in executable files')
-def embed_manifest(filepath:Path):
-    if ext(filepath) != 'exe': return
-    run([path(SDK_PATH, 'mt.exe'), '-nologo',
-            '-manifest', path(SRC_PATH, 'noprivs.manifest'),
-           f'-outputresource:{filepath};#1'
-    ], check=True)
-    msys_exes[basename(filepath)] = os.path.relpath(filepath, MSYS2_PATH)
+#----------------------------------------------------------------------------
 
-withfilesin(MSYS2_PATH, do=embed_manifest)
-logsuccess(f'embedded {len(msys_exes)} manifests', 'DONE')
+@stage('completions', 'Installing bash-completion helpers', after=['msys2', 'python', 'pycompile'],
+    fetches=lambda: list(helpers()),
+    inputs=lambda: [fetched('hg-completion'), fetched('git-completion')],
+    outputs=lambda: [path(COMPLETIONS, name) for name in ['hg', 'git', 'pip']])
+def stage_completions():
+    copy(fetched('hg-completion'),  COMPLETIONS, 'hg')
+    copy(fetched('git-completion'), COMPLETIONS, 'git')
 
-#----------------------------------------------------------------------------
+    # FIXME: umm, this one is way to laggy to use
+    # tested on a SSD, with hg clone mozilla-unified, with a i7-9750H cpu
+    # download('https://hg.mozilla.org/mozilla-unified/raw-file/tip/python/mach/bash-completion.sh',
+    #           path(COMPLETIONS, 'mach'))
+    # and the script generated by 'mach mach-autocomplete bash' seems to be source root specific :/
 
-logsection('Configure staged MSYS')
-
-# db_home:  Set "~" to point to "%USERPROFILE%"
-# db_gecos: Fills out gecos information
-#           (such as the user's full name) from AD/SAM.
-putcontents(path(MSYS2_ETC, 'nsswitch.conf'), dedent(
-    """
-    db_home: windows
-    db_gecos: windows
-    """
-))
-
-# vi/vim wrapper
-putcontents(path(MSYS2_UBIN, 'vi'), dedent(
-    """
-    #!/bin/sh
-    exec vim "$@"
-    """
-))
-
-if not MSYS_PACMAN:
-    # we didn't include the package manager (pacman),
-    # so remove its key management setup.
-    try: os.remove(path(MSYS2_ETC, 'post-install', '07-pacman-key.post'))
-    except: pass
+    # FIXME: not needed (?) (as the preferred way of running pip should be
+    # with 'mach python -m pip' in a source root)
+    putcontents(path(COMPLETIONS, 'pip'),
+                output([path(PY3_PATH, 'python3.exe'), '-m', 'pip', 'completion', '--bash']))
+    shebang_fix(path(COMPLETIONS, 'pip'))
 
-# We didn't install the xmlcatalog binary.
-try: os.remove(path(MSYS2_ETC, 'post-install', '08-xml-catalog.post'))
-except: pass
+    # FIXME: maybe 'pip competion --bash' and 'rustup complete bash' etc can go into post ?
 
-#----------------------------------------------------------------------------
+#============================================================================
+# ALL STAGED, LETS PACKAGEIT!
 
-# Copy various configuration files.
-logsubhead('Copying configuration files')
+INSTALLER_NSI = 'installit.nsi'
+PAYLOAD_NSI   = 'payload.nsi'
+LICENSE_FILE  = 'license.rtf'
 
-copy(path(PWD, 'VERSION'), MOZ_PATH)
-copy(path(MSYS2_ETC, 'skel', '.inputrc'), MSYS2_ETC, 'inputrc')
-copy(path(CONTENT_PATH, 'mercurial.ini'  ), PYSCRPTS)
-copy(path(CONTENT_PATH, 'start-shell.bat'), MOZ_PATH)
-copy(path(CONTENT_PATH, 'msys-config', 'ssh_config'),
-     path(MSYS2_ETC, 'ssh'))
-copy(path(CONTENT_PATH, 'msys-config', 'profile-mozilla.sh'),
-     path(MSYS2_ETC, 'profile.d'))
+def replaceversion(text:Text) -> Text:
+    return text.replace('@VERSION@', VERSION)
 
-#----------------------------------------------------------------------------
+# log the size of each top level component of the staged tree
+def reportsizes():
+    sizes:dict[str,int] = {}
+    for entry in (files := STAGED.files()):
+        name = os.path.relpath(entry.path, MOZ_PATH).split(os.sep)[0]
+        sizes[name] = sizes.get(name, 0) + entry.size
 
-logsubhead('Installing bash-completion helpers')
-COMPLETIONS = path(MSYS2_USR, 'share', 'bash-completion', 'completions')
+    for name, size in sorted(sizes.items(), key=lambda item: -item[1]):
+        println(taskf('size'), fmt(f'{size / 2**20:9.1f} MiB', CYAN), name)
+    logsuccess(f'staged {len(files)} files, {sum(sizes.values()) / 2**20:.1f} MiB', 'SIZE')
 
-download('https://www.mercurial-scm.org/repo/hg/raw-file/tip/contrib/bash_completion',
-         path(COMPLETIONS, 'hg'))
+#----------------------------------------------------------------------------
+# Deduplicate the payload: identical staged files (7-Zip in bin and bin/7zip,
+# the perl dll-s, python.exe and python3.exe, ...) are packed once, and the
+# duplicates are copied from them at install time. PAYLOAD_NSI holds the
+# generated directives, included by the install script (which falls back
+# to 'File /r *.*' without it).
+
+def filedigest(entry:FileEntry) -> str:
+    if (key := (entry.path, entry.size, entry.mtime)) not in digests:
+        digests[key] = sha256sum(entry.path)
+    return digests[key]
+
+# groups of identical files (only the files of the same size are hashed)
+def duplicates(files:list[FileEntry], jobs:int=None) -> list[list[FileEntry]]:
+    bysize:dict[int,list[FileEntry]] = {}
+    for entry in files:
+        if entry.size: bysize.setdefault(entry.size, []).append(entry)
+
+    candidates = [entry for group in bysize.values() if len(group) > 1 for entry in group]
+    with ThreadPoolExecutor(jobs or JOBS, thread_name_prefix='hash') as pool:
+        hashes = list(pool.map(filedigest, candidates))
+
+    groups:dict[str,list[FileEntry]] = {}
+    for entry, digest in zip(candidates, hashes):
+        groups.setdefault(digest, []).append(entry)
+    return [group for group in groups.values() if len(group) > 1]
+
+# path relative to MOZ_PATH, as used in nsis scripts
+def nsispath(filepath:Path) -> Text:
+    return os.path.relpath(filepath, MOZ_PATH).replace(os.sep, '\\').replace('$', '$$')
+
+# path in the installation
+def instpath(filepath:Path) -> Text:
+    return '\\'.join(['$INSTDIR', nsispath(filepath)][:1 if filepath == MOZ_PATH else 2])
+
+# write the File / CopyFiles directives, returns the bytes saved
+def writepayload(filename:Path, files:list[FileEntry], groups:list[list[FileEntry]]) -> int:
+    copies = {entry.path: group[0].path for group in groups for entry in group[1:]}
+
+    bydir:dict[Path,list[Path]] = {}
+    for entry in files:
+        bydir.setdefault(dirname(entry.path), [])
+        if entry.path not in copies: bydir[dirname(entry.path)].append(entry.path)
+
+    lines = [f'; generated by packageit.py: {len(copies)} duplicates are copied at install time',
+             '!define PAYLOAD_NSI']
+    for dirpath in sorted(bydir):
+        if bydir[dirpath]: lines.append(f'  SetOutPath "{instpath(dirpath)}"')
+        else:              lines.append(f'  CreateDirectory "{instpath(dirpath)}"')
+        lines += [f'  File "{nsispath(filepath)}"' for filepath in sorted(bydir[dirpath])]
+
+    # directories w/o any files
+    for dirpath, dirnames, filenames in os.walk(MOZ_PATH):
+        if not (dirnames or filenames):
+            lines.append(f'  CreateDirectory "{instpath(dirpath)}"')
+
+    lines += [f'  CopyFiles /SILENT "{instpath(src)}" "{instpath(dst)}"'
+              for dst, src in sorted(copies.items())]
+    lines.append('  SetOutPath $INSTDIR')
+
+    putcontents(filename, os.linesep.join(lines) + os.linesep)
+    return sum(entry.size for group in groups for entry in group[1:])
+
+def dedup(filename:Path):
+    if os.path.exists(filename): os.remove(filename)
+    if DEDUP == 'off': return
+
+    # a fresh crawl: the payload has to list exactly what's staged
+    files = TreeIndex(MOZ_PATH).files()
+    groups = duplicates(files)
+
+    for group in sorted(groups, key=lambda group: -group[0].size * (len(group) - 1))[:10]:
+        println(taskf('dupe'), fmt(f'{group[0].size / 2**20:7.1f} MiB', CYAN),
+                chf(f'x{len(group)}'), nsispath(group[0].path))
+
+    saved = sum(entry.size for group in groups for entry in group[1:])
+    if DEDUP == 'nsis': writepayload(filename, files, groups)
+    logsuccess(f'{sum(len(group) - 1 for group in groups)} duplicates in {len(groups)} groups, '
+               f'{saved / 2**20:.1f} MiB ' + ('packed once' if DEDUP == 'nsis' else 'could be saved'),
+               'DEDUP')
 
-download('https://raw.githubusercontent.com/git/git/master/contrib/completion/git-completion.bash',
-         path(COMPLETIONS, 'git'))
+#----------------------------------------------------------------------------
+# Packaging backends: the NSIS installer (with the deduplicated payload), or
+# a portable archive of the staged tree. NSIS compresses the payload as one
+# solid lzma stream, on one core. The portable archives are compressed on
+# JOBS workers instead: the zip members are deflated in parallel, the tar
+# stream is packed in XZ_CHUNK sized independent xz streams (concatenated,
+# which any xz decoder reads as one), and zstd uses its own threads.
+
+ZIP_LEVEL  = 9
+XZ_PRESET  = 6
+XZ_CHUNK   = 32 * 1024 * 1024
+ZSTD_LEVEL = 19
+
+class BackendError(Exception): pass
+
+class Backend(typing.NamedTuple):
+    name:    str
+    title:   Text
+    build:   Callable[[Path], None]       # package the staged tree to a file
+    output:  Callable[[], Path]           # the file packaged by default
+    extract: Callable[[Path, Path], None] # unpack a package (for benchmarking)
+
+BACKENDS:dict[str,Backend] = {}
+
+def backend(name:str, title:Text, output:Callable[[],Path],
+            extract:Callable[[Path,Path],None]) -> Callable:
+    def register(build:Callable[[Path], None]) -> Callable[[Path], None]:
+        BACKENDS[name] = Backend(name, title, build, output, extract)
+        return build
+    return register
+
+# results of 'func' for each of 'items', in order, computed on 'pool'
+# with at most 'window' of them pending (so held in memory)
+def ordered(pool:ThreadPoolExecutor, func:Callable[[T],Any],
+            items:Iterable[T], window:int) -> Iterator[Any]:
+    pending:deque[Future] = deque()
+    for item in items:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= window: yield pending.popleft().result()
+    while pending: yield pending.popleft().result()
+
+# the files and empty dirs in 'top', in order, with their archive names
+# (relative to the parent of 'top', so the archives have a root folder)
+def members(top:Path) -> list[tuple[Path,Text]]:
+    items:list[Path] = []
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        if not (dirnames or filenames): items.append(dirpath)
+        items += [path(dirpath, name) for name in sorted(filenames)]
+    return [(item, os.path.relpath(item, dirname(top)).replace(os.sep, '/')) for item in items]
 
-# FIXME: umm, this one is way to laggy to use
-# tested on a SSD, with hg clone mozilla-unified, with a i7-9750H cpu
-# download('https://hg.mozilla.org/mozilla-unified/raw-file/tip/python/mach/bash-completion.sh',
-#           path(COMPLETIONS, 'mach'))
-# and the script generated by 'mach mach-autocomplete bash' seems to be source root specific :/
+#----------------------------------------------------------------------------
+# The portable archives are assembled from chunks: one per component (each
+# top level folder of the staged tree, and its top level files together).
+# A chunk is cached in PAYLOAD_CACHE by the digest of its manifest (the
+# names, modes and contents of its files), so an unchanged component is not
+# compressed again. As zip records and tar members do not depend on what
+# precedes them, the archive is the chunks concatenated, followed by the
+# central directory (zip) or the end of archive blocks (tar).
+
+# the staged members, by component
+def components() -> dict[str,list[tuple[Path,Text]]]:
+    groups:dict[str,list[tuple[Path,Text]]] = {}
+    for filepath, name in members(MOZ_PATH):
+        parts = name.split('/')
+        groups.setdefault(parts[1] if len(parts) > 2 else '.files', []).append((filepath, name))
+    return groups
+
+def contentdigest(filepath:Path) -> str:
+    if isdir(filepath): return ''
+    info = os.stat(filepath)
+    return filedigest(FileEntry(filepath, '', '', info.st_size, info.st_mtime_ns))
+
+# digests of the component manifests, for the backend 'params'
+def manifests(groups:dict[str,list[tuple[Path,Text]]], params:Any) -> dict[str,str]:
+    items = [item for group in groups.values() for item in group]
+    with ThreadPoolExecutor(JOBS, thread_name_prefix='hash') as pool:
+        sums = dict(zip(items, pool.map(lambda item: contentdigest(item[0]), items)))
+
+    prints = {}
+    for component, group in groups.items():
+        digest = hashlib.sha256(repr(params).encode())
+        for item in group:
+            mode = stat.S_IMODE(os.stat(item[0]).st_mode)
+            digest.update(f'{item[1]}\0{mode:o}\0{sums[item]}\n'.encode())
+        prints[component] = digest.hexdigest()
+    return prints
+
+# the chunks of the staged tree (and their indexes), from the cache, or
+# written by 'pack' (which returns the index of the chunk, eg. its records)
+def chunks(backend:str, pack:Callable[[list[tuple[Path,Text]],typing.BinaryIO],Json],
+           params:Any) -> list[tuple[Path,Json]]:
+    groups = components()
+    prints = manifests(groups, params)
+    mkdirs(PAYLOAD_CACHE)
+
+    result = []
+    for component, group in groups.items():
+        chunk = path(PAYLOAD_CACHE, f'{backend}-{component}-{prints[component][:16]}')
+        # the index is written last, so only complete chunks are reused
+        if os.path.exists(f'{chunk}.json') and os.path.exists(chunk):
+            index = json.loads(getcontents(f'{chunk}.json'))
+            println(taskf('cached', DIM), fmt(f'{os.path.getsize(chunk) / 2**20:9.1f} MiB', CYAN), component)
+        else:
+            for stale in os.listdir(PAYLOAD_CACHE):
+                if stale.startswith(f'{backend}-{component}-'): os.remove(path(PAYLOAD_CACHE, stale))
+            with traced('chunk', f'{backend}:{component}', files=len(group)) as span:
+                with open(f'{chunk}.part', 'wb') as file: index = pack(group, file)
+                os.replace(f'{chunk}.part', chunk)
+                span.update(written=os.path.getsize(chunk))
+            putcontents(f'{chunk}.json', json.dumps(index))
+            println(taskf('packed'), fmt(f'{os.path.getsize(chunk) / 2**20:9.1f} MiB', CYAN), component)
+        result.append((chunk, index))
+    return result
+
+# the chunks, followed by 'tail'
+def concat(out:Path, parts:list[Path], tail:bytes):
+    with open(out, 'wb') as file:
+        for part in parts:
+            with open(part, 'rb') as chunk: copyfileobj(chunk, file, COPY_CHUNK)
+        file.write(tail)
 
-# FIXME: not needed (?) (as the preferred way of running pip should be
-# with 'mach python -m pip' in a source root)
-putcontents(path(COMPLETIONS, 'pip'),
-            output([path(PY3_PATH, 'python3.exe'), '-m', 'pip', 'completion', '--bash']))
-shebang_fix(path(COMPLETIONS, 'pip'))
+#----------------------------------------------------------------------------
+# zip: the members are deflated on the workers, and written in order as
+# they are done. the records are laid out by hand, as zipfile can only
+# compress members while writing them (so on one thread)
+
+class ZipRecord(typing.NamedTuple):
+    name:   bytes
+    method: int
+    time:   int # dos time and date
+    date:   int
+    crc:    int
+    packed: int
+    size:   int
+    mode:   int
+    data:   bytes # the local header, followed by the member data
+
+def dostime(mtime:float) -> tuple[int,int]:
+    tm = time.localtime(mtime)
+    if tm.tm_year < 1980: return 0, 1 << 5 | 1
+    return (tm.tm_hour << 11 | tm.tm_min << 5 | tm.tm_sec // 2,
+            (tm.tm_year - 1980) << 9 | tm.tm_mon << 5 | tm.tm_mday)
+
+def ziprecord(filepath:Path, name:Text, level:int=ZIP_LEVEL) -> ZipRecord:
+    info = os.stat(filepath)
+    dtime, ddate = dostime(info.st_mtime)
+    arcname = name.encode()
+
+    if stat.S_ISDIR(info.st_mode):
+        arcname, packed, crc, size, method = arcname + b'/', b'', 0, 0, zipfile.ZIP_STORED
+    else:
+        with open(filepath, 'rb') as file: contents = file.read()
+        crc, size = zlib.crc32(contents), len(contents)
+        packer = zlib.compressobj(level, zlib.DEFLATED, -15)
+        packed, method = packer.compress(contents) + packer.flush(), zipfile.ZIP_DEFLATED
+        if len(packed) >= size: packed, method = contents, zipfile.ZIP_STORED
+
+    if size >= 0xFFFFFFFF: raise BackendError(f'too large for a zip member: {filepath}')
+    header = struct.pack('<4sHHHHHLLLHH', b'PK\x03\x04', 20, 0x800, method,
+                         dtime, ddate, crc, len(packed), size, len(arcname), 0)
+    return ZipRecord(arcname, method, dtime, ddate, crc, len(packed), size,
+                     info.st_mode, header + arcname + packed)
+
+# the central directory entry of a record written at 'offset'
+def zipcentral(record:ZipRecord, offset:int) -> bytes:
+    extra = struct.pack('<HHQ', 1, 8, offset) if offset >= 0xFFFFFFFF else b''
+    attrs = (record.mode & 0xFFFF) << 16 | (0x10 if stat.S_ISDIR(record.mode) else 0)
+    return struct.pack('<4sHHHHHHLLLHHHHHLL', b'PK\x01\x02', 3 << 8 | 20, 45 if extra else 20,
+                       0x800, record.method, record.time, record.date, record.crc,
+                       record.packed, record.size, len(record.name), len(extra), 0, 0, 0,
+                       attrs, min(offset, 0xFFFFFFFF)) + record.name + extra
+
+# the central directory (zip64, if needed for the number of members or
+# the offsets) of the records, written one after the other from the start
+def zipdirectory(records:list[ZipRecord]) -> bytes:
+    central:list[bytes] = []
+    offset = 0
+    for record in records:
+        central.append(zipcentral(record, offset))
+        offset += 30 + len(record.name) + record.packed
+
+    directory = b''.join(central)
+    count, size, start = len(central), len(directory), offset
+    if count >= 0xFFFF or max(size, start) >= 0xFFFFFFFF:
+        directory += struct.pack('<4sQHHLLQQQQ', b'PK\x06\x06', 44, 45, 45, 0, 0,
+                                 count, count, size, start)
+        directory += struct.pack('<4sLQL', b'PK\x06\x07', 0, start + size, 1)
+        count, size, start = min(count, 0xFFFF), min(size, 0xFFFFFFFF), min(start, 0xFFFFFFFF)
+    return directory + struct.pack('<4sHHHHLLH', b'PK\x05\x06', 0, 0, count, count, size, start, 0)
+
+# a chunk of records, indexed by their fields (w/o the data)
+def zipchunk(items:list[tuple[Path,Text]], file:typing.BinaryIO) -> Json:
+    index = []
+    with ThreadPoolExecutor(JOBS, thread_name_prefix='zip') as pool:
+        for record in ordered(pool, lambda item: ziprecord(*item), items, JOBS * 4):
+            file.write(record.data)
+            index.append([record.name.decode(), *record[1:-1]])
+    return index
+
+@backend('zip', 'a portable zip (parallel deflate)',
+         output=lambda: f'{PORTABLE_BASE}.zip', extract=extractzip)
+def package_zip(out:Path):
+    parts = chunks('zip', zipchunk, ZIP_LEVEL)
+    records = [ZipRecord(name.encode(), *fields, b'') for _, index in parts for name, *fields in index]
+    concat(out, [chunk for chunk, _ in parts], zipdirectory(records))
+    println(taskf('zip'), fmt(len(records), CYAN), 'members', opf(dst=out))
 
-# FIXME: maybe 'pip competion --bash' and 'rustup complete bash' etc can go into post ?
+#----------------------------------------------------------------------------
+# tarballs: the members of a chunk are written to a StreamPacker, which
+# compresses them in 'chunk' sized blocks on the workers
+
+TAR_END = tarfile.NUL * tarfile.RECORDSIZE # the end of archive blocks, padded
+
+class StreamPacker:
+    def __init__(self, file:typing.BinaryIO, pack:Callable[[bytes],bytes],
+                 pool:ThreadPoolExecutor, chunk:int, window:int):
+        self.file, self.pack, self.pool = file, pack, pool
+        self.chunk, self.window = chunk, window
+        self.buffer = bytearray()
+        self.pending:deque[Future] = deque()
+        self.written = 0
+
+    def submit(self, block:bytes):
+        self.pending.append(self.pool.submit(self.pack, block))
+        while len(self.pending) > self.window:
+            self.file.write(self.pending.popleft().result())
+
+    def tell(self) -> int:
+        return self.written
+
+    def write(self, data:bytes) -> int:
+        self.buffer += data
+        self.written += len(data)
+        while len(self.buffer) >= self.chunk:
+            self.submit(bytes(self.buffer[:self.chunk]))
+            del self.buffer[:self.chunk]
+        return len(data)
+
+    def close(self):
+        if self.buffer: self.submit(bytes(self.buffer))
+        self.buffer.clear()
+        while self.pending: self.file.write(self.pending.popleft().result())
+
+# no owners in the portable archives
+def tarinfo(info:tarfile.TarInfo) -> tarfile.TarInfo:
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    return info
+
+# write the members w/o the end of archive blocks (so the tarfile is left
+# open), returns the number of members. hard links are only kept within
+# a chunk (a fresh tarfile per chunk), their targets are in the same one
+def tarchunk(items:list[tuple[Path,Text]], fileobj:Any) -> int:
+    tar = tarfile.TarFile(fileobj=fileobj, mode='w', format=tarfile.PAX_FORMAT)
+    tar.copybufsize = COPY_CHUNK
+    for filepath, name in items: tar.add(filepath, name, recursive=False, filter=tarinfo)
+    return len(items)
+
+def xzblock(block:bytes) -> bytes:
+    return lzma.compress(block, lzma.FORMAT_XZ, lzma.CHECK_CRC64, XZ_PRESET)
+
+def xzchunk(items:list[tuple[Path,Text]], file:typing.BinaryIO) -> Json:
+    with ThreadPoolExecutor(JOBS, thread_name_prefix='xz') as pool:
+        packer = StreamPacker(file, xzblock, pool, XZ_CHUNK, JOBS * 2)
+        count = tarchunk(items, packer)
+        packer.close()
+    return count
+
+@backend('tar.xz', 'a portable tar.xz (parallel xz streams)',
+         output=lambda: f'{PORTABLE_BASE}.tar.xz', extract=extracttar)
+def package_xz(out:Path):
+    parts = chunks('tar.xz', xzchunk, [XZ_PRESET, XZ_CHUNK])
+    concat(out, [chunk for chunk, _ in parts], xzblock(TAR_END))
+    println(taskf('tar.xz'), fmt(sum(count for _, count in parts), CYAN), 'members', opf(dst=out))
+
+# zstandard is optional, only needed for the tar.zst backend
+def zstandard() -> Any:
+    try: import zstandard
+    except ImportError: raise BackendError(
+        'the tar.zst backend needs the zstandard module (pip install zstandard)')
+    return zstandard
+
+def unzst(archive:Path, dst:Path):
+    with open(archive, 'rb') as file:
+        with zstandard().ZstdDecompressor().stream_reader(file, read_across_frames=True) as stream:
+            with tarfile.open(fileobj=stream, mode='r|') as tar: tar.extractall(dst, **tarfilter())
+
+def zstpacker() -> Any:
+    return zstandard().ZstdCompressor(level=ZSTD_LEVEL, threads=JOBS)
+
+def zstchunk(items:list[tuple[Path,Text]], file:typing.BinaryIO) -> Json:
+    with zstpacker().stream_writer(file, closefd=False) as stream:
+        return tarchunk(items, stream)
+
+@backend('tar.zst', 'a portable tar.zst (multithreaded zstd)',
+         output=lambda: f'{PORTABLE_BASE}.tar.zst', extract=unzst)
+def package_zst(out:Path):
+    parts = chunks('tar.zst', zstchunk, ZSTD_LEVEL)
+    concat(out, [chunk for chunk, _ in parts], zstpacker().compress(TAR_END))
+    println(taskf('tar.zst'), fmt(sum(count for _, count in parts), CYAN), 'members', opf(dst=out))
 
-#============================================================================
-# ALL STAGED, LETS PACKAGEIT!
+#----------------------------------------------------------------------------
+# NSIS: makensis packs the payload (listed in PAYLOAD_NSI) as written by
+# the install script, extracted with 7-Zip (for benchmarking)
 
-logsection('Packaging the installer')
-if FETCH_TOOLS:
-    logsubhead('Fetching latest NSIS')
-    INSTALL_NSIS = winget('NSIS', 'NSIS',
-        lambda installer: installer['Architecture'] == 'x86',
-        lambda url: sourceforge_url(url).replace('-setup.exe', '.zip')
-    ) or INSTALL_NSIS
+@backend('nsis', 'the NSIS installer (solid lzma)',
+         output=lambda: INSTALLER_EXE, extract=un7pak)
+def package_nsis(out:Path):
+    NSISOUT_PATH = unpack(fetched('nsis', INSTALL_NSIS), OUT_PATH)
 
-logsubhead('Unpacking NSIS tools')
-NSISOUT_PATH = unpack(INSTALL_NSIS, OUT_PATH)
+    copy(path(NSISSRC_PATH, 'setup.ico'),        OUT_PATH)
+    copy(path(NSISSRC_PATH, 'helpers.nsi'),      OUT_PATH)
+    copy(path(NSISSRC_PATH, 'mozillabuild.bmp'), OUT_PATH)
 
-#----------------------------------------------------------------------------
+    # replace the version placeholder in the install script
+    copy(path(NSISSRC_PATH, INSTALLER_NSI), OUT_PATH)
+    modcontents(path(OUT_PATH, INSTALLER_NSI), replaceversion)
 
-logsubhead('Prepping installer scripts')
+    logsubhead('Deduplicating the payload')
+    dedup(path(OUT_PATH, PAYLOAD_NSI))
 
-INSTALLER_NSI = 'installit.nsi'
-LICENSE_FILE  = 'license.rtf'
+    logsubhead('Packaging with NSIS...')
+    command([path(OUT_PATH, NSISOUT_PATH, 'makensis.exe'),
+             '/NOCD', INSTALLER_NSI], cwd=OUT_PATH)
+    if os.path.normpath(out) != os.path.normpath(INSTALLER_EXE):
+        os.replace(INSTALLER_EXE, out)
 
-copy(path(NSISSRC_PATH, 'setup.ico'),        OUT_PATH)
-copy(path(NSISSRC_PATH, 'helpers.nsi'),      OUT_PATH)
-copy(path(NSISSRC_PATH, 'mozillabuild.bmp'), OUT_PATH)
+#----------------------------------------------------------------------------
 
-def replaceversion(text:Text) -> Text:
-    return text.replace('@VERSION@', VERSION)
+def packages() -> list[Path]:
+    return [BACKENDS[name].output() for name in PACKAGE_WITH]
 
-# replace the version placeholder in the license file
+# replace the version placeholder in the license file,
 # also make a copy in the installation folder
-copy(path(NSISSRC_PATH, LICENSE_FILE), OUT_PATH)
-modcontents(path(OUT_PATH, LICENSE_FILE), replaceversion)
-copy(path(OUT_PATH, LICENSE_FILE), MOZ_PATH)
+def stagelicense():
+    copy(path(NSISSRC_PATH, LICENSE_FILE), OUT_PATH)
+    modcontents(path(OUT_PATH, LICENSE_FILE), replaceversion)
+    copy(path(OUT_PATH, LICENSE_FILE), MOZ_PATH)
+
+# package the staged tree with each backend (to a scratch folder, w/o the
+# cached chunks), then unpack it, and compare the times, sizes and throughput
+def benchbackends(names:list[str]) -> list[Json]:
+    global PAYLOAD_CACHE
+    scratch = path(OUT_PATH, '.backends')
+    staged = TreeIndex(MOZ_PATH).size()
+    results:list[Json] = []
+
+    for name in names:
+        item = BACKENDS[name]
+        logsubhead(f'Benchmarking {item.title}')
+        if os.path.exists(scratch): rmdir(scratch)
+        mkdirs(scratch)
+
+        out = path(scratch, basename(item.output()))
+        cache, PAYLOAD_CACHE = PAYLOAD_CACHE, path(scratch, 'payload')
+        try:
+            with traced('backend', name) as span:
+                start = time.perf_counter()
+                item.build(out)
+                packtime = time.perf_counter() - start
+
+                start = time.perf_counter()
+                item.extract(out, path(scratch, 'extracted'))
+                unpacktime = time.perf_counter() - start
+                span.update(written=os.path.getsize(out))
+        except Exception as error:
+            logerror(f'{name}: {error}', 'FAIL')
+            results.append({'backend': name, 'error': str(error)})
+            continue
+        finally:
+            PAYLOAD_CACHE = cache
+
+        size = os.path.getsize(out)
+        results.append({'backend': name, 'staged': staged, 'packed': size,
+                        'ratio': staged / size, 'pack_seconds': packtime,
+                        'unpack_seconds': unpacktime,
+                        'unpack_mib_per_second': staged / 2**20 / unpacktime})
+        println(taskf(name), fmt(f'{size / 2**20:9.1f} MiB', CYAN),
+                chf(f'ratio {staged / size:.2f}'),
+                f'packed in {packtime:.1f}s, unpacked in {unpacktime:.1f}s',
+                chf(f'({staged / 2**20 / unpacktime:.1f} MiB/s)'))
+
+    if os.path.exists(scratch): rmdir(scratch)
+    putcontents(path(OUT_PATH, 'backends.json'), json.dumps(results, indent=1))
+    logsuccess(f'results in {path(OUT_PATH, "backends.json")}', 'BENCH')
+    return results
+
+# (re)package when anything in the payload was restaged
+@stage('package', 'Packaging the installer',
+    after=[name for name in STAGES if name != 'sources'],
+    fetches=lambda: ['nsis'] if 'nsis' in PACKAGE_WITH else [],
+    inputs=lambda: [NSISSRC_PATH, VERSION, DEDUP, PACKAGE_WITH,
+                    *(inspect.getsource(BACKENDS[name].build) for name in PACKAGE_WITH),
+                    *([fetched('nsis', INSTALL_NSIS)] if 'nsis' in PACKAGE_WITH else [])],
+    outputs=lambda: [*packages(), path(MOZ_PATH, LICENSE_FILE), path(OUT_PATH, LICENSE_FILE),
+                     *([path(OUT_PATH, PAYLOAD_NSI)] if 'nsis' in PACKAGE_WITH and DEDUP == 'nsis' else [])])
+def stage_package():
+    logsubhead('Prepping the license')
+    stagelicense()
+
+    logsubhead('Staged payload')
+    reportsizes()
+
+    for name in PACKAGE_WITH:
+        logsubhead(f'Packaging {BACKENDS[name].title}')
+        with traced('backend', name):
+            BACKENDS[name].build(BACKENDS[name].output())
 
-# replace the version placeholder in the install script
-copy(path(NSISSRC_PATH, INSTALLER_NSI), OUT_PATH)
-modcontents(path(OUT_PATH, INSTALLER_NSI), replaceversion)
+#============================================================================
+# PIPELINE
+#
+# A packaging run as an importable api. The options are the ones of the
+# command line (by their 'dest' names), eg. from another script:
+#
+#   from packageit import Pipeline
+#   Pipeline(OUT_PATH='d:/stage', MSYS_EXTRA=True).run(only=['msys2'])
+#
+# The configuration lives in the module globals, so the active pipeline is
+# the one which was configured (or run) last.
+
+class Pipeline:
+    def __init__(self, options:Namespace=None, **overrides:Any):
+        self.options = options or args.parse_args([])
+        for name, value in overrides.items():
+            if not hasattr(self.options, name): raise TypeError(f'unknown option: {name}')
+            setattr(self.options, name, value)
+
+    # a pipeline with options from the command line
+    @classmethod
+    def fromargs(cls, argv:list[str]=None) -> 'Pipeline':
+        return cls(args.parse_args(argv))
+
+    @property
+    def stages(self) -> list[str]:
+        return list(STAGES)
+
+    # make the options of this pipeline the active configuration
+    def configure(self) -> 'Pipeline':
+        configure(self.options)
+        setupoutput(COLOR, VERBOSITY)
+        return self
+
+    def selected(self, only:list[str]=None) -> Maybe[list[str]]:
+        for name in (only := only or ONLY_STAGES or []):
+            if name not in STAGES: raise ValueError(
+                f'unknown stage "{name}", one of: {", ".join(STAGES)}')
+        return only or None
+
+    # print version + options as header
+    def header(self):
+        logheader(
+            ' '.join([fmt('MozillaBuild PACKAGEIT', BOLD, BLUE),
+                      chf(':'), fmt(VERSION, BOLD, MAGENTA)]),
+            [
+                ('Reference (host) MSYS2 install',  REF_PATH  or 'detected when needed'),
+                ('Source location',                 SRC_PATH),
+                ('Staging folder',                  OUT_PATH),
+                ('Clean staging folder first',      CLEAN),
+                ('Parallel stages',                 JOBS),
+                ('MSVC install path',               MSVC_PATH or 'detected when needed'),
+                ('Latest Windows 10 SDK path',      SDK_PATH  or 'detected when needed'),
+                ('Download MSYS2 package sources',  FETCH_SOURCES),
+                ('Download latest tool updates',    FETCH_TOOLS),
+                ('Download cache size limit (MiB)', CACHE_SIZE),
+                ('Tool lock file',                  readlock() and LOCK_FILE or 'unlocked'),
+                ('Bundle extras with MSYS2',        MSYS_EXTRA),
+                ('Bundle devel libs with MSYS2',    MSYS_DEVEL),
+                ('MSYS2 mirrors',                   f'{len(MIRROR_URLS)}, ranked on first use'),
+                ('Packaging backends',              ', '.join(PACKAGE_WITH)),
+            ]
+        )
+
+    # the stages a run would redo, and why: nothing is fetched or staged
+    # (the downloads are taken as the last run fetched them, so newer
+    # tool updates are not taken into account)
+    def plan(self, only:list[str]=None) -> list[tuple[str,Maybe[Text]]]:
+        global FETCHED
+        self.configure()
+        only = self.selected(only)
+        self.header()
+
+        logsection('Dry run')
+        FETCHED = lastfetched()
+        plan = planstages(STAGES, only)
+        for stage, reason in plan:
+            if reason: println(taskf('stage', YELLOW), stage.name, chf(f'({reason})'))
+            else:      println(taskf('up to date', DIM), stage.name)
+
+        return [(stage.name, reason) for stage, reason in plan]
+
+    # (re)do the invalid stages (of 'stages', default: all), or the 'only' ones.
+    # only the downloads of those stages (and the 'fetches') are prefetched
+    def run(self, only:list[str]=None, stages:dict[str,Stage]=None, fetches:list[str]=[]):
+        global FETCHED
+        self.configure()
+        only = self.selected(only)
+        resettrace()
+        resetcopies()
+        self.header()
+
+        # clear leftovers form previous run, if a clean build was requested
+        # (otherwise, only the invalid stages are redone)
+        if CLEAN and not only and os.path.exists(OUT_PATH):
+            logsubhead('Removing the previous staging directory')
+            rmdir(OUT_PATH)
+
+        logsubhead('Creating working directories')
+        mkdirs(CACHE_PATH, OUT_PATH, STAMP_PATH, MOZ_PATH, BIN_PATH)
+
+        logsubhead('Fetching tool updates and helpers')
+        selected = [stage for name, stage in (stages or STAGES).items() if not only or name in only]
+        FETCHED = prefetch(fetchjobs({*fetches, *(name for stage in selected for name in stage.fetches())}))
+        if lock := readlock(): checkassets(lock)
+
+        tracesection(None)
+        try:
+            with traced('run', f'MozillaBuild v{VERSION}', only=only):
+                runstages(stages or STAGES, JOBS, only)
+        finally:
+            logsubhead('Trace summary')
+            tracesection(None)
+            tracesummary()
+            reportcopies()
+            writetrace(TRACE_PATH)
+
+        if only:         logsuccess(f'MozillaBuild v{VERSION} stages done: {", ".join(only)}')
+        elif not stages: logsuccess(f'MozillaBuild v{VERSION} packages ready: '
+                                    + ', '.join(map(basename, packages())))
+
+    # write the missing entries of the lock file, or refresh the 'update'
+    # ones (all of them, if empty). the bundled installers are always rehashed
+    def resolve(self, update:list[str]=None) -> Json:
+        self.configure()
+        self.header()
+
+        logsection(f'Resolving the lock file: {LOCK_FILE}')
+        lock = loadlock()
+        names = list(TOOLS) + list(helpers())
+        for name in update or []:
+            if name not in names + ['wheels']:
+                raise ValueError(f'unknown tool "{name}", one of: {", ".join(names + ["wheels"])}')
+
+        todo = [name for name in names if name not in lock['tools'] or
+                update is not None and (not update or name in update)]
+        with ThreadPoolExecutor(FETCH_JOBS, thread_name_prefix='fetch') as pool:
+            pinned = dict(zip(todo, pool.map(pin, todo)))
+
+        for name in names:
+            entry = pinned.get(name) or lock['tools'][name]
+            println(taskf('pinned' if name in pinned else 'locked', YELLOW if name in pinned else DIM),
+                    fmt(name, GREEN), fmt(entry['version'] or '', CYAN), chf(entry['sha256'][:16]))
+
+        lock['tools'] = {name: pinned.get(name) or lock['tools'][name] for name in names}
+
+        if not lockedwheels(lock) or update is not None and (not update or 'wheels' in update):
+            lock['wheels'] = pinwheels()
+            pinned['wheels'] = lock['wheels']
+        for entry in lock['wheels']['packages'].values():
+            println(taskf('pinned' if 'wheels' in pinned else 'locked', YELLOW if 'wheels' in pinned else DIM),
+                    fmt(entry['name'], GREEN), fmt(entry['version'], CYAN), chf(entry['sha256'][:16]))
+
+        lock['assets'] = {name: {'file': os.path.relpath(filepath, SRC_PATH).replace(os.sep, '/'),
+                                 'size': os.path.getsize(filepath), 'sha256': contentdigest(filepath)}
+                          for name, filepath in assets().items() if os.path.isfile(filepath)}
+        putcontents(LOCK_FILE, json.dumps(lock, indent=1) + '\n')
+
+        logsuccess(f'{len(pinned)} entries resolved, {len(names) + 1 - len(pinned)} kept', 'LOCK')
+        return lock
+
+    # stage python (and what it needs), then time importing mercurial in it
+    def importtimes(self) -> list[Json]:
+        needed, todo = set(), ['pycompile']
+        while todo:
+            if (name := todo.pop()) not in needed: needed.add(name); todo += STAGES[name].after
+        self.run(stages={name: stage for name, stage in STAGES.items() if name in needed})
+
+        logsection(f'Benchmarking the import time: {IMPORT_BENCH}')
+        return benchimports()
+
+    # stage everything but the package, then compare the packaging backends
+    # ('names', the -b ones, or all of them) on the staged tree
+    def benchmark(self, names:list[str]=None) -> list[Json]:
+        self.run(stages={name: stage for name, stage in STAGES.items() if name != 'package'},
+                 fetches=STAGES['package'].fetches())
+
+        logsection('Benchmarking the packaging backends')
+        stagelicense()
+        return benchbackends(names or BACKEND_NAMES or list(BACKENDS))
 
 #----------------------------------------------------------------------------
 
-logsubhead('Packaging with NSIS...')
-command([path(OUT_PATH, NSISOUT_PATH, 'makensis.exe'),
-         '/NOCD', INSTALLER_NSI], cwd=OUT_PATH)
-
-logsuccess(f'MozillaBuild v{VERSION} installer package ready')
+# the defaults, until a pipeline is configured
+configure(args.parse_args([]))
+
+def main(argv:list[str]=None):
+    pipeline = Pipeline.fromargs(argv)
+    if pipeline.options.DRY_RUN:          pipeline.plan()
+    elif pipeline.options.BENCH_BACKENDS: pipeline.benchmark()
+    elif pipeline.options.BENCH_IMPORTS:  pipeline.importtimes()
+    elif pipeline.options.RESOLVE:        pipeline.resolve()
+    elif pipeline.options.UPDATE_TOOLS is not None:
+                                          pipeline.resolve(pipeline.options.UPDATE_TOOLS)
+    else:                                 pipeline.run()
+
+if __name__ == '__main__':
+    main()